@@ -29,7 +29,7 @@
 
 # MAGIC %md
 # MAGIC ### Projeto de Particionamento Adequado/Efetivo
-# MAGIC **Estratégia de Particionamento:** Não vi necessidade em desenvolver um esquema de particionamento, mas poderia ser feito considerando colunas-chave (como 'uf', 'registro_car',	'situacao_cadastro',	'condicao_cadastro' ou outras) para distribuir os dados de forma eficiente entre os nós do banco de dados distribuído. A estratégia de particionamento selecionada deve ser baseada em colunas relevantes para as consultas frequentes, buscando minimizar a necessidade de leitura de partições desnecessárias e otimizar o desempenho das consultas.
+# MAGIC **Estratégia de Particionamento:** Quase todas as consultas filtram ou agrupam por `uf` (Consultas 1, 2, 3, 6 e 8) e a Consulta 4 agrupa por ano de inscrição, então essas são as colunas candidatas ao particionamento horizontal. Em vez de fixar uma escolha, a gravação da tabela passa por uma etapa de layout configurável (`LAYOUT_TABELA`): sem particionamento (agrupada pela célula da grade), particionada por `uf`, particionada por `uf` e ano de inscrição, ou sem particionamento com Z-Ordering em `uf`/`area_do_imovel`. O benchmark de layouts, ao fim da bateria de testes, roda as oito consultas contra cada opção e registra bytes lidos, arquivos lidos e latência, para que a decisão de particionamento seja baseada em medições.
 
 # COMMAND ----------
 
@@ -38,6 +38,17 @@
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ##### Dependências
+# MAGIC
+# MAGIC `%pip` reinicia o Python do notebook, então as bibliotecas são instaladas antes de qualquer estado ser criado. As funções que rodam nos executores (como os sketches do modo aproximado) importam essas bibliotecas lá, e o `%pip` instala as dependências do notebook também nos executores. O motor de geometria usa funções vetorizadas que só existem a partir do shapely 2 (`contains_xy`, `prepare`, `box`, `STRtree.query` com predicado), por isso a versão mínima é fixada. O DuckDB é o motor SQL embutido usado na validação cruzada do catálogo de consultas.
+
+# COMMAND ----------
+
+# MAGIC %pip install datasketches "shapely>=2" duckdb
+
+# COMMAND ----------
+
 # Caminho para o arquivo Parquet no DBFS
 caminho_arquivo = "/FileStore/big-data_project/temas_ambientais-1.parquet"
 
@@ -54,8 +65,346 @@ caminho_delta = "/FileStore/big-data_project/delta/temas_amb"
 
 # COMMAND ----------
 
-# Escrevendo o DataFrame como Tabela Delta
-df.write.format("delta").mode("overwrite").save(caminho_delta)
+# MAGIC %md
+# MAGIC ##### Índice espacial em grade (quadtree)
+# MAGIC
+# MAGIC Cada propriedade recebe, na ingestão, o identificador `celula_grade` da célula de um quadtree sobre a grade latitude/longitude, na resolução `GRADE_RESOLUCAO`. O identificador intercala os bits das coordenadas da célula (código de Morton, equivalente a um quadkey), então as células filhas de uma célula ocupam um intervalo contínuo de identificadores. A tabela é gravada agrupada por `celula_grade`, de modo que as estatísticas min/max de cada arquivo cobrem poucas células. Consultas por polígono ou por raio calculam as células que cobrem a região, filtram por esses intervalos (data skipping) e só então aplicam o teste exato. Os motores centralizados usam os mesmos intervalos: a leitura em lotes os empurra para o filtro Arrow (row groups pelas estatísticas de `celula_grade`), e a máscara do Pandas descarta as linhas fora das células antes do teste exato, calculando `celula_grade` com a versão NumPy quando a coluna não foi lida.
+
+# COMMAND ----------
+
+import numpy as np
+from pyspark.sql import functions as F
+
+# Nível do quadtree: com 14, cada célula tem cerca de 0,022° de longitude por 0,011° de latitude
+GRADE_RESOLUCAO = 14
+
+# Número máximo de células avaliadas ao calcular a cobertura de uma região
+GRADE_MAX_CELULAS_COBERTURA = 4096
+
+# Raio médio da Terra em km
+RAIO_TERRA_KM = 6371
+
+
+# Expressão Spark (sem UDF) que calcula o identificador da célula de cada linha
+def coluna_celula_grade(resolucao=GRADE_RESOLUCAO, latitude="latitude", longitude="longitude"):
+    n = 2 ** resolucao
+    x = F.least(F.greatest(F.floor((F.col(longitude) + 180) / 360 * n), F.lit(0)), F.lit(n - 1)).cast("long")
+    y = F.least(F.greatest(F.floor((90 - F.col(latitude)) / 180 * n), F.lit(0)), F.lit(n - 1)).cast("long")
+
+    codigo = F.lit(0).cast("long")
+    for i in range(resolucao):
+        codigo = codigo.bitwiseOR(F.shiftleft(F.shiftright(x, i).bitwiseAND(1), 2 * i))
+        codigo = codigo.bitwiseOR(F.shiftleft(F.shiftright(y, i).bitwiseAND(1), 2 * i + 1))
+    return codigo
+
+
+# Intercala os bits de x (posições pares) e y (posições ímpares), versão NumPy
+def codigo_morton(x, y, resolucao):
+    x = np.asarray(x, dtype="int64")
+    y = np.asarray(y, dtype="int64")
+    codigo = np.zeros(np.broadcast(x, y).shape, dtype="int64")
+    for i in range(resolucao):
+        codigo |= ((x >> i) & 1) << (2 * i)
+        codigo |= ((y >> i) & 1) << (2 * i + 1)
+    return codigo
+
+
+# Versão NumPy de coluna_celula_grade, para o ambiente centralizado
+def celula_grade(latitudes, longitudes, resolucao=GRADE_RESOLUCAO):
+    n = 2 ** resolucao
+    x = np.clip(np.floor((np.asarray(longitudes, dtype="float64") + 180) / 360 * n), 0, n - 1)
+    y = np.clip(np.floor((90 - np.asarray(latitudes, dtype="float64")) / 180 * n), 0, n - 1)
+    return codigo_morton(x, y, resolucao)
+
+
+# Calcula os intervalos de celula_grade que cobrem uma geometria shapely (em lon/lat).
+# A cobertura é feita no nível mais fino que não ultrapassa GRADE_MAX_CELULAS_COBERTURA
+# células candidatas; cada célula grossa corresponde a um intervalo contínuo no nível da tabela.
+def intervalos_cobertura(geometria, resolucao=GRADE_RESOLUCAO, max_celulas=GRADE_MAX_CELULAS_COBERTURA):
+    import shapely
+
+    lon_min, lat_min, lon_max, lat_max = geometria.bounds
+    for nivel in range(resolucao, -1, -1):
+        n = 2 ** nivel
+        x0, x1 = int(np.clip(np.floor((lon_min + 180) / 360 * n), 0, n - 1)), int(np.clip(np.floor((lon_max + 180) / 360 * n), 0, n - 1))
+        y0, y1 = int(np.clip(np.floor((90 - lat_max) / 180 * n), 0, n - 1)), int(np.clip(np.floor((90 - lat_min) / 180 * n), 0, n - 1))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_celulas:
+            break
+
+    xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+    xs, ys = xs.ravel(), ys.ravel()
+    celulas = shapely.box(xs * 360 / n - 180, 90 - (ys + 1) * 180 / n, (xs + 1) * 360 / n - 180, 90 - ys * 180 / n)
+    cobertas = shapely.intersects(geometria, celulas)
+
+    # Cada célula do nível de cobertura vira um intervalo de identificadores no nível da tabela
+    deslocamento = 2 * (resolucao - nivel)
+    inicios = np.sort(codigo_morton(xs[cobertas], ys[cobertas], nivel)) << deslocamento
+    intervalos = []
+    for inicio in inicios.tolist():
+        fim = inicio + (1 << deslocamento) - 1
+        if intervalos and inicio == intervalos[-1][1] + 1:
+            intervalos[-1] = (intervalos[-1][0], fim)
+        else:
+            intervalos.append((inicio, fim))
+    return intervalos
+
+
+# Monta o predicado SQL que restringe a leitura às células que cobrem a geometria
+def filtro_celulas_grade(geometria, resolucao=GRADE_RESOLUCAO):
+    intervalos = intervalos_cobertura(geometria, resolucao)
+    if not intervalos:
+        return "FALSE"
+    return "(" + " OR ".join(f"celula_grade BETWEEN {inicio} AND {fim}" for inicio, fim in intervalos) + ")"
+
+
+# Expressão SQL da distância de Haversine (em km) entre cada linha e um ponto de referência
+def expressao_haversine_km(latitude_ref, longitude_ref):
+    return (
+        f"2 * {RAIO_TERRA_KM} * ASIN(SQRT("
+        f"POWER(SIN(RADIANS(latitude - {latitude_ref!r}) / 2), 2) + "
+        f"COS(RADIANS({latitude_ref!r})) * COS(RADIANS(latitude)) * "
+        f"POWER(SIN(RADIANS(longitude - {longitude_ref!r}) / 2), 2)))"
+    )
+
+
+# Caixa (em lon/lat) que contém o círculo de raio_km em torno do ponto de referência, na mesma esfera da
+# distância de Haversine. A maior abertura do círculo em longitude é exatamente asin(sin(r/R) / cos(lat)), com a
+# latitude do centro; um círculo que alcança um polo cobre todas as longitudes.
+def caixa_raio(latitude_ref, longitude_ref, raio_km):
+    import shapely
+
+    angulo = min(raio_km / RAIO_TERRA_KM, np.pi)
+    delta_lat = np.degrees(angulo)
+    if abs(latitude_ref) + delta_lat >= 90:
+        delta_lon = 180.0
+    else:
+        delta_lon = np.degrees(np.arcsin(min(1.0, np.sin(angulo) / np.cos(np.radians(latitude_ref)))))
+    return shapely.box(longitude_ref - delta_lon, latitude_ref - delta_lat, longitude_ref + delta_lon, latitude_ref + delta_lat)
+
+
+# Monta a consulta por raio: células que cobrem o círculo, seguidas do teste exato de distância
+def montar_sql_raio(tabela, latitude_ref, longitude_ref, raio_km, resolucao=GRADE_RESOLUCAO):
+    distancia = expressao_haversine_km(latitude_ref, longitude_ref)
+    return f"""
+        SELECT *, {distancia} AS distancia_km
+        FROM {tabela}
+        WHERE {filtro_celulas_grade(caixa_raio(latitude_ref, longitude_ref, raio_km), resolucao)}
+        AND {distancia} <= {raio_km!r}
+    """
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Layout físico da tabela (particionamento)
+# MAGIC
+# MAGIC Implementação da estratégia descrita em *Projeto de Particionamento Adequado/Efetivo*: os layouts disponíveis e a gravação da tabela com o layout escolhido em `LAYOUT_TABELA`.
+
+# COMMAND ----------
+
+# Layouts disponíveis: colunas de partição e colunas de Z-Ordering (OPTIMIZE ... ZORDER BY)
+LAYOUTS = {
+    "sem_particao": {"particoes": [], "zorder": []},
+    "uf": {"particoes": ["uf"], "zorder": []},
+    "uf_ano": {"particoes": ["uf", "ano_inscricao"], "zorder": []},
+    "zorder_uf_area": {"particoes": [], "zorder": ["uf", "area_do_imovel"]},
+}
+
+# Layout usado na tabela principal
+LAYOUT_TABELA = "sem_particao"
+
+
+# Grava o DataFrame como tabela Delta no layout informado
+def gravar_layout(df_origem, caminho, layout=LAYOUT_TABELA):
+    configuracao = LAYOUTS[layout]
+    particoes = configuracao["particoes"]
+
+    if "ano_inscricao" in particoes and "ano_inscricao" not in df_origem.columns:
+        df_origem = df_origem.withColumn("ano_inscricao", F.year("data_inscricao"))
+
+    # Com partições, cada tarefa grava apenas as suas partições; sem elas, os arquivos são agrupados pela célula da grade
+    if particoes:
+        df_origem = df_origem.repartition(*particoes)
+    else:
+        df_origem = df_origem.repartitionByRange("celula_grade")
+
+    # Sem deletion vectors: os motores centralizados leem os arquivos Parquet da tabela diretamente.
+    # O Change Data Feed alimenta a atualização incremental dos rollups.
+    escrita = df_origem.sortWithinPartitions("celula_grade").write.format("delta") \
+        .mode("overwrite").option("overwriteSchema", "true") \
+        .option("delta.enableDeletionVectors", "false") \
+        .option("delta.enableChangeDataFeed", "true")
+    if particoes:
+        escrita = escrita.partitionBy(*particoes)
+    escrita.save(caminho)
+
+    if configuracao["zorder"]:
+        spark.sql(f"OPTIMIZE delta.`{caminho}` ZORDER BY ({', '.join(configuracao['zorder'])})")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Ingestão incremental (upsert por `registro_car`)
+# MAGIC
+# MAGIC Regravar a tabela inteira a cada carga custa o mesmo que a base nacional, mesmo quando poucas propriedades mudaram de situação. No modo incremental, um manifesto registra os arquivos Parquet de origem já ingeridos (caminho, tamanho e data de modificação); só os arquivos novos ou alterados são lidos, e suas linhas são aplicadas com um `MERGE` do Delta pela chave `registro_car`. Linhas idênticas às da tabela não são reescritas. Quando a tabela é particionada por `uf`, o `MERGE` é restrito às UFs presentes nos arquivos alterados, para tocar apenas as partições afetadas. Com essa restrição, uma propriedade que mudou de UF não encontra a sua linha antiga e é inserida de novo, então a linha antiga é removida logo depois, em um segundo `MERGE` restrito às UFs antigas. No fim da ingestão, confere-se que `registro_car` continua único. As duas verificações (propriedades que mudaram de UF e chaves repetidas) só leem as linhas da tabela cujas chaves estão nos arquivos alterados (semi-join com as chaves da origem), então o custo acompanha o tamanho da mudança. Se houver chave repetida, a tabela é restaurada (`RESTORE`) à versão anterior ao `MERGE` antes do erro, e os arquivos não entram no manifesto. As colunas derivadas da origem (como `ano_inscricao`) seguem as partições da tabela existente, lidas do `DESCRIBE DETAIL`. Trocar `LAYOUT_TABELA` só muda a tabela na próxima carga com `MODO_INGESTAO = "completa"`, e a ingestão incremental avisa enquanto o layout da tabela for outro.
+
+# COMMAND ----------
+
+from delta.tables import DeltaTable
+
+# "incremental" aplica só as mudanças dos arquivos novos ou alterados; "completa" regrava a tabela
+MODO_INGESTAO = "incremental"
+
+# Manifesto dos arquivos de origem já ingeridos
+caminho_manifesto = "/FileStore/big-data_project/delta/controle/arquivos_ingeridos"
+
+
+# Acrescenta as colunas derivadas da tabela (célula da grade e, se as partições pedirem, o ano de inscrição).
+# Sem particoes, valem as partições do layout.
+def preparar_linhas(df_origem, layout=LAYOUT_TABELA, particoes=None):
+    particoes = LAYOUTS[layout]["particoes"] if particoes is None else particoes
+    df_origem = df_origem.select(coluna_celula_grade().alias("celula_grade"), "*")
+    if "ano_inscricao" in particoes:
+        df_origem = df_origem.withColumn("ano_inscricao", F.year("data_inscricao"))
+    return df_origem
+
+
+# Lista os arquivos Parquet de origem (o caminho pode ser um arquivo ou um diretório)
+def listar_arquivos_origem(caminho):
+    arquivos = []
+    pendentes = [caminho]
+    while pendentes:
+        for arquivo in dbutils.fs.ls(pendentes.pop()):
+            if arquivo.isDir():
+                pendentes.append(arquivo.path)
+            elif arquivo.name.endswith(".parquet"):
+                arquivos.append((arquivo.path, arquivo.size, arquivo.modificationTime))
+    return spark.createDataFrame(arquivos, "caminho STRING, tamanho LONG, modificacao LONG")
+
+
+# Arquivos de origem que ainda não foram ingeridos, ou que mudaram desde a última ingestão
+def arquivos_alterados(arquivos, caminho=caminho_manifesto):
+    if not DeltaTable.isDeltaTable(spark, caminho):
+        return arquivos
+    manifesto = spark.read.format("delta").load(caminho)
+    return arquivos.join(manifesto, ["caminho", "tamanho", "modificacao"], "left_anti")
+
+
+# Registra os arquivos como ingeridos no manifesto
+def registrar_arquivos_ingeridos(arquivos, caminho=caminho_manifesto):
+    if not DeltaTable.isDeltaTable(spark, caminho):
+        arquivos.write.format("delta").save(caminho)
+        return
+    DeltaTable.forPath(spark, caminho).alias("m").merge(arquivos.alias("a"), "m.caminho = a.caminho") \
+        .whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+
+
+# Linhas da tabela cujas chaves aparecem na origem (semi-join: as demais linhas não passam da leitura)
+def linhas_das_chaves(tabela, origem):
+    return tabela.toDF().join(origem.select("registro_car"), "registro_car", "left_semi")
+
+
+# Remove as linhas antigas das propriedades que mudaram de UF (inseridas de novo pelo MERGE restrito por UF)
+# e retorna quantas eram. O MERGE de remoção é restrito às UFs antigas, para tocar só as suas partições.
+def remover_ufs_antigas(tabela, origem):
+    mudaram = linhas_das_chaves(tabela, origem).alias("t") \
+        .join(origem.select("registro_car", "uf").alias("s"), "registro_car") \
+        .where(~F.col("t.uf").eqNullSafe(F.col("s.uf"))) \
+        .select("registro_car", F.col("t.uf").alias("uf_antiga"), F.col("s.uf").alias("uf_nova")).distinct() \
+        .cache()
+    ufs_antigas = [linha["uf_antiga"] for linha in mudaram.select("uf_antiga").distinct().collect()]
+    if not ufs_antigas:
+        mudaram.unpersist()
+        return 0
+    condicao = "t.registro_car = m.registro_car AND NOT (t.uf <=> m.uf_nova)"
+    if None not in ufs_antigas:
+        condicao += " AND t.uf IN (" + ", ".join(f"'{uf}'" for uf in ufs_antigas) + ")"
+    tabela.alias("t").merge(mudaram.alias("m"), condicao).whenMatchedDelete().execute()
+    mudaram.unpersist()
+    return int(tabela.history(1).select("operationMetrics").first()[0].get("numTargetRowsDeleted", 0))
+
+
+# Retorna a versão atual de uma tabela Delta
+def versao_delta(caminho):
+    return DeltaTable.forPath(spark, caminho).history(1).select("version").first()[0]
+
+
+# Aplica as linhas dos arquivos novos ou alterados na tabela Delta com MERGE por registro_car
+def ingerir_incremental(caminho_origem, caminho=caminho_delta, layout=LAYOUT_TABELA):
+    novos = arquivos_alterados(listar_arquivos_origem(caminho_origem)).cache()
+    try:
+        caminhos_novos = [linha["caminho"] for linha in novos.select("caminho").collect()]
+        if not caminhos_novos:
+            return {"arquivos": 0, "linhas_inseridas": 0, "linhas_atualizadas": 0, "linhas_inalteradas": 0}
+
+        # As colunas derivadas seguem as partições da tabela existente, e não o layout pedido: um layout novo só
+        # é aplicado pela carga completa, que regrava a tabela
+        particoes = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first()["partitionColumns"] or []
+        if sorted(particoes) != sorted(LAYOUTS[layout]["particoes"]):
+            print(f"A tabela {caminho} está particionada por {particoes}, e não pelo layout {layout}: "
+                  f"use MODO_INGESTAO = \"completa\" para regravá-la com o layout novo")
+
+        # Uma linha por registro_car na origem, como exige o MERGE
+        origem = preparar_linhas(spark.read.parquet(*caminhos_novos), particoes=particoes).dropDuplicates(["registro_car"])
+        ufs = [linha["uf"] for linha in origem.select("uf").distinct().collect() if linha["uf"] is not None]
+
+        # Com a tabela particionada por UF, a restrição por UF permite ao Delta descartar as partições que não
+        # podem ter correspondência. Uma propriedade que mudou de UF não é encontrada e é inserida de novo;
+        # a linha antiga é removida depois do MERGE.
+        restrito = "uf" in particoes and bool(ufs)
+        condicao = "t.registro_car = s.registro_car"
+        if restrito:
+            condicao += " AND t.uf IN (" + ", ".join(f"'{uf}'" for uf in ufs) + ")"
+
+        # Só atualiza quando alguma coluna mudou (comparação que trata nulos como iguais)
+        colunas = [coluna for coluna in origem.columns if coluna != "registro_car"]
+        mudou = " OR ".join(f"NOT (t.`{coluna}` <=> s.`{coluna}`)" for coluna in colunas)
+
+        tabela = DeltaTable.forPath(spark, caminho)
+        versao_anterior = versao_delta(caminho)
+        tabela.alias("t").merge(origem.alias("s"), condicao) \
+            .whenMatchedUpdateAll(condition=mudou) \
+            .whenNotMatchedInsertAll() \
+            .execute()
+
+        metricas = tabela.history(1).select("operationMetrics").first()[0]
+        inseridas = int(metricas.get("numTargetRowsInserted", 0))
+        atualizadas = int(metricas.get("numTargetRowsUpdated", 0))
+        if restrito:
+            # Uma propriedade que mudou de UF conta como atualizada, não como inserida
+            movidas = remover_ufs_antigas(tabela, origem)
+            inseridas -= movidas
+            atualizadas += movidas
+
+        # registro_car continua único depois da ingestão. Só as chaves da origem podem ter sido repetidas, então só
+        # as suas linhas são agrupadas. Com repetição, a tabela volta à versão anterior ao MERGE antes do erro.
+        repetidos = linhas_das_chaves(tabela, origem).groupBy("registro_car").count() \
+            .where(F.col("count") > 1).limit(5).collect()
+        if repetidos:
+            tabela.restoreToVersion(versao_anterior)
+            raise ValueError(f"registro_car repetido na tabela {caminho} após a ingestão (tabela restaurada à versão "
+                             f"{versao_anterior}): {[linha['registro_car'] for linha in repetidos]}")
+        registrar_arquivos_ingeridos(novos)
+
+        return {
+            "arquivos": len(caminhos_novos),
+            "linhas_inseridas": inseridas,
+            "linhas_atualizadas": atualizadas,
+            "linhas_inalteradas": int(metricas.get("numSourceRows", 0)) - inseridas - atualizadas,
+        }
+    finally:
+        novos.unpersist()
+
+# COMMAND ----------
+
+# Gravando a tabela Delta: carga completa na primeira execução (ou no modo "completa"), upsert nas seguintes.
+# Na carga completa a célula da grade é a primeira coluna (o Delta só coleta estatísticas das primeiras colunas).
+if MODO_INGESTAO == "completa" or not DeltaTable.isDeltaTable(spark, caminho_delta):
+    gravar_layout(preparar_linhas(df), caminho_delta, LAYOUT_TABELA)
+    registrar_arquivos_ingeridos(listar_arquivos_origem(caminho_arquivo))
+else:
+    relatorio_ingestao = ingerir_incremental(caminho_arquivo)
+    print(f"Arquivos processados: {relatorio_ingestao['arquivos']}")
+    print(f"Linhas inseridas: {relatorio_ingestao['linhas_inseridas']} | atualizadas: {relatorio_ingestao['linhas_atualizadas']} | inalteradas: {relatorio_ingestao['linhas_inalteradas']}")
 
 # COMMAND ----------
 
@@ -71,230 +420,1801 @@ df_delta.createOrReplaceTempView("tabela_delta")
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ## Bateria de Testes (Queries)
+# MAGIC ## Rollups de agregação
+# MAGIC
+# MAGIC As Consultas 1, 4, 5, 6 e 8 são agregações sobre a tabela inteira. Em vez de reler a tabela Delta a cada execução, uma tabela de resumo guarda, por (`uf`, ano de inscrição), a contagem de propriedades, a soma e a soma dos quadrados de `area_do_imovel` e a soma da razão de vegetação nativa.
+# MAGIC
+# MAGIC A tabela de resumo só recebe inserções: cada atualização lê o Change Data Feed da tabela base desde a última versão resumida, agrega as mudanças com sinal (+1 para inserções e pós-imagens de atualização, -1 para remoções e pré-imagens) e grava as contribuições em um único append, marcado com a versão da tabela base. Assim apends e MERGEs na base são refletidos sem reprocessar a tabela inteira. O roteador recebe um plano do catálogo de consultas, compila-o para o resumo quando ele está na mesma versão da base e os dados guardados bastam, e volta para a tabela base quando ele está desatualizado. Para decidir sem rodar jobs Spark, o roteador usa a versão resumida guardada no driver e a versão do último commit, lida da listagem do `_delta_log`. O Change Data Feed é ativado uma única vez, na gravação da tabela base.
+
+# COMMAND ----------
+
+from delta.tables import DeltaTable
+
+# Caminho da tabela de resumo por (uf, ano de inscrição)
+caminho_rollup = "/FileStore/big-data_project/delta/rollups/uf_ano"
+
+
+# Versão do último commit, lida da listagem do _delta_log no driver (sem job Spark)
+def versao_ultimo_commit(caminho):
+    commits = [arquivo.name for arquivo in dbutils.fs.ls(f"{caminho}/_delta_log") if arquivo.name.endswith(".json")]
+    return max(int(nome.split(".")[0]) for nome in commits)
+
+
+# Versão da base já refletida em cada resumo, guardada no driver para o roteador não consultar o resumo
+versoes_resumidas = {}
+
+
+# Agrega as contribuições de um DataFrame por (uf, ano), multiplicadas pela coluna de sinal
+def agregar_rollup(df_origem, versao, sinal=F.lit(1)):
+    area = F.col("area_do_imovel")
+    razao = F.when(area != 0, F.col("area_remanescente_vegetacao_nativa") / area)
+    return (
+        df_origem.withColumn("_sinal", sinal)
+        .groupBy("uf", F.year("data_inscricao").alias("ano_inscricao"))
+        .agg(
+            F.sum("_sinal").alias("contagem"),
+            F.sum(F.when(area.isNotNull(), F.col("_sinal"))).alias("contagem_area"),
+            F.sum(F.col("_sinal") * area).alias("soma_area"),
+            F.sum(F.col("_sinal") * area * area).alias("soma_area_quadrado"),
+            F.sum(F.when(razao.isNotNull(), F.col("_sinal"))).alias("contagem_razao"),
+            F.sum(F.col("_sinal") * razao).alias("soma_razao"),
+        )
+        .withColumn("versao_base", F.lit(versao).cast("long"))
+    )
+
+
+# Linha sem contribuições que registra a versão da base já refletida no resumo
+def marcador_versao(versao):
+    return spark.sql(f"""
+        SELECT CAST(NULL AS STRING) AS uf, CAST(NULL AS INT) AS ano_inscricao,
+               0L AS contagem, 0L AS contagem_area, 0D AS soma_area, 0D AS soma_area_quadrado,
+               0L AS contagem_razao, 0D AS soma_razao, {versao}L AS versao_base
+    """)
+
+
+# Reconstrói o resumo a partir da tabela base inteira (também compacta as contribuições acumuladas)
+def reconstruir_rollup(caminho_base=caminho_delta, caminho=caminho_rollup):
+    # O Change Data Feed é ativado na gravação da base (gravar_layout); só tabelas antigas precisam do ALTER,
+    # que cria uma nova versão da base
+    propriedades = spark.sql(f"DESCRIBE DETAIL delta.`{caminho_base}`").first()["properties"] or {}
+    if propriedades.get("delta.enableChangeDataFeed", "false").lower() != "true":
+        spark.sql(f"ALTER TABLE delta.`{caminho_base}` SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+    versao = versao_delta(caminho_base)
+    base = spark.read.format("delta").option("versionAsOf", versao).load(caminho_base)
+    agregar_rollup(base, versao).unionByName(marcador_versao(versao)) \
+        .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(caminho)
+    versoes_resumidas[caminho] = versao
+    return versao
+
+
+# Versão da tabela base já refletida no resumo (None se o resumo não existe)
+def versao_rollup(caminho=caminho_rollup):
+    if caminho not in versoes_resumidas:
+        if not DeltaTable.isDeltaTable(spark, caminho):
+            return None
+        versoes_resumidas[caminho] = spark.read.format("delta").load(caminho).agg(F.max("versao_base")).first()[0]
+    return versoes_resumidas[caminho]
+
+
+# Aplica ao resumo as mudanças da tabela base desde a última versão resumida
+def atualizar_rollup(caminho_base=caminho_delta, caminho=caminho_rollup):
+    versao_resumida = versao_rollup(caminho)
+    if versao_resumida is None:
+        return reconstruir_rollup(caminho_base, caminho)
+
+    versao_atual = versao_delta(caminho_base)
+    if versao_resumida >= versao_atual:
+        return versao_resumida
+
+    try:
+        mudancas = spark.read.format("delta").option("readChangeFeed", "true") \
+            .option("startingVersion", versao_resumida + 1).option("endingVersion", versao_atual) \
+            .load(caminho_base)
+        sinal = F.when(F.col("_change_type").isin("insert", "update_postimage"), 1).otherwise(-1)
+        agregar_rollup(mudancas, versao_atual, sinal).unionByName(marcador_versao(versao_atual)) \
+            .write.format("delta").mode("append").save(caminho)
+        versoes_resumidas[caminho] = versao_atual
+    except Exception as erro:
+        # Sem Change Data Feed para o intervalo (ex.: versões anteriores à sua ativação), o resumo é refeito
+        print(f"Change Data Feed indisponível ({erro.__class__.__name__}); reconstruindo o resumo")
+        return reconstruir_rollup(caminho_base, caminho)
+    return versao_atual
+
+
+# Verifica se o resumo reflete a versão atual da tabela base (versões do driver, sem jobs Spark)
+def rollup_atualizado(caminho_base=caminho_delta, caminho=caminho_rollup):
+    versao_resumida = versao_rollup(caminho)
+    return versao_resumida is not None and versao_resumida >= versao_ultimo_commit(caminho_base)
+
+# COMMAND ----------
+
+# Compila um plano do catálogo de consultas para o resumo, quando o plano só usa o que o resumo guarda: filtros
+# por lista de UFs, agrupamento por uf e/ou ano de inscrição e contagens, somas e médias da área ou da razão de
+# vegetação. As contribuições de cada (uf, ano) são somadas e os grupos sem propriedades (marcadores de versão
+# ou grupos zerados por remoções) são descartados. Retorna None quando o resumo não responde o plano.
+def plano_para_sql_rollup(plano):
+    colunas_resumo = {"uf": "uf", "area_do_imovel": "area"}
+    for nome, derivada in plano.get("derivadas", {}).items():
+        if derivada == ("ano", "data_inscricao"):
+            colunas_resumo[nome] = "ano_inscricao"
+        elif derivada == ("razao", "area_remanescente_vegetacao_nativa", "area_do_imovel"):
+            colunas_resumo[nome] = "razao"
+        else:
+            return None
+
+    filtros = []
+    for coluna, operador, argumento in plano.get("filtros", []):
+        if coluna != "uf" or operador != "em":
+            return None
+        filtros.append("uf IN (" + ", ".join(literal_sql(valor) for valor in argumento) + ")")
+
+    grupos = plano.get("agrupar", [])
+    if not plano.get("agregacoes") or any(colunas_resumo.get(grupo) not in ("uf", "ano_inscricao") for grupo in grupos):
+        return None
+    selecao = [f"{colunas_resumo[grupo]} AS {grupo}" for grupo in grupos]
+    for nome, (funcao, coluna) in plano["agregacoes"].items():
+        origem = colunas_resumo.get(coluna)
+        if funcao == "contagem":
+            selecao.append(f"SUM(contagem) AS {nome}")
+        elif funcao == "soma" and origem == "area":
+            selecao.append(f"SUM(soma_area) AS {nome}")
+        elif funcao == "media" and origem in ("area", "razao"):
+            selecao.append(f"SUM(soma_{origem}) / SUM(contagem_{origem}) AS {nome}")
+        else:
+            return None
+
+    sql = f"SELECT {', '.join(selecao)} FROM rollup_uf_ano"
+    if filtros:
+        sql += " WHERE " + " AND ".join(filtros)
+    if grupos:
+        sql += " GROUP BY " + ", ".join(colunas_resumo[grupo] for grupo in grupos) + " HAVING SUM(contagem) > 0"
+    if plano.get("ordenar"):
+        sql += " ORDER BY " + ", ".join(f"{coluna} {'ASC' if crescente else 'DESC'}" for coluna, crescente in plano["ordenar"])
+    return sql
+
+
+# Médias de área do resumo, por UF ou nacional, para o filtro relativo_grupo (Consulta 8). A tabela base
+# ainda é lida uma vez, porque a contagem acima da média depende da distribuição das áreas. Os percentis não
+# estão no resumo e vêm da tabela base.
+def referencia_rollup(coluna, estatistica, grupo):
+    if estatistica != "media" or coluna != "area_do_imovel" or grupo not in ("uf", None):
+        return referencia_duas_fases(coluna, estatistica, grupo)
+    if grupo is None:
+        return literal_sql(spark.sql("SELECT SUM(soma_area) / SUM(contagem_area) FROM rollup_uf_ano").first()[0])
+    medias = spark.sql("""
+        SELECT uf, SUM(soma_area) / SUM(contagem_area)
+        FROM rollup_uf_ano
+        GROUP BY uf
+        HAVING SUM(contagem_area) > 0
+    """).collect()
+    return expressao_por_grupo("uf", [(linha[0], linha[1]) for linha in medias])
+
+
+# Responde o plano pelo resumo quando ele está atualizado; caso contrário, executa o plano na tabela base
+def rotear_plano(plano, caminho_base=caminho_delta, caminho=caminho_rollup):
+    if not rollup_atualizado(caminho_base, caminho):
+        return motor_spark(plano)
+
+    spark.read.format("delta").load(caminho).createOrReplaceTempView("rollup_uf_ano")
+    sql = plano_para_sql_rollup(plano)
+    if sql is not None:
+        return spark.sql(sql)
+    return motor_spark(plano, referencia_grupo=referencia_rollup)
+
+# COMMAND ----------
+
+# Mantendo o resumo em dia com a versão atual da tabela base
+print(f"Resumo na versão {atualizar_rollup()} da tabela base")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Modo aproximado (sketches e amostra estratificada)
+# MAGIC
+# MAGIC Painéis que só precisam de respostas com erro de cerca de 1% não precisam pagar uma leitura exata da tabela a cada atualização. Na ingestão, cada partição do Spark gera, por UF, a contagem de propriedades, um sketch HLL dos municípios (contagem de distintos) e um sketch KLL de `area_do_imovel` (percentis), todos combináveis entre si; e uma amostra estratificada por `uf`, com o peso de cada linha, é gravada à parte. Na consulta, os sketches das partições são combinados no driver e cada resposta vem com um intervalo de erro: o intervalo de ~95% do HLL, o erro de posto normalizado do KLL e o intervalo de confiança de 95% do estimador estratificado. HLL e KLL não suportam remoções, então os sketches são refeitos quando a versão da tabela base muda.
+
+# COMMAND ----------
+
+import numpy as np
 import pandas as pd
+
+# Parâmetros dos sketches: lg_k do HLL (erro padrão ~1,04/sqrt(2^lg_k)) e k do KLL (erro de posto ~1% com k=400)
+SKETCH_HLL_LG_K = 14
+SKETCH_KLL_K = 400
+
+# Tamanho desejado da amostra de cada UF
+AMOSTRA_LINHAS_POR_UF = 20000
+
+# Caminhos das tabelas do modo aproximado
+caminho_sketches = "/FileStore/big-data_project/delta/aproximado/sketches"
+caminho_amostra = "/FileStore/big-data_project/delta/aproximado/amostra_uf"
+
+
+# Gera os sketches de uma partição do Spark, um registro por UF (usada com mapInPandas)
+def sketches_particao(lotes, lg_k=SKETCH_HLL_LG_K, k=SKETCH_KLL_K):
+    from datasketches import hll_sketch, kll_floats_sketch
+    from pyspark import TaskContext
+
+    por_uf = {}
+    for lote in lotes:
+        for uf, grupo in lote.groupby('uf', dropna=False):
+            uf = None if pd.isna(uf) else uf
+            if uf not in por_uf:
+                por_uf[uf] = [0, hll_sketch(lg_k), kll_floats_sketch(k)]
+            sketches = por_uf[uf]
+            sketches[0] += len(grupo)
+            # Os municípios se repetem muito dentro do lote; só os distintos precisam entrar no HLL
+            for municipio in grupo['municipio'].dropna().unique():
+                sketches[1].update(str(municipio))
+            areas = grupo['area_do_imovel'].dropna().to_numpy(dtype="float32")
+            if len(areas):
+                sketches[2].update(areas)
+
+    particao = TaskContext.get().partitionId()
+    yield pd.DataFrame([
+        {"uf": uf, "particao": particao, "contagem": contagem,
+         "hll_municipios": bytes(hll.serialize_compact()), "kll_area": bytes(kll.serialize())}
+        for uf, (contagem, hll, kll) in por_uf.items()
+    ], columns=["uf", "particao", "contagem", "hll_municipios", "kll_area"])
+
+
+# Refaz os sketches e a amostra estratificada quando a versão da tabela base mudou
+def construir_aproximacoes(caminho_base=caminho_delta):
+    versao = versao_delta(caminho_base)
+    if DeltaTable.isDeltaTable(spark, caminho_sketches):
+        versao_sketches = spark.read.format("delta").load(caminho_sketches).agg(F.max("versao_base")).first()[0]
+        if versao_sketches == versao:
+            return versao
+
+    base = spark.read.format("delta").option("versionAsOf", versao).load(caminho_base)
+
+    base.select("uf", "municipio", "area_do_imovel") \
+        .mapInPandas(sketches_particao, "uf STRING, particao INT, contagem LONG, hll_municipios BINARY, kll_area BINARY") \
+        .withColumn("versao_base", F.lit(versao).cast("long")) \
+        .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(caminho_sketches)
+
+    # Amostra estratificada: fração de cada UF escolhida para chegar perto de AMOSTRA_LINHAS_POR_UF linhas
+    contagens = {linha["uf"]: linha["count"] for linha in base.groupBy("uf").count().collect() if linha["uf"] is not None}
+    fracoes = {uf: min(1.0, AMOSTRA_LINHAS_POR_UF / contagem) for uf, contagem in contagens.items()}
+    base.sampleBy("uf", fracoes, seed=42) \
+        .select("uf", "area_do_imovel", "area_remanescente_vegetacao_nativa") \
+        .withColumn("versao_base", F.lit(versao).cast("long")) \
+        .write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(caminho_amostra)
+    return versao
+
+# COMMAND ----------
+
+# Combina os sketches HLL das partições e estima o número de municípios distintos (intervalo de ~95%)
+def municipios_distintos_aproximado(ufs=None):
+    from datasketches import hll_sketch, hll_union
+
+    sketches = spark.read.format("delta").load(caminho_sketches)
+    if ufs:
+        sketches = sketches.where(F.col("uf").isin(ufs))
+    uniao = hll_union(SKETCH_HLL_LG_K)
+    for linha in sketches.select("hll_municipios").collect():
+        uniao.update(hll_sketch.deserialize(bytes(linha["hll_municipios"])))
+    resultado = uniao.get_result()
+    return {"valor": resultado.get_estimate(), "limite_inferior": resultado.get_lower_bound(2),
+            "limite_superior": resultado.get_upper_bound(2)}
+
+
+# Combina os sketches KLL das partições e estima um percentil de area_do_imovel.
+# O intervalo corresponde aos percentis q ± erro de posto normalizado.
+def percentil_area_aproximado(q, ufs=None):
+    from datasketches import kll_floats_sketch
+
+    sketches = spark.read.format("delta").load(caminho_sketches)
+    if ufs:
+        sketches = sketches.where(F.col("uf").isin(ufs))
+    combinado = kll_floats_sketch(SKETCH_KLL_K)
+    for linha in sketches.select("kll_area").collect():
+        combinado.merge(kll_floats_sketch.deserialize(bytes(linha["kll_area"])))
+    erro = combinado.get_normalized_rank_error(False)
+    return {"valor": combinado.get_quantile(q), "limite_inferior": combinado.get_quantile(max(0.0, q - erro)),
+            "limite_superior": combinado.get_quantile(min(1.0, q + erro))}
+
+
+# Contagem de propriedades por UF, somando as contagens das partições (exata)
+def contagem_por_uf_aproximada():
+    return spark.read.format("delta").load(caminho_sketches).groupBy("uf") \
+        .agg(F.sum("contagem").alias("total_propriedades")).toPandas()
+
+
+# Estratos da amostra: tamanho da população (das contagens exatas), tamanho, média e variância amostrais
+def estratos_amostra(valores):
+    populacao = contagem_por_uf_aproximada().set_index("uf")["total_propriedades"]
+    estratos = valores.groupby(level=0).agg(["count", "mean", "var"])
+    estratos["populacao"] = populacao.reindex(estratos.index)
+    # Fator de correção para população finita: zero quando o estrato inteiro está na amostra
+    estratos["correcao"] = (1 - estratos["count"] / estratos["populacao"]).clip(lower=0)
+    return estratos.fillna({"var": 0})
+
+
+# Razão média de vegetação nativa (Consulta 5) pelo estimador estratificado, com intervalo de confiança de 95%
+def razao_vegetacao_aproximada():
+    amostra = spark.read.format("delta").load(caminho_amostra).toPandas()
+    area = amostra["area_do_imovel"].where(amostra["area_do_imovel"] != 0)
+    razoes = (amostra["area_remanescente_vegetacao_nativa"] / area).set_axis(amostra["uf"]).dropna()
+    estratos = estratos_amostra(razoes)
+
+    pesos = estratos["populacao"] / estratos["populacao"].sum()
+    valor = (pesos * estratos["mean"]).sum()
+    erro_padrao = np.sqrt((pesos ** 2 * estratos["var"] / estratos["count"] * estratos["correcao"]).sum())
+    return {"valor": valor, "limite_inferior": valor - 1.96 * erro_padrao, "limite_superior": valor + 1.96 * erro_padrao}
+
+
+# Soma de área por UF (Consulta 1) pelo estimador de expansão de cada estrato, com intervalo de confiança de 95%
+def area_por_uf_aproximada(ufs=None):
+    amostra = spark.read.format("delta").load(caminho_amostra).toPandas()
+    estratos = estratos_amostra(amostra["area_do_imovel"].set_axis(amostra["uf"]).dropna())
+    if ufs:
+        estratos = estratos[estratos.index.isin(ufs)]
+
+    valor = estratos["populacao"] * estratos["mean"]
+    erro_padrao = estratos["populacao"] * np.sqrt(estratos["var"] / estratos["count"] * estratos["correcao"])
+    return pd.DataFrame({"valor": valor, "limite_inferior": valor - 1.96 * erro_padrao,
+                         "limite_superior": valor + 1.96 * erro_padrao}).rename_axis("uf").reset_index()
+
+# COMMAND ----------
+
+# Mantendo os sketches e a amostra em dia com a versão atual da tabela base
+print(f"Sketches e amostra na versão {construir_aproximacoes()} da tabela base")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Bateria de Testes (Queries)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Representação compacta para o ambiente centralizado
+# MAGIC
+# MAGIC Depois do `toPandas()`, as colunas de texto ficam como objetos Python (uma string por linha) e a Consulta 4 convertia `data_inscricao` dentro da região medida. O carregador abaixo transforma as colunas de texto com poucos valores distintos em categorias (códigos inteiros e um dicionário de valores), reduz as colunas numéricas ao menor tipo que representa os mesmos valores e converte as datas uma única vez, derivando a coluna `ano_inscricao`. Assim `isin`, `groupby('uf')` e `value_counts` trabalham sobre códigos inteiros.
+
+# COMMAND ----------
+
 import time
 
-# Leitura dos dados em um DataFrame Pandas
-df_pd = df_delta.toPandas()
-
-# COMMAND ----------
-
-# Consulta 1 - Distribuído (Spark)
-start_time_spark_1 = time.time()
-consulta1_spark = spark.sql("""
-    SELECT uf, SUM(area_do_imovel) AS area_total_hectares
-    FROM tabela_delta
-    WHERE uf IN ('MS', 'MT') 
-    GROUP BY uf 
-    ORDER BY area_total_hectares DESC
-""")
-#consulta1_spark.display()
-end_time_spark_1 = time.time()
-
-# Consulta 1 - Centralizado (Pandas)
-start_time_pandas_1 = time.time()
-consulta1_pandas = df_pd[df_pd['uf'].isin(['MS', 'MT'])].groupby('uf')['area_do_imovel'].sum().reset_index()
-consulta1_pandas = consulta1_pandas.sort_values(by='area_do_imovel', ascending=False)
-#display(consulta1_pandas)
-end_time_pandas_1 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_1 = end_time_spark_1 - start_time_spark_1
-tempo_execucao_pandas_1 = end_time_pandas_1 - start_time_pandas_1
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 1 (Spark): {tempo_execucao_spark_1} segundos")
-print(f"Tempo de execução Consulta 1 (Pandas): {tempo_execucao_pandas_1} segundos")
-
-# COMMAND ----------
-
-# Consulta 2 - Distribuído (Spark)
-start_time_spark_2 = time.time()
-consulta2_spark = spark.sql("""
-    SELECT *
-    FROM tabela_delta
-    WHERE uf IN ('SP', 'RJ', 'MG', 'ES')
-""")
-#consulta2_spark.display()
-end_time_spark_2 = time.time()
-
-# Consulta 2 - Centralizado (Pandas)
-start_time_pandas_2 = time.time()
-consulta2_pandas = df_pd[df_pd['uf'].isin(['SP', 'RJ', 'MG', 'ES'])]
-#display(consulta2_pandas)
-end_time_pandas_2 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_2 = end_time_spark_2 - start_time_spark_2
-tempo_execucao_pandas_2 = end_time_pandas_2 - start_time_pandas_2
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 2 (Spark): {tempo_execucao_spark_2} segundos")
-print(f"Tempo de execução Consulta 2 (Pandas): {tempo_execucao_pandas_2} segundos")
-
-# COMMAND ----------
-
-# Função para verificar se as coordenadas estão dentro do polígono
-def check_inside_polygon(lat, lon):
-    point = Point(lon, lat)
-    return polygon.contains(point)
-
-# Registrando a função como uma UDF (User Defined Function)
-spark.udf.register("check_inside_polygon", check_inside_polygon)
-
-# Consulta 3 - Distribuído (Spark)
-start_time_spark_3 = time.time()
-consulta3_spark = spark.sql("""
-    SELECT *
-    FROM tabela_delta
-    WHERE uf IN ('GO', 'MS', 'MT')
-    AND check_inside_polygon(latitude, longitude) = True
-""")
-#consulta3_spark.display()
-end_time_spark_3 = time.time()
-
-# Consulta 3 - Centralizado (Pandas)
-start_time_pandas_3 = time.time()
-consulta3_pandas = df_pd[df_pd['uf'].isin(['GO', 'MS', 'MT'])]
-consulta3_pandas = consulta3_pandas[consulta3_pandas.apply(lambda row: check_inside_polygon(row['latitude'], row['longitude']), axis=1)]
-#display(consulta3_pandas)
-end_time_pandas_3 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_3 = end_time_spark_3 - start_time_spark_3
-tempo_execucao_pandas_3 = end_time_pandas_3 - start_time_pandas_3
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 3 (Spark): {tempo_execucao_spark_3} segundos")
-print(f"Tempo de execução Consulta 3 (Pandas): {tempo_execucao_pandas_3} segundos")
-
-# COMMAND ----------
-
-# Consulta 4 - Distribuído (Spark)
-start_time_spark_4 = time.time()
-consulta4_spark = spark.sql("""
-    SELECT YEAR(data_inscricao) AS ano, COUNT(*) AS total_propriedades
-    FROM tabela_delta
-    GROUP BY YEAR(data_inscricao)
-    ORDER BY ano
-""")
-#consulta4_spark.display()
-end_time_spark_4 = time.time()
-
-# Consulta 4 - Centralizado (Pandas)
-start_time_pandas_4 = time.time()
-df_pd['data_inscricao'] = pd.to_datetime(df_pd['data_inscricao'])
-consulta4_pandas = df_pd.groupby(df_pd['data_inscricao'].dt.year).size().reset_index(name='total_propriedades')
-consulta4_pandas = consulta4_pandas.rename(columns={'data_inscricao': 'ano'})
-#display(consulta4_pandas)
-end_time_pandas_4 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_4 = end_time_spark_4 - start_time_spark_4
-tempo_execucao_pandas_4 = end_time_pandas_4 - start_time_pandas_4
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 4 (Spark): {tempo_execucao_spark_4} segundos")
-print(f"Tempo de execução Consulta 4 (Pandas): {tempo_execucao_pandas_4} segundos")
-
-# COMMAND ----------
-
-# Consulta 5 - Distribuído (Spark)
-start_time_spark_5 = time.time()
-consulta5_spark = spark.sql("""
-    SELECT AVG(area_remanescente_vegetacao_nativa / area_do_imovel) AS percentual_medio
-    FROM tabela_delta
-""")
-#consulta5_spark.display()
-end_time_spark_5 = time.time()
-
-# Consulta 5 - Centralizado (Pandas)
-start_time_pandas_5 = time.time()
-consulta5_pandas = df_pd['area_remanescente_vegetacao_nativa'].mean() / df_pd['area_do_imovel'].mean()
-#display(f"Percentual médio (Pandas): {consulta5_pandas}")
-end_time_pandas_5 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_5 = end_time_spark_5 - start_time_spark_5
-tempo_execucao_pandas_5 = end_time_pandas_5 - start_time_pandas_5
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 5 (Spark): {tempo_execucao_spark_5} segundos")
-print(f"Tempo de execução Consulta 5 (Pandas): {tempo_execucao_pandas_5} segundos")
-
-
-# COMMAND ----------
-
-# Consulta 6 - Distribuído (Spark)
-start_time_spark_6 = time.time()
-consulta6_spark = spark.sql("""
-    SELECT uf, COUNT(*) AS total_propriedades
-    FROM tabela_delta
-    GROUP BY uf
-""")
-#consulta6_spark.display()
-end_time_spark_6 = time.time()
-
-# Consulta 6 - Centralizado (Pandas)
-start_time_pandas_6 = time.time()
-consulta6_pandas = df_pd['uf'].value_counts()
-#display(f"Total de propriedades por UF (Pandas):\n{consulta6_pandas}")
-end_time_pandas_6 = time.time()
-
-# Cálculo dos tempos de execução
-tempo_execucao_spark_6 = end_time_spark_6 - start_time_spark_6
-tempo_execucao_pandas_6 = end_time_pandas_6 - start_time_pandas_6
-
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 6 (Spark): {tempo_execucao_spark_6} segundos")
-print(f"Tempo de execução Consulta 6 (Pandas): {tempo_execucao_pandas_6} segundos")
-
-
+import numpy as np
+import pandas as pd
+
+# Colunas de texto com poucos valores distintos, guardadas como categorias
+COLUNAS_CATEGORICAS = ['uf', 'municipio', 'situacao_cadastro', 'condicao_cadastro']
+
+
+# Memória ocupada por um DataFrame Pandas, em MB (incluindo o conteúdo das strings)
+def memoria_mb(df_memoria):
+    return df_memoria.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+# Converte o DataFrame para a representação compacta (altera e retorna o próprio DataFrame)
+def compactar_pandas(df_memoria):
+    for coluna in COLUNAS_CATEGORICAS:
+        if coluna in df_memoria.columns:
+            df_memoria[coluna] = df_memoria[coluna].astype('category')
+
+    for coluna in df_memoria.select_dtypes(include='integer').columns:
+        df_memoria[coluna] = pd.to_numeric(df_memoria[coluna], downcast='integer')
+
+    # float32 só quando a conversão não altera nenhum valor
+    for coluna in df_memoria.select_dtypes(include='float').columns:
+        reduzida = df_memoria[coluna].astype('float32')
+        if np.array_equal(reduzida.to_numpy(dtype='float64'), df_memoria[coluna].to_numpy(), equal_nan=True):
+            df_memoria[coluna] = reduzida
+
+    if 'data_inscricao' in df_memoria.columns:
+        df_memoria['data_inscricao'] = pd.to_datetime(df_memoria['data_inscricao'])
+        df_memoria['ano_inscricao'] = df_memoria['data_inscricao'].dt.year.astype('Int16')
+    return df_memoria
+
+
+# Carrega a tabela Spark no driver na representação compacta, informando a memória antes e depois
+def carregar_pandas_compacto(df_spark):
+    df_memoria = df_spark.toPandas()
+    memoria_antes = memoria_mb(df_memoria)
+    df_memoria = compactar_pandas(df_memoria)
+    print(f"Memória do DataFrame Pandas: {memoria_antes:.1f} MB antes, {memoria_mb(df_memoria):.1f} MB depois")
+    return df_memoria
+
 # COMMAND ----------
 
-# Consulta 8 - Distribuído (Spark)
-start_time_spark_8 = time.time()
-consulta8_spark = spark.sql("""
-    WITH media_por_estado AS (
-        SELECT uf, AVG(area_do_imovel) AS media_area
-        FROM tabela_delta
-        GROUP BY uf
+# MAGIC %md
+# MAGIC ##### Snapshot local mapeado em memória
+# MAGIC
+# MAGIC Carregar o ambiente centralizado exige ler a tabela Delta inteira e convertê-la para Pandas a cada sessão. O snapshot grava a versão atual da tabela, já na representação compacta, em um arquivo Arrow IPC (Feather v2, sem compressão) no disco local do driver, com a versão do Delta no nome e nos metadados do arquivo. As sessões seguintes abrem o arquivo com `pyarrow.memory_map` e o snapshot só é refeito quando a versão da tabela Delta muda. Na conversão para Pandas, as colunas de texto viram `pd.ArrowDtype` apoiadas nos buffers mapeados, sem criar um `str` do Python por linha, e as colunas numéricas sem nulos reaproveitam os buffers. As colunas numéricas com nulos e as categorias ainda são copiadas na conversão.
+
+# COMMAND ----------
+
+import glob
+import os
+
+import pyarrow as pa
+
+# Diretório dos snapshots no disco local do driver
+caminho_snapshots = "/local_disk0/big-data_project/snapshots"
+
+
+# Caminho do snapshot de uma versão da tabela Delta
+def caminho_snapshot(versao, caminho=caminho_snapshots):
+    return os.path.join(caminho, f"temas_amb_v{versao}.arrow")
+
+
+# Grava o snapshot compacto de uma versão da tabela Delta (gravação atômica via arquivo temporário)
+def criar_snapshot(versao, caminho_base=caminho_delta, caminho=caminho_snapshots):
+    os.makedirs(caminho, exist_ok=True)
+    df_versao = spark.read.format("delta").option("versionAsOf", versao).load(caminho_base)
+    tabela = pa.Table.from_pandas(carregar_pandas_compacto(df_versao), preserve_index=False)
+    tabela = tabela.replace_schema_metadata({**(tabela.schema.metadata or {}), b"delta_versao": str(versao).encode()})
+
+    destino = caminho_snapshot(versao, caminho)
+    temporario = destino + ".tmp"
+    with pa.OSFile(temporario, "wb") as arquivo, pa.ipc.new_file(arquivo, tabela.schema) as escritor:
+        escritor.write_table(tabela)
+    os.replace(temporario, destino)
+
+    # Snapshots de versões anteriores não são mais usados
+    for antigo in glob.glob(os.path.join(caminho, "temas_amb_v*.arrow")):
+        if antigo != destino:
+            os.remove(antigo)
+    return destino
+
+
+# Texto continua no formato Arrow (pd.ArrowDtype), sem criar um str do Python por linha; os demais tipos seguem o padrão
+def tipo_pandas_arrow(tipo):
+    if pa.types.is_string(tipo) or pa.types.is_large_string(tipo):
+        return pd.ArrowDtype(tipo)
+    return None
+
+
+# Carrega a versão atual da tabela a partir do snapshot mapeado em memória, refazendo-o se a versão mudou
+def carregar_snapshot(caminho_base=caminho_delta, caminho=caminho_snapshots):
+    versao = versao_delta(caminho_base)
+    destino = caminho_snapshot(versao, caminho)
+    if not os.path.exists(destino):
+        print(f"Criando snapshot da versão {versao} da tabela Delta")
+        criar_snapshot(versao, caminho_base, caminho)
+
+    tabela = pa.ipc.open_file(pa.memory_map(destino, "r")).read_all()
+    # split_blocks evita juntar as colunas em blocos, o que permite reaproveitar os buffers mapeados
+    return tabela.to_pandas(split_blocks=True, types_mapper=tipo_pandas_arrow)
+
+# COMMAND ----------
+
+# Motor centralizado: "memoria" carrega a tabela inteira no driver; "lotes" lê a tabela em lotes Arrow;
+# "processos" divide a tabela em shards e usa todos os núcleos do driver
+MOTOR_CENTRALIZADO = "memoria"
+
+# Leitura dos dados em um DataFrame Pandas compacto, a partir do snapshot local da versão atual
+if MOTOR_CENTRALIZADO == "memoria":
+    df_pd = carregar_snapshot()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Ferramentas de benchmark
+# MAGIC
+# MAGIC `spark.sql(...)` apenas monta o plano lógico (execução preguiçosa), então medir só a chamada não mede o trabalho da consulta. O executor abaixo força a execução completa de cada consulta (sink `noop`, `count` ou `collect`), faz rodadas de aquecimento e rodadas medidas com `time.perf_counter`, e só registra os tempos depois de conferir que os resultados do Spark e do Pandas são iguais. Os resultados são gravados em JSON e CSV para acompanhar regressões entre execuções.
+
+# COMMAND ----------
+
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+# Configuração do benchmark
+BENCHMARK_AQUECIMENTO = 1        # Rodadas descartadas antes da medição
+BENCHMARK_REPETICOES = 5         # Rodadas medidas
+BENCHMARK_MODO_SPARK = "noop"    # "noop", "count" ou "collect"
+BENCHMARK_TOLERANCIA = 1e-6      # Tolerância relativa na comparação de resultados numéricos
+
+# Caminho para gravar os resultados do benchmark (visto pelo driver via /dbfs)
+caminho_resultados = "/dbfs/FileStore/big-data_project/benchmarks"
+
+# Resultados de todas as consultas executadas, indexados pelo nome da consulta
+resultados_benchmark = {}
+
+
+# Força a execução completa de um DataFrame Spark
+def forcar_execucao_spark(df_spark, modo=BENCHMARK_MODO_SPARK):
+    if modo == "noop":
+        # O sink "noop" executa todo o plano sem gravar nada
+        df_spark.write.format("noop").mode("overwrite").save()
+    elif modo == "count":
+        df_spark.count()
+    elif modo == "collect":
+        df_spark.collect()
+    else:
+        raise ValueError(f"Modo de execução Spark desconhecido: {modo}")
+
+
+# Converte o resultado de uma consulta para um DataFrame Pandas comparável
+def normalizar_resultado(resultado):
+    if hasattr(resultado, "toPandas"):
+        resultado = resultado.toPandas()
+    if isinstance(resultado, pd.Series):
+        resultado = resultado.reset_index()
+    elif not isinstance(resultado, pd.DataFrame):
+        resultado = pd.DataFrame({"valor": [resultado]})
+
+    # Categorias, texto Arrow e datas do Pandas compacto são comparados pelos valores, como no Spark
+    for coluna in resultado.columns:
+        if isinstance(resultado[coluna].dtype, (pd.CategoricalDtype, pd.ArrowDtype)):
+            resultado[coluna] = resultado[coluna].astype(object)
+        elif pd.api.types.is_datetime64_any_dtype(resultado[coluna]):
+            resultado[coluna] = resultado[coluna].dt.date
+
+    # Os nomes das colunas variam entre os ambientes, então a comparação é posicional
+    resultado = resultado.reset_index(drop=True)
+    resultado.columns = range(resultado.shape[1])
+    return resultado.sort_values(by=list(resultado.columns)).reset_index(drop=True)
+
+
+# Verifica se os resultados do Spark e do Pandas são equivalentes
+def comparar_resultados(resultado_spark, resultado_pandas, tolerancia=BENCHMARK_TOLERANCIA):
+    esperado = normalizar_resultado(resultado_spark)
+    obtido = normalizar_resultado(resultado_pandas)
+    try:
+        pd.testing.assert_frame_equal(esperado, obtido, check_dtype=False, check_exact=False, rtol=tolerancia)
+    except AssertionError as erro:
+        return False, str(erro)
+    return True, ""
+
+
+# Executa a função de aquecimento e as repetições medidas, retornando os tempos em segundos
+def medir_tempos(funcao, aquecimento=BENCHMARK_AQUECIMENTO, repeticoes=BENCHMARK_REPETICOES):
+    for _ in range(aquecimento):
+        funcao()
+
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return tempos
+
+
+# Resume uma lista de tempos em mínimo, mediana e percentil 95
+def resumir_tempos(tempos):
+    return {
+        "min": float(np.min(tempos)),
+        "mediana": float(np.median(tempos)),
+        "p95": float(np.percentile(tempos, 95)),
+    }
+
+
+# Executa uma consulta nos dois ambientes, valida os resultados e mede os tempos
+def executar_benchmark(nome, consulta_spark, consulta_pandas, aquecimento=BENCHMARK_AQUECIMENTO,
+                       repeticoes=BENCHMARK_REPETICOES, modo_spark=BENCHMARK_MODO_SPARK):
+    # Validação: os tempos só são registrados se os dois ambientes concordarem
+    resultados_iguais, detalhe = comparar_resultados(consulta_spark(), consulta_pandas())
+    if not resultados_iguais:
+        raise AssertionError(f"{nome}: resultados do Spark e do Pandas divergem\n{detalhe}")
+
+    tempos_spark = medir_tempos(lambda: forcar_execucao_spark(consulta_spark(), modo_spark), aquecimento, repeticoes)
+    tempos_pandas = medir_tempos(consulta_pandas, aquecimento, repeticoes)
+
+    # Execução instrumentada, separada das medições de tempo
+    metricas_spark = medir_execucao_spark(consulta_spark)
+    metricas_pandas = medir_execucao_pandas(consulta_pandas)
+
+    resultado = {
+        "consulta": nome,
+        "aquecimento": aquecimento,
+        "repeticoes": repeticoes,
+        "modo_spark": modo_spark,
+        "spark": resumir_tempos(tempos_spark),
+        "pandas": resumir_tempos(tempos_pandas),
+        "tempos_spark": tempos_spark,
+        "tempos_pandas": tempos_pandas,
+        "metricas_spark": metricas_spark,
+        "metricas_pandas": metricas_pandas,
+    }
+    resultados_benchmark[nome] = resultado
+
+    print(f"{nome} (Spark): min {resultado['spark']['min']:.4f} s | mediana {resultado['spark']['mediana']:.4f} s | p95 {resultado['spark']['p95']:.4f} s")
+    print(f"{nome} (Pandas): min {resultado['pandas']['min']:.4f} s | mediana {resultado['pandas']['mediana']:.4f} s | p95 {resultado['pandas']['p95']:.4f} s")
+    return resultado
+
+
+# Grava os resultados do benchmark em JSON e CSV, com carimbo de data/hora da execução
+def salvar_resultados_benchmark(resultados, caminho=caminho_resultados):
+    os.makedirs(caminho, exist_ok=True)
+    carimbo = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    caminho_json = os.path.join(caminho, f"benchmark_{carimbo}.json")
+    with open(caminho_json, "w") as arquivo:
+        json.dump(list(resultados.values()), arquivo, indent=2)
+
+    linhas = []
+    for resultado in resultados.values():
+        for ambiente in ("spark", "pandas"):
+            linhas.append({
+                "execucao": carimbo,
+                "consulta": resultado["consulta"],
+                "ambiente": ambiente,
+                "aquecimento": resultado["aquecimento"],
+                "repeticoes": resultado["repeticoes"],
+                "min_s": resultado[ambiente]["min"],
+                "mediana_s": resultado[ambiente]["mediana"],
+                "p95_s": resultado[ambiente]["p95"],
+            })
+    caminho_csv = os.path.join(caminho, f"benchmark_{carimbo}.csv")
+    pd.DataFrame(linhas).to_csv(caminho_csv, index=False)
+
+    return caminho_json, caminho_csv
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Métricas de execução por consulta
+# MAGIC
+# MAGIC O tempo total não explica por que uma consulta é lenta. Depois das medições de tempo, `executar_benchmark` roda cada consulta mais uma vez instrumentada. No Spark, os jobs da consulta são agrupados em um job group e as métricas dos seus stages são lidas da API REST da interface do Spark: bytes e linhas de entrada, shuffle lido e escrito, spill em memória e em disco, e assimetria entre tarefas (maior tempo de execução de uma tarefa dividido pela mediana, no pior stage). A consulta é passada como uma função e montada dentro do job group, porque a montagem pode disparar jobs: a Consulta 8 coleta as médias por UF no driver antes de compilar o filtro. Essas execuções auxiliares são registradas (`coletar_auxiliar`), e os seus scans e planos entram no relatório junto com os da consulta. Antes da leitura, a execução espera pelo `StatusTracker` até que todos os jobs do grupo terminem. Assim o status de cada stage já está final na API, e não é preciso sondar. Um stage que ainda assim não aparece como concluído não entra nas somas e é listado em `stages_incompletos`, para que o relatório mostre quais métricas ficaram parciais. Cada nó de leitura do plano físico executado informa os arquivos lidos. Esse número é comparado com o total de arquivos da tabela Delta que aquele nó lê, e a soma das diferenças dá os arquivos pulados. O plano físico executado também é guardado. No Pandas, são medidos o tempo de CPU e o pico de RSS do processo durante a consulta. Tudo entra no relatório junto com a tabela de tempos.
+
+# COMMAND ----------
+
+import threading
+import urllib.request
+import uuid
+
+import psutil
+from py4j.protocol import Py4JError
+from pyspark.sql.utils import AnalysisException
+
+# Prazo para os jobs da execução instrumentada aparecerem como terminados no StatusTracker
+METRICAS_PRAZO_S = 30
+
+
+# Percorre os nós do plano físico executado (JVM), atravessando os nós do AQE e as subconsultas
+def nos_plano_fisico(no):
+    nome = no.nodeName()
+    if nome == "AdaptiveSparkPlan":
+        yield from nos_plano_fisico(no.executedPlan())
+        return
+    if nome.endswith("QueryStage"):
+        yield from nos_plano_fisico(no.plan())
+        return
+    yield no
+    # Os planos das subconsultas (por exemplo, as subconsultas escalares) não são filhos do nó
+    for filhos in (no.children(), no.subqueries()):
+        for i in range(filhos.size()):
+            yield from nos_plano_fisico(filhos.apply(i))
+
+
+# Lê um valor das métricas SQL de um nó do plano (0 quando o nó não tem a métrica)
+def valor_metrica(no, nome):
+    metricas = no.metrics()
+    return metricas.apply(nome).value() if metricas.contains(nome) else 0
+
+
+# Caminho raiz da relação lida por um nó de scan de arquivos (None quando o nó não expõe a relação)
+def caminho_scan(no):
+    try:
+        return no.relation().location().rootPaths().head().toString()
+    except Py4JError:
+        return None
+
+
+# Execuções auxiliares disparadas enquanto uma consulta é montada (por exemplo, as referências por grupo
+# coletadas no driver), registradas só durante montar_consulta
+captura_auxiliares = {"execucoes": None}
+
+
+# Executa uma consulta auxiliar e traz as linhas para o driver, registrando a execução se houver captura ativa
+def coletar_auxiliar(df_spark):
+    linhas = df_spark.collect()
+    if captura_auxiliares["execucoes"] is not None:
+        captura_auxiliares["execucoes"].append(df_spark._jdf.queryExecution())
+    return linhas
+
+
+# Monta o DataFrame da consulta (função sem argumentos) e retorna também as execuções auxiliares da montagem
+def montar_consulta(consulta):
+    anteriores = captura_auxiliares["execucoes"]
+    captura_auxiliares["execucoes"] = []
+    try:
+        return consulta(), captura_auxiliares["execucoes"]
+    finally:
+        captura_auxiliares["execucoes"] = anteriores
+
+
+# Arquivos selecionados por um nó de scan de arquivos depois da poda de partições e do data skipping
+# (None quando o nó não expõe a lista)
+def arquivos_scan(no):
+    try:
+        arquivos = []
+        for particao in no.selectedPartitions():
+            lista = particao.files()
+            arquivos.extend(lista.apply(i).getPath().toString() for i in range(lista.size()))
+        return arquivos
+    except Py4JError:
+        return None
+
+
+# Métricas de leitura somadas de todos os nós de scan de arquivos das execuções (e as de cada nó em "scans",
+# com a lista de arquivos lidos quando listar_arquivos é verdadeiro)
+def metricas_leitura(execucoes, listar_arquivos=False):
+    metricas = {"arquivos_lidos": 0, "bytes_lidos": 0, "linhas_lidas": 0, "nos_leitura": 0, "scans": [],
+                "plano_executado": "\n\n".join(execucao.executedPlan().toString() for execucao in execucoes)}
+    for execucao in execucoes:
+        for no in nos_plano_fisico(execucao.executedPlan()):
+            if no.metrics().contains("numFiles"):
+                scan = {"caminho": caminho_scan(no), "arquivos_lidos": valor_metrica(no, "numFiles"),
+                        "bytes_lidos": valor_metrica(no, "filesSize")}
+                if listar_arquivos:
+                    scan["arquivos"] = arquivos_scan(no)
+                metricas["scans"].append(scan)
+                metricas["nos_leitura"] += 1
+                metricas["arquivos_lidos"] += scan["arquivos_lidos"]
+                metricas["bytes_lidos"] += scan["bytes_lidos"]
+                metricas["linhas_lidas"] += valor_metrica(no, "numOutputRows")
+    return metricas
+
+
+# Monta e executa a consulta (função sem argumentos que devolve o DataFrame), sem trazer linhas para o Python,
+# e retorna as métricas de leitura da execução e das execuções auxiliares da montagem
+def executar_com_metricas_leitura(consulta, listar_arquivos=False):
+    df_spark, auxiliares = montar_consulta(consulta)
+    execucao = df_spark._jdf.queryExecution()
+    execucao.toRdd().count()
+    return metricas_leitura(auxiliares + [execucao], listar_arquivos)
+
+
+# Arquivos pulados: para cada nó de scan de uma tabela Delta, total de arquivos da tabela menos os lidos.
+# Nós de outras fontes (ou sem a relação exposta) ficam de fora e são contados em "nos_sem_total".
+def arquivos_pulados_scans(scans):
+    totais = {}
+    pulados, sem_total = 0, 0
+    for scan in scans:
+        caminho = scan["caminho"]
+        if caminho is not None and caminho not in totais:
+            try:
+                detalhe = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first()
+                totais[caminho] = detalhe["numFiles"] if detalhe["format"] == "delta" else None
+            except AnalysisException:
+                totais[caminho] = None
+        total = totais.get(caminho)
+        if total is None:
+            sem_total += 1
+        else:
+            pulados += max(0, total - scan["arquivos_lidos"])
+    return pulados, sem_total
+
+
+# Consulta a API REST da interface do Spark da aplicação atual
+def api_spark(caminho):
+    sc = spark.sparkContext
+    with urllib.request.urlopen(f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/{caminho}") as resposta:
+        return json.loads(resposta.read())
+
+
+# Espera, pelo StatusTracker, que todos os jobs do grupo terminem. O fim do job é processado pelo listener
+# depois do fim dos seus stages, então a partir daí o status dos stages na API já é o final.
+# Retorna os jobs que não terminaram dentro do prazo.
+def esperar_jobs_grupo(grupo, prazo_s=METRICAS_PRAZO_S):
+    rastreador = spark.sparkContext.statusTracker()
+    limite = time.monotonic() + prazo_s
+    while True:
+        pendentes = [job for job in rastreador.getJobIdsForGroup(grupo)
+                     if (rastreador.getJobInfo(job) is not None
+                         and rastreador.getJobInfo(job).status not in ("SUCCEEDED", "FAILED"))]
+        if not pendentes or time.monotonic() >= limite:
+            return pendentes
+        time.sleep(0.05)
+
+
+# Executa a consulta Spark instrumentada e retorna as métricas de leitura, shuffle, spill e assimetria. A consulta
+# é montada dentro do job group, então os jobs disparados na montagem também entram nas métricas.
+def medir_execucao_spark(consulta):
+    sc = spark.sparkContext
+    grupo = f"bateria_{uuid.uuid4().hex}"
+    sc.setJobGroup(grupo, "Métricas da bateria de testes")
+    try:
+        inicio = time.perf_counter()
+        metricas = executar_com_metricas_leitura(consulta)
+        metricas["tempo_s"] = time.perf_counter() - inicio
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", None)
+
+    metricas["arquivos_pulados"], metricas["nos_sem_total"] = arquivos_pulados_scans(metricas["scans"])
+
+    metricas.update({"bytes_entrada": 0, "linhas_entrada": 0, "shuffle_lido_bytes": 0, "shuffle_escrito_bytes": 0,
+                     "spill_memoria_bytes": 0, "spill_disco_bytes": 0, "assimetria_tarefas": 1.0,
+                     "jobs_pendentes": esperar_jobs_grupo(grupo), "stages_incompletos": []})
+    jobs = [sc.statusTracker().getJobInfo(job) for job in sc.statusTracker().getJobIdsForGroup(grupo)]
+    stages = sorted({stage for job in jobs if job is not None for stage in job.stageIds})
+    for stage_id in stages:
+        for execucao in api_spark(f"stages/{stage_id}"):
+            # Stages pulados não têm métricas; os demais que não concluíram ficam marcados no relatório
+            if execucao["status"] == "SKIPPED":
+                continue
+            if execucao["status"] != "COMPLETE":
+                metricas["stages_incompletos"].append(f"{stage_id}.{execucao['attemptId']} ({execucao['status']})")
+                continue
+            metricas["bytes_entrada"] += execucao["inputBytes"]
+            metricas["linhas_entrada"] += execucao["inputRecords"]
+            metricas["shuffle_lido_bytes"] += execucao["shuffleReadBytes"]
+            metricas["shuffle_escrito_bytes"] += execucao["shuffleWriteBytes"]
+            metricas["spill_memoria_bytes"] += execucao["memoryBytesSpilled"]
+            metricas["spill_disco_bytes"] += execucao["diskBytesSpilled"]
+            if execucao["numCompleteTasks"] > 1:
+                resumo = api_spark(f"stages/{stage_id}/{execucao['attemptId']}/taskSummary?quantiles=0.5,1.0")
+                mediana, maximo = resumo["executorRunTime"]
+                if mediana > 0:
+                    metricas["assimetria_tarefas"] = max(metricas["assimetria_tarefas"], maximo / mediana)
+    return metricas
+
+
+# Executa a consulta Pandas medindo o tempo de CPU e o pico de RSS do processo (amostrado em segundo plano)
+def medir_execucao_pandas(consulta_pandas, intervalo=0.005):
+    processo = psutil.Process()
+    rss_inicial = processo.memory_info().rss
+    pico = [rss_inicial]
+    parar = threading.Event()
+
+    def amostrar_rss():
+        while not parar.is_set():
+            pico[0] = max(pico[0], processo.memory_info().rss)
+            parar.wait(intervalo)
+
+    amostrador = threading.Thread(target=amostrar_rss, daemon=True)
+    amostrador.start()
+    inicio_cpu, inicio = time.process_time(), time.perf_counter()
+    try:
+        consulta_pandas()
+    finally:
+        parar.set()
+        amostrador.join()
+    pico_rss = max(pico[0], processo.memory_info().rss)
+
+    return {
+        "tempo_s": time.perf_counter() - inicio,
+        "cpu_s": time.process_time() - inicio_cpu,
+        "rss_pico_mb": pico_rss / 1024 ** 2,
+        "rss_adicional_mb": (pico_rss - rss_inicial) / 1024 ** 2,
+    }
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Motor centralizado em lotes (fora da memória)
+# MAGIC
+# MAGIC `df_delta.toPandas()` carrega a tabela inteira no driver, o que não cabe na memória com a base nacional completa. Com `MOTOR_CENTRALIZADO = "lotes"`, o ambiente centralizado lê os arquivos Parquet da versão atual da tabela Delta como lotes Arrow (`pyarrow.dataset`), lendo só as colunas usadas e aplicando os filtros na leitura. O motor executa os mesmos planos do catálogo de consultas: cada plano calcula agregações parciais (ou as k maiores linhas de cada lote) e as combina no fim (os filtros que dependem da tabela inteira, como as médias por grupo, usam uma primeira passada), então o pico de memória é limitado pelo tamanho do lote (`MOTOR_LOTE_LINHAS`) e não pelo tamanho da tabela. Nas referências por percentil, a primeira passada guarda um sketch KLL por grupo (`SKETCH_KLL_K`, erro de posto de cerca de 1%) em vez dos valores da coluna, para manter esse limite: nesse motor, o percentil é aproximado, enquanto os motores em memória e em processos o calculam exatamente. A leitura direta dos arquivos exige uma tabela sem deletion vectors: com eles, as linhas reescritas pelo MERGE seriam lidas duas vezes. Por isso `gravar_layout` cria a tabela com os deletion vectors desativados, e `atualizar_dataset_delta` recusa uma tabela que os tenha ativados. A lista de arquivos (um job Spark) é resolvida uma vez por versão da tabela, fora das medições: antes de reaproveitá-la, a versão guardada é comparada com a do último commit (listagem do `_delta_log`, sem job Spark), então uma ingestão ou um VACUUM na mesma sessão faz a lista ser resolvida de novo.
+
+# COMMAND ----------
+
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# Número máximo de linhas por lote Arrow
+MOTOR_LOTE_LINHAS = 262144
+
+
+# Converte um caminho do DBFS para o caminho local visto pelo driver
+def caminho_local_dbfs(caminho):
+    if caminho.startswith("dbfs:"):
+        caminho = caminho[len("dbfs:"):]
+    return caminho if caminho.startswith("/dbfs/") else "/dbfs" + caminho
+
+
+# Datasets Arrow já resolvidos, por caminho da tabela Delta: versão e dataset
+datasets_delta = {}
+
+
+# Resolve a lista de arquivos Parquet da versão atual da tabela Delta (jobs Spark, fora das medições).
+# Com deletion vectors, os arquivos lidos diretamente ainda conteriam as linhas removidas ou
+# reescritas pelo MERGE, então a leitura direta é recusada.
+def atualizar_dataset_delta(caminho=caminho_delta):
+    propriedades = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first()["properties"] or {}
+    if propriedades.get("delta.enableDeletionVectors", "false").lower() == "true":
+        raise ValueError(f"A tabela {caminho} usa deletion vectors; a leitura direta dos arquivos Parquet leria linhas removidas")
+
+    # A versão é lida antes da lista: um commit no meio deixa a versão guardada atrasada, e o dataset é refeito
+    versao = versao_ultimo_commit(caminho)
+    arquivos = [caminho_local_dbfs(arquivo) for arquivo in spark.read.format("delta").load(caminho).inputFiles()]
+    datasets_delta[caminho] = {
+        "versao": versao,
+        "dataset": ds.dataset(arquivos, format="parquet", partitioning="hive", partition_base_dir=caminho_local_dbfs(caminho)),
+    }
+    return datasets_delta[caminho]["dataset"]
+
+
+# Dataset Arrow com os arquivos Parquet da tabela Delta (partições no estilo hive), resolvido uma vez por versão.
+# A versão do último commit vem da listagem do _delta_log, sem job Spark.
+def dataset_delta(caminho=caminho_delta):
+    if caminho not in datasets_delta or datasets_delta[caminho]["versao"] != versao_ultimo_commit(caminho):
+        return atualizar_dataset_delta(caminho)
+    return datasets_delta[caminho]["dataset"]
+
+
+# Lê a tabela em lotes Pandas, só com as colunas pedidas e com o filtro aplicado na leitura
+def ler_lotes(colunas=None, filtro=None, caminho=caminho_delta, tamanho_lote=MOTOR_LOTE_LINHAS):
+    lotes = dataset_delta(caminho).to_batches(
+        columns=colunas, filter=filtro, batch_size=tamanho_lote, batch_readahead=1, fragment_readahead=1
     )
-    SELECT t.uf, COUNT(*) AS propriedades_acima_media
-    FROM tabela_delta t
-    JOIN media_por_estado m ON t.uf = m.uf
-    WHERE t.area_do_imovel > m.media_area
-    GROUP BY t.uf
-""")
-#consulta8_spark.display()
-end_time_spark_8 = time.time()
+    for lote in lotes:
+        if lote.num_rows:
+            yield lote.to_pandas(types_mapper=tipo_pandas_arrow)
+
+
+# Colunas da tabela lidas pelo plano (as colunas derivadas são calculadas a partir delas)
+def colunas_lidas_plano(plano, colunas_tabela):
+    derivadas = plano.get("derivadas", {})
+    usadas = {coluna for _, *colunas in derivadas.values() for coluna in colunas}
+    for coluna, operador, _ in plano.get("filtros", []):
+        usadas.update(["latitude", "longitude", "celula_grade"] if operador == "dentro_poligono" else [coluna])
+    usadas.update(plano.get("agrupar", []))
+    if plano.get("top_k"):
+        usadas.update([plano["top_k"][0], plano["top_k"][2]])
+    if plano.get("agregacoes"):
+        usadas.update(coluna for _, coluna in plano["agregacoes"].values() if coluna)
+    else:
+        usadas.update(plano.get("colunas", colunas_tabela))
+    return [coluna for coluna in colunas_tabela if coluna in usadas and coluna not in derivadas]
+
+
+# Filtros do plano aplicados na leitura Arrow: listas de valores, as células da grade e a caixa envolvente do polígono
+def filtro_arrow_plano(plano):
+    filtro = None
+    for coluna, operador, argumento in plano.get("filtros", []):
+        if operador == "em":
+            condicao = pc.field(coluna).isin(argumento)
+        elif operador == "dentro_poligono":
+            lat_min, lat_max, lon_min, lon_max = limites_poligono(argumento)
+            condicao = (
+                (pc.field('latitude') >= lat_min) & (pc.field('latitude') <= lat_max)
+                & (pc.field('longitude') >= lon_min) & (pc.field('longitude') <= lon_max)
+            )
+            celulas = pc.scalar(False)
+            for inicio, fim in zip(*intervalos_poligono(argumento)):
+                celulas = celulas | ((pc.field('celula_grade') >= int(inicio)) & (pc.field('celula_grade') <= int(fim)))
+            condicao = celulas & condicao
+        else:
+            continue
+        filtro = condicao if filtro is None else filtro & condicao
+    return filtro
+
+
+# Executa um plano do catálogo lote a lote. As referências dos filtros (médias por grupo) vêm de
+# uma primeira passada sem filtros; a segunda aplica os filtros na leitura e calcula as parciais.
+def executar_plano_lotes(plano, colunas_tabela=None):
+    colunas_tabela = list(colunas_tabela if colunas_tabela is not None else df_delta.columns)
+    colunas = colunas_lidas_plano(plano, colunas_tabela)
+
+    # Os percentis vêm de sketches KLL, para que a primeira passada também tenha memória limitada
+    referencias = {}
+    if referencias_plano(plano):
+        referencias = combinar_referencias(
+            plano, [parciais_referencias(plano, lote, aproximado=True) for lote in ler_lotes(colunas)], aproximado=True
+        )
+    parciais = [
+        parcial_plano(plano, lote, referencias, colunas_tabela)
+        for lote in ler_lotes(colunas, filtro_arrow_plano(plano))
+    ]
+    return combinar_plano(plano, parciais, colunas_tabela)
+
+
+# Executa o plano no motor centralizado escolhido em MOTOR_CENTRALIZADO
+def motor_centralizado(plano):
+    if MOTOR_CENTRALIZADO == "processos":
+        return executar_plano_processos(plano)
+    if MOTOR_CENTRALIZADO == "lotes":
+        return executar_plano_lotes(plano)
+    return motor_pandas(plano)
+
+
+# A lista de arquivos da versão atual é resolvida aqui, antes das medições
+if MOTOR_CENTRALIZADO in ("lotes", "processos"):
+    atualizar_dataset_delta()
+
+# COMMAND ----------
 
-# Consulta 8 - Centralizado (Pandas)
-start_time_pandas_8 = time.time()
+# MAGIC %md
+# MAGIC ##### Motor centralizado multiprocessado (shards em memória compartilhada)
+# MAGIC
+# MAGIC O Pandas usa um único núcleo, enquanto o Spark usa o cluster inteiro. Assim, a comparação mede mais o paralelismo do que a arquitetura. Com `MOTOR_CENTRALIZADO = "processos"`, o ambiente centralizado usa todos os núcleos da máquina.
+# MAGIC
+# MAGIC A tabela do snapshot local é dividida em shards, por `uf` ou por faixas de linhas. Cada shard é gravado como um arquivo Arrow IPC em `/dev/shm`, que é memória compartilhada. As agregações parciais de cada consulta rodam em um `ProcessPoolExecutor`, e cada processo abre os shards com `pyarrow.memory_map`. Só o caminho do shard e os parâmetros da consulta passam entre os processos, nunca os dados. O driver então combina os resultados parciais.
+# MAGIC
+# MAGIC A divisão padrão (`PROCESSOS_ESTRATEGIA = "linhas"`) é por faixas de linhas do mesmo tamanho, uma por núcleo, então todas as consultas usam todos os núcleos, inclusive as que filtram poucas UFs (Consultas 1 e 3). Nessa divisão, a Consulta 8 precisa de duas passadas: as médias por UF vêm primeiro. Na divisão por `uf`, cada estado fica inteiro em um shard, e os shards são balanceados pelo número de linhas. Com essa divisão, as Consultas 1, 2 e 3 pulam os shards sem as UFs pedidas, e a Consulta 8 é resolvida em uma única passada. Em troca, uma consulta sobre duas ou três UFs roda em no máximo dois ou três processos. A Consulta 7 usa uma única passada: cada shard devolve as suas maiores linhas e o driver escolhe entre elas.
+# MAGIC
+# MAGIC Esse motor executa os mesmos planos do catálogo de consultas. Nas consultas que extraem linhas (2, 3 e 7), as linhas filtradas voltam serializadas dos processos, o que pesa na Consulta 2. Os shards (cuja versão vem de um job Spark) e o pool de processos são preparados uma vez por benchmark por `preparar_processos`, fora das medições, e liberados por `encerrar_processos` no fim da bateria. O pool é criado por `fork`, porque as funções do notebook não são importáveis por processos novos. Fazer fork do REPL do Databricks, que tem threads vivas do py4j, só é seguro com algumas condições, e o pool as respeita:
+# MAGIC
+# MAGIC * o fork acontece uma única vez, fora das medições, depois de definidas as funções do catálogo (por isso a preparação fica na célula da bateria, e não nesta);
+# MAGIC * os processos filhos rodam apenas Pandas e PyArrow sobre os shards, e nunca usam a sessão Spark nem o gateway py4j, cujas threads não existem no filho;
+# MAGIC * um pool quebrado (`BrokenProcessPool`) é recriado uma vez antes de o erro ser propagado.
+# MAGIC
+# MAGIC Os shards duplicam o snapshot na memória compartilhada, então `/dev/shm` precisa comportar a tabela compacta.
 
-# Calculando a média de área por estado no DataFrame Pandas
-media_por_estado_pandas = df_pd.groupby('uf')['area_do_imovel'].mean().reset_index()
-media_por_estado_pandas.columns = ['uf', 'media_area']
+# COMMAND ----------
 
-# Juntando os DataFrames com a condição e contando as propriedades
-joined_df = df_pd.merge(media_por_estado_pandas, on='uf')
-consulta8_pandas = joined_df[joined_df['area_do_imovel'] > joined_df['media_area']].groupby('uf').size().reset_index(name='propriedades_acima_media')
-#display(f"Propriedades acima da média por UF (Pandas):\n{consulta8_pandas}")
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Divisão da tabela ("linhas" ou "uf"), número de shards e de processos. Com "linhas", toda consulta usa todos
+# os shards (e todos os núcleos); com "uf", as consultas filtradas por UF só usam os shards dessas UFs.
+PROCESSOS_ESTRATEGIA = "linhas"
+PROCESSOS_SHARDS = os.cpu_count()
+PROCESSOS_TRABALHADORES = os.cpu_count()
+
+# Diretório dos shards na memória compartilhada do driver
+caminho_shards = "/dev/shm/big-data_project/shards"
+
+# Índices dos shards já construídos nesta sessão, por diretório
+indices_shards = {}
+
+
+# Divide as UFs em grupos com números de linhas parecidos (maior UF primeiro, no grupo mais leve)
+def agrupar_ufs(contagens, num_grupos):
+    grupos = [[] for _ in range(num_grupos)]
+    linhas = [0] * num_grupos
+    for uf, contagem in contagens.sort_values(ascending=False).items():
+        menor = linhas.index(min(linhas))
+        grupos[menor].append(uf)
+        linhas[menor] += contagem
+    return [grupo for grupo in grupos if grupo]
+
+
+# Grava uma tabela Arrow como arquivo IPC (gravação atômica via arquivo temporário)
+def gravar_arrow(tabela, destino):
+    temporario = destino + ".tmp"
+    with pa.OSFile(temporario, "wb") as arquivo, pa.ipc.new_file(arquivo, tabela.schema) as escritor:
+        escritor.write_table(tabela)
+    os.replace(temporario, destino)
+
+
+# Divide o snapshot da versão atual em shards na memória compartilhada, refazendo-os se a versão mudou
+def construir_shards(estrategia=PROCESSOS_ESTRATEGIA, num_shards=PROCESSOS_SHARDS, caminho=caminho_shards):
+    versao = versao_delta(caminho_delta)
+    destino = os.path.join(caminho, f"v{versao}_{estrategia}_{num_shards}")
+    caminho_indice = os.path.join(destino, "shards.json")
+    if destino in indices_shards:
+        return indices_shards[destino]
+    if os.path.exists(caminho_indice):
+        with open(caminho_indice) as arquivo:
+            indices_shards[destino] = json.load(arquivo)
+        return indices_shards[destino]
+
+    if not os.path.exists(caminho_snapshot(versao)):
+        criar_snapshot(versao)
+    tabela = pa.ipc.open_file(pa.memory_map(caminho_snapshot(versao), "r")).read_all()
+
+    if estrategia == "uf":
+        ufs = tabela["uf"].cast(pa.string())
+        grupos = agrupar_ufs(tabela.select(["uf"]).to_pandas()["uf"].astype(object).value_counts(), num_shards)
+        partes = []
+        for numero, grupo in enumerate(grupos):
+            mascara = pc.is_in(ufs, value_set=pa.array(grupo, pa.string()))
+            if numero == 0:
+                # Linhas sem UF ficam no primeiro shard
+                mascara = pc.or_(mascara, pc.is_null(ufs))
+            partes.append((tabela.filter(mascara), grupo))
+    elif estrategia == "linhas":
+        tamanho = -(-tabela.num_rows // num_shards)
+        partes = [(tabela.slice(inicio, tamanho), None) for inicio in range(0, tabela.num_rows, tamanho)]
+    else:
+        raise ValueError(f"Estratégia de divisão desconhecida: {estrategia}")
+
+    # Shards de versões ou configurações anteriores não são mais usados
+    if os.path.exists(caminho):
+        shutil.rmtree(caminho)
+    os.makedirs(destino)
+
+    shards = []
+    for numero, (parte, ufs_shard) in enumerate(partes):
+        caminho_shard = os.path.join(destino, f"shard_{numero}.arrow")
+        gravar_arrow(parte, caminho_shard)
+        shards.append({"caminho": caminho_shard, "ufs": ufs_shard, "linhas": parte.num_rows})
+    with open(caminho_indice, "w") as arquivo:
+        json.dump(shards, arquivo)
+
+    indices_shards.clear()
+    indices_shards[destino] = shards
+    return shards
+
+
+# Shards que podem conter alguma das UFs pedidas (na divisão por linhas, todos)
+def shards_com_ufs(shards, ufs=None):
+    if ufs is None:
+        return shards
+    return [shard for shard in shards if shard["ufs"] is None or set(shard["ufs"]) & set(ufs)]
+
+
+# Lê as colunas pedidas de um shard, mapeado em memória (executado dentro dos processos)
+def ler_shard(caminho, colunas=None):
+    tabela = pa.ipc.open_file(pa.memory_map(caminho, "r")).read_all()
+    if colunas is not None:
+        tabela = tabela.select(colunas)
+    return tabela.to_pandas(split_blocks=True, types_mapper=tipo_pandas_arrow)
+
+
+# Shards da versão atual e pool de processos do benchmark, preparados fora das medições
+estado_processos = {"shards": None, "executor": None}
+
+
+# Constrói (ou reaproveita) os shards da versão atual e cria o pool de processos, se ainda não existir.
+# O pool é criado por fork: as funções usadas pelos processos precisam estar definidas antes desta chamada.
+def preparar_processos(processos=PROCESSOS_TRABALHADORES):
+    estado_processos["shards"] = construir_shards()
+    if estado_processos["executor"] is None:
+        contexto = multiprocessing.get_context("fork")
+        estado_processos["executor"] = ProcessPoolExecutor(max_workers=processos, mp_context=contexto)
+    return estado_processos["shards"]
+
+
+# Encerra o pool de processos do benchmark
+def encerrar_processos():
+    if estado_processos["executor"] is not None:
+        estado_processos["executor"].shutdown()
+    estado_processos["executor"] = None
+    estado_processos["shards"] = None
+
+
+# Roda a função parcial em cada shard, no pool de processos, e retorna as parciais na ordem dos shards
+def executar_parciais(funcao, shards, *argumentos, tentativas=2):
+    if not shards:
+        return []
+    for tentativa in range(tentativas):
+        if estado_processos["executor"] is None:
+            preparar_processos()
+        try:
+            futuros = [estado_processos["executor"].submit(funcao, shard["caminho"], *argumentos) for shard in shards]
+            return [futuro.result() for futuro in futuros]
+        except BrokenProcessPool:
+            # Um processo morreu (por exemplo, pelo OOM killer): o pool é recriado uma vez
+            estado_processos["executor"].shutdown(wait=False)
+            estado_processos["executor"] = None
+            if tentativa == tentativas - 1:
+                raise
+
+
+# Parciais das referências do plano em um shard (executado dentro dos processos)
+def referencias_shard(caminho, plano, colunas):
+    return parciais_referencias(plano, ler_shard(caminho, colunas))
+
+
+# Parcial do plano em um shard. Sem referências, elas são calculadas no próprio shard, o que só é
+# válido quando cada grupo das referências está inteiro no shard.
+def parcial_shard(caminho, plano, referencias, colunas, colunas_tabela):
+    dados = ler_shard(caminho, colunas)
+    if referencias is None:
+        referencias = combinar_referencias(plano, [parciais_referencias(plano, dados)])
+    return parcial_plano(plano, dados, referencias, colunas_tabela)
+
+
+# Executa um plano do catálogo nos shards, em processos separados, e combina as parciais no driver
+def executar_plano_processos(plano, colunas_tabela=None):
+    colunas_tabela = list(colunas_tabela if colunas_tabela is not None else df_delta.columns)
+    colunas = colunas_lidas_plano(plano, colunas_tabela)
+    shards = estado_processos["shards"] or preparar_processos()
+
+    # Referências por UF (médias ou percentis) com shards de UFs inteiras: calculadas em cada shard, em uma única passada
+    necessarias = referencias_plano(plano)
+    locais = bool(necessarias) and all(grupo == "uf" for _, _, grupo in necessarias) \
+        and all(shard["ufs"] is not None for shard in shards)
+    referencias = None if locais else {}
+    if necessarias and not locais:
+        referencias = combinar_referencias(plano, executar_parciais(referencias_shard, shards, plano, colunas))
+
+    # Só os shards que podem conter as UFs do filtro por lista
+    ufs = next((argumento for coluna, operador, argumento in plano.get("filtros", [])
+                if coluna == "uf" and operador == "em"), None)
+    parciais = executar_parciais(parcial_shard, shards_com_ufs(shards, ufs), plano, referencias, colunas, colunas_tabela)
+    return combinar_plano(plano, parciais, colunas_tabela)
 
-end_time_pandas_8 = time.time()
+# COMMAND ----------
 
-# Cálculo dos tempos de execução
-tempo_execucao_spark_8 = end_time_spark_8 - start_time_spark_8
-tempo_execucao_pandas_8 = end_time_pandas_8 - start_time_pandas_8
+# MAGIC %md
+# MAGIC ##### Motor vetorizado de ponto-em-polígono
+# MAGIC
+# MAGIC A versão original da Consulta 3 usava uma UDF Python comum (um `Point` do shapely por linha) no Spark e `DataFrame.apply(..., axis=1)` no Pandas, o que deixava o custo dominado pelo interpretador. Aqui o teste de contenção recebe vetores inteiros de latitude/longitude e usa `shapely.contains_xy` sobre um polígono preparado (`shapely.prepare`), construído uma única vez por processo. No Spark o mesmo motor roda dentro de uma `pandas_udf`, que recebe lotes Arrow (tamanho controlado por `spark.sql.execution.arrow.maxRecordsPerBatch`).
+
+# COMMAND ----------
+
+import shapely
+from pyspark.sql.functions import pandas_udf
+
+
+# Dicionário de cache por processo, guardado em um módulo próprio (cache_car) registrado em sys.modules.
+# O módulo sobrevive entre tarefas quando o worker Python do executor é reutilizado
+# (spark.python.worker.reuse, padrão true).
+def cache_processo(nome):
+    import sys
+    import types
+
+    modulo = sys.modules.get("cache_car")
+    if modulo is None:
+        modulo = sys.modules.setdefault("cache_car", types.ModuleType("cache_car"))
+    return modulo.__dict__.setdefault(nome, {})
+
+
+# Retorna o polígono preparado para o WKT informado, construindo-o apenas uma vez por processo
+def obter_poligono_preparado(poligono_wkt):
+    import shapely
+
+    cache = cache_processo("poligonos_preparados")
+    poligono = cache.get(poligono_wkt)
+    if poligono is None:
+        poligono = shapely.from_wkt(poligono_wkt)
+        shapely.prepare(poligono)
+        cache[poligono_wkt] = poligono
+    return poligono
+
+
+# Verifica, de forma vetorizada, quais pontos (latitude, longitude) estão dentro do polígono
+def pontos_dentro_poligono(latitudes, longitudes, poligono_wkt):
+    import numpy as np
+    import shapely
+
+    poligono = obter_poligono_preparado(poligono_wkt)
+    return shapely.contains_xy(
+        poligono,
+        np.asarray(longitudes, dtype="float64"),
+        np.asarray(latitudes, dtype="float64"),
+    )
 
-# Exibindo tempos de execução
-print(f"Tempo de execução Consulta 8 (Spark): {tempo_execucao_spark_8} segundos")
-print(f"Tempo de execução Consulta 8 (Pandas): {tempo_execucao_pandas_8} segundos")
 
+# Cria uma pandas_udf (Arrow) que aplica o teste de contenção a lotes inteiros de linhas
+def criar_udf_dentro_poligono(poligono_wkt):
+    @pandas_udf("boolean")
+    def dentro_poligono(latitude: pd.Series, longitude: pd.Series) -> pd.Series:
+        return pd.Series(pontos_dentro_poligono(latitude.to_numpy(), longitude.to_numpy(), poligono_wkt))
+
+    return dentro_poligono
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Filtro de caixa envolvente (bounding box) antes do teste exato
+# MAGIC
+# MAGIC O filtro por `uf` sozinho manda todas as propriedades de GO, MS e MT para o teste geométrico. A caixa envolvente do polígono é derivada automaticamente e injetada como `latitude BETWEEN ... AND longitude BETWEEN ...`, um predicado simples que o Spark empurra para a leitura (data skipping do Delta pelas estatísticas min/max de cada arquivo e filtro de row groups do Parquet). O teste exato só roda nas linhas que sobrevivem à caixa. Depois da bateria, `relatorio_poda_scan` executa a Consulta 3 e compara os arquivos e bytes lidos pelo scan executado (métricas `numFiles` e `filesSize` do plano físico) com o total da tabela; os arquivos pulados vêm da mesma conta das métricas por consulta (`arquivos_pulados_scans`). Os row groups são contados nos rodapés Parquet dos arquivos que o scan leu: um row group é lido quando as suas estatísticas min/max passam pelos filtros do plano empurrados para a leitura.
+
+# COMMAND ----------
+
+import json
+
+
+# Retorna os limites do polígono como (latitude mínima, latitude máxima, longitude mínima, longitude máxima)
+def limites_poligono(poligono_wkt):
+    lon_min, lat_min, lon_max, lat_max = shapely.from_wkt(poligono_wkt).bounds
+    return lat_min, lat_max, lon_min, lon_max
+
+
+# Intervalos de celula_grade que cobrem o polígono, como arrays (inícios, fins), calculados uma vez por processo
+def intervalos_poligono(poligono_wkt):
+    cache = cache_processo("intervalos_poligonos")
+    intervalos = cache.get(poligono_wkt)
+    if intervalos is None:
+        pares = intervalos_cobertura(shapely.from_wkt(poligono_wkt))
+        intervalos = (np.array([inicio for inicio, _ in pares], dtype="int64"), np.array([fim for _, fim in pares], dtype="int64"))
+        cache[poligono_wkt] = intervalos
+    return intervalos
+
+
+# Verifica, de forma vetorizada, quais células estão em algum intervalo da cobertura do polígono
+def celulas_no_poligono(celulas, poligono_wkt):
+    inicios, fins = intervalos_poligono(poligono_wkt)
+    celulas = np.asarray(celulas, dtype="int64")
+    if not len(inicios):
+        return np.zeros(len(celulas), dtype=bool)
+    posicoes = np.searchsorted(inicios, celulas, side="right") - 1
+    return (posicoes >= 0) & (celulas <= fins[np.maximum(posicoes, 0)])
+
+
+# Monta o predicado SQL da caixa envolvente do polígono
+def filtro_caixa_envolvente(poligono_wkt):
+    lat_min, lat_max, lon_min, lon_max = limites_poligono(poligono_wkt)
+    return (
+        f"latitude BETWEEN {lat_min!r} AND {lat_max!r} "
+        f"AND longitude BETWEEN {lon_min!r} AND {lon_max!r}"
+    )
+
+
+# Row groups dos arquivos lidos cujas estatísticas (min/max do rodapé Parquet) passam pelo filtro Arrow do plano,
+# ou seja, os que a leitura não pula
+def contar_row_groups_lidos(arquivos, filtro, caminho=caminho_delta):
+    dataset = ds.dataset([caminho_local_dbfs(arquivo) for arquivo in arquivos], format="parquet",
+                         partitioning="hive", partition_base_dir=caminho_local_dbfs(caminho))
+    return sum(
+        fragmento.metadata.num_row_groups if filtro is None else len(fragmento.split_by_row_group(filtro))
+        for fragmento in dataset.get_fragments()
+    )
+
+
+# Poda feita na execução de um plano do catálogo sobre a tabela: arquivos e bytes lidos pelos nós de scan da
+# tabela (métricas do plano executado), arquivos pulados (arquivos_pulados_scans) e row groups lidos, contados
+# nos rodapés dos arquivos que o scan leu, comparados com o total da tabela Delta
+def relatorio_poda_scan(plano, caminho=caminho_delta):
+    metricas = executar_com_metricas_leitura(lambda: motor_spark(plano), listar_arquivos=True)
+    scans = [scan for scan in metricas["scans"]
+             if scan["caminho"] is not None and caminho_local_dbfs(scan["caminho"]) == caminho_local_dbfs(caminho)]
+    arquivos_pulados, _ = arquivos_pulados_scans(scans)
+    detalhe = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first()
+    arquivos = [arquivo for scan in scans for arquivo in (scan["arquivos"] or [])]
+    return {
+        "nos_leitura": len(scans),
+        "nos_sem_lista_arquivos": sum(scan["arquivos"] is None for scan in scans),
+        "arquivos_total": detalhe["numFiles"],
+        "arquivos_lidos": sum(scan["arquivos_lidos"] for scan in scans),
+        "arquivos_pulados": arquivos_pulados,
+        "bytes_total": detalhe["sizeInBytes"],
+        "bytes_lidos": sum(scan["bytes_lidos"] for scan in scans),
+        "row_groups_total": sum(fragmento.metadata.num_row_groups for fragmento in dataset_delta(caminho).get_fragments()),
+        "row_groups_lidos": contar_row_groups_lidos(arquivos, filtro_arrow_plano(plano), caminho),
+    }
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Catálogo declarativo de consultas
+# MAGIC
+# MAGIC Cada consulta da bateria é definida uma única vez, como um plano lógico pequeno com quatro partes:
+# MAGIC
+# MAGIC * colunas derivadas;
+# MAGIC * filtros;
+# MAGIC * agrupamento com agregações;
+# MAGIC * ordenação.
+# MAGIC
+# MAGIC Os filtros cobrem os operadores usados nas consultas: pertinência a uma lista, ponto dentro de polígono e valor relativo a uma referência do grupo. O filtro relativo ao grupo recebe a direção (acima ou abaixo), a estatística (a média ou um percentil entre 0 e 1) e o grupo (por exemplo, `uf`, ou nenhum para a referência nacional). Um plano sem agregações pode pedir só as k maiores linhas por uma coluna (`top_k`), com todas as colunas da tabela. O mesmo plano é compilado para SQL (Spark, DuckDB, rollups, processos Spark da varredura e seção de Consultas) ou interpretado sobre DataFrames Pandas (em memória, em lotes ou em shards), então as versões de uma consulta não divergem entre os motores.
+# MAGIC
+# MAGIC No SQL, a consulta por polígono filtra pelas células da grade e pela caixa envolvente, que são empurradas para a leitura, e só então aplica o teste exato (`pontos_dentro_poligono`, em uma `pandas_udf` no Spark). O filtro relativo ao grupo não usa junção: no Spark, as referências (médias ou percentis exatos) vêm de uma agregação separada, coletada no driver, e são aplicadas como uma expressão `CASE` literal, sem junção e sem janela; nos outros motores SQL, de uma agregação em janela. O `top_k` vira `ORDER BY ... LIMIT k`, que o Spark executa como `TakeOrderedAndProject`, em uma única leitura. No Pandas, o `top_k` guarda as k maiores linhas de cada parte da tabela (`nlargest`) e escolhe as k maiores entre elas no fim, e as referências vêm de parciais combináveis (soma e contagem por grupo para as médias; os valores da coluna, com o grupo, para os percentis exatos, ou sketches KLL no motor em lotes), o que permite executar o mesmo plano lote a lote ou shard a shard.
+
+# COMMAND ----------
+
+import hashlib
+
+from shapely.geometry import Polygon
+
+# Definindo as coordenadas do polígono da Consulta 3
+coords = [(-53.5325072, -19.4632582), (-51.0495971, -19.1625841), (-51.3734501, -16.1924262), (-53.8181518, -16.4010783), (-53.5325072, -19.4632582)]
+
+# Criando um objeto Polygon (polígono) e sua representação WKT, enviada aos executores
+polygon = Polygon(coords)
+polygon_wkt = polygon.wkt
+
+# Catálogo: cada consulta da bateria definida uma única vez como plano lógico
+CATALOGO_CONSULTAS = {
+    "Consulta 1": {
+        "filtros": [("uf", "em", ["MS", "MT"])],
+        "agrupar": ["uf"],
+        "agregacoes": {"area_total_hectares": ("soma", "area_do_imovel")},
+        "ordenar": [("area_total_hectares", False)],
+    },
+    "Consulta 2": {
+        "filtros": [("uf", "em", ["SP", "RJ", "MG", "ES"])],
+    },
+    "Consulta 3": {
+        "filtros": [("uf", "em", ["GO", "MS", "MT"]), ("ponto", "dentro_poligono", polygon_wkt)],
+    },
+    "Consulta 4": {
+        "derivadas": {"ano": ("ano", "data_inscricao")},
+        "agrupar": ["ano"],
+        "agregacoes": {"total_propriedades": ("contagem", None)},
+        "ordenar": [("ano", True)],
+    },
+    "Consulta 5": {
+        "derivadas": {"razao_vegetacao": ("razao", "area_remanescente_vegetacao_nativa", "area_do_imovel")},
+        "agregacoes": {"percentual_medio": ("media", "razao_vegetacao")},
+    },
+    "Consulta 6": {
+        "agrupar": ["uf"],
+        "agregacoes": {"total_propriedades": ("contagem", None)},
+    },
+    # A maior propriedade, com todas as colunas; registro_car desempata propriedades com a mesma área
+    "Consulta 7": {
+        "top_k": ("area_do_imovel", 1, "registro_car"),
+    },
+    # Na bateria, a referência é a média da própria UF; com grupo None, é a média nacional
+    "Consulta 8": {
+        "filtros": [("area_do_imovel", "relativo_grupo", ("acima", "media", "uf"))],
+        "agrupar": ["uf"],
+        "agregacoes": {"propriedades_acima_media": ("contagem", None)},
+    },
+}
+
+
+# Literal SQL de um valor Python (números reais como DOUBLE, que o Spark e o DuckDB leem igual)
+def literal_sql(valor):
+    if valor is None or valor != valor:
+        return "NULL"
+    if isinstance(valor, str):
+        return "'" + valor.replace("'", "''") + "'"
+    if isinstance(valor, (int, np.integer)):
+        return str(int(valor))
+    return f"CAST({float(valor)!r} AS DOUBLE)"
+
+
+# Expressão SQL de uma coluna derivada do plano
+def derivada_sql(derivada):
+    operador, *colunas = derivada
+    if operador == "ano":
+        return f"YEAR({colunas[0]})"
+    if operador == "razao":
+        # Divisão por zero vira nulo e é ignorada pelas agregações, em todos os motores
+        return f"{colunas[0]} / NULLIF({colunas[1]}, 0)"
+    raise ValueError(f"Coluna derivada desconhecida: {operador}")
+
+
+# Expressão SQL com o valor, já calculado, do grupo de cada linha (nulo para grupos sem valor)
+def expressao_por_grupo(grupo, valores):
+    casos = " ".join(
+        f"WHEN {grupo} IS NULL THEN {literal_sql(valor)}" if chave is None
+        else f"WHEN {grupo} = {literal_sql(chave)} THEN {literal_sql(valor)}"
+        for chave, valor in valores
+    )
+    return f"CASE {casos} END" if casos else "NULL"
+
+
+# Comparação SQL de cada direção do filtro relativo ao grupo
+DIRECOES_GRUPO = {"acima": ">", "abaixo": "<"}
+
+
+# Agregação SQL da estatística de referência: "media" ou um percentil entre 0 e 1 (exato, com interpolação
+# linear, como no Pandas). O nome da função de percentil muda entre os motores.
+def agregado_referencia_sql(coluna, estatistica, dialeto="spark"):
+    if estatistica == "media":
+        return f"AVG({coluna})"
+    funcao = "quantile_cont" if dialeto == "duckdb" else "percentile"
+    return f"{funcao}({coluna}, {float(estatistica)!r})"
+
+
+# Compila o plano para SQL. funcao_poligono registra o teste de contenção no motor e devolve o nome da função;
+# referencia_grupo(coluna, estatistica, grupo) devolve a expressão da referência do grupo, ou None para usar
+# uma janela; dialeto escolhe os nomes das funções ("spark" ou "duckdb").
+def plano_para_sql(plano, tabela, colunas_tabela, funcao_poligono, referencia_grupo=None, dialeto="spark"):
+    selecao_base = ["*"] + [f"{derivada_sql(derivada)} AS {nome}" for nome, derivada in plano.get("derivadas", {}).items()]
+    filtros = []
+    for numero, (coluna, operador, argumento) in enumerate(plano.get("filtros", [])):
+        if operador == "em":
+            filtros.append(f"{coluna} IN (" + ", ".join(literal_sql(valor) for valor in argumento) + ")")
+        elif operador == "dentro_poligono":
+            # Células da grade e caixa envolvente são empurradas para a leitura; o teste exato vem por último
+            filtros.append(filtro_celulas_grade(shapely.from_wkt(argumento)))
+            filtros.append(filtro_caixa_envolvente(argumento))
+            filtros.append(f"{funcao_poligono(argumento)}(latitude, longitude)")
+        elif operador == "relativo_grupo":
+            direcao, estatistica, grupo = argumento
+            if direcao not in DIRECOES_GRUPO:
+                raise ValueError(f"Direção desconhecida: {direcao}")
+            referencia = referencia_grupo(coluna, estatistica, grupo) if referencia_grupo else None
+            if referencia is None:
+                particao = f"PARTITION BY {grupo}" if grupo else ""
+                selecao_base.append(f"{agregado_referencia_sql(coluna, estatistica, dialeto)} OVER ({particao}) AS _referencia_{numero}")
+                referencia = f"_referencia_{numero}"
+            filtros.append(f"{coluna} {DIRECOES_GRUPO[direcao]} {referencia}")
+        else:
+            raise ValueError(f"Filtro desconhecido: {operador}")
+
+    agregacoes_sql = {"soma": "SUM({})", "media": "AVG({})", "contagem": "COUNT(*)"}
+    grupos = plano.get("agrupar", [])
+    if plano.get("agregacoes"):
+        selecao = grupos + [f"{agregacoes_sql[funcao].format(coluna)} AS {nome}"
+                            for nome, (funcao, coluna) in plano["agregacoes"].items()]
+    else:
+        selecao = list(plano.get("colunas", colunas_tabela))
+
+    sql = f"WITH base AS (SELECT {', '.join(selecao_base)} FROM {tabela})\nSELECT {', '.join(selecao)} FROM base"
+    if filtros:
+        sql += "\nWHERE " + " AND ".join(filtros)
+    if grupos:
+        sql += "\nGROUP BY " + ", ".join(grupos)
+    if plano.get("top_k"):
+        coluna, k, desempate = plano["top_k"]
+        sql += f"\nORDER BY {coluna} DESC NULLS LAST, {desempate} ASC\nLIMIT {int(k)}"
+    elif plano.get("ordenar"):
+        sql += "\nORDER BY " + ", ".join(f"{coluna} {'ASC' if crescente else 'DESC'}" for coluna, crescente in plano["ordenar"])
+    return sql
+
+
+# Nome da função de contenção registrada para um polígono
+def nome_funcao_poligono(poligono_wkt):
+    return f"dentro_poligono_{hashlib.sha1(poligono_wkt.encode()).hexdigest()[:12]}"
+
+
+# Funções de contenção já registradas na sessão Spark
+funcoes_poligono_spark = set()
+
+
+def registrar_poligono_spark(poligono_wkt):
+    nome = nome_funcao_poligono(poligono_wkt)
+    if nome not in funcoes_poligono_spark:
+        spark.udf.register(nome, criar_udf_dentro_poligono(poligono_wkt))
+        funcoes_poligono_spark.add(nome)
+    return nome
+
+
+# Referências (médias ou percentis) calculadas em uma agregação separada e aplicadas como expressão literal: a
+# tabela é lida uma vez para as referências e outra para o filtro, sem junção e sem janela (que levaria cada
+# grupo inteiro a uma única tarefa)
+def referencia_duas_fases(coluna, estatistica, grupo, tabela="tabela_delta"):
+    agregado = agregado_referencia_sql(coluna, estatistica)
+    if grupo is None:
+        return literal_sql(coletar_auxiliar(spark.sql(f"SELECT {agregado} FROM {tabela}"))[0][0])
+    referencias = coletar_auxiliar(spark.sql(f"SELECT {grupo}, {agregado} FROM {tabela} GROUP BY {grupo}"))
+    return expressao_por_grupo(grupo, [(linha[0], linha[1]) for linha in referencias])
+
+
+# SQL Spark do plano sobre a view tabela_delta, com o teste de contenção em uma pandas_udf
+def sql_spark(plano, referencia_grupo=referencia_duas_fases):
+    return plano_para_sql(plano, "tabela_delta", df_delta.columns, registrar_poligono_spark, referencia_grupo)
+
+
+# Motor Spark: SQL compilado do plano
+def motor_spark(plano, referencia_grupo=referencia_duas_fases):
+    return spark.sql(sql_spark(plano, referencia_grupo))
+
+
+# Consultas Spark da bateria de testes, compiladas do catálogo
+consultas_spark = {nome: (lambda plano=plano: motor_spark(plano)) for nome, plano in CATALOGO_CONSULTAS.items()}
+
+
+# Colunas derivadas do plano, calculadas sem copiar as demais colunas do DataFrame
+def colunas_derivadas(plano, dados):
+    derivadas = {}
+    for nome, (operador, *colunas) in plano.get("derivadas", {}).items():
+        if operador == "ano" and colunas[0] == "data_inscricao" and "ano_inscricao" in dados.columns:
+            # O carregamento compacto já deriva o ano de inscrição
+            derivadas[nome] = pd.Series(dados["ano_inscricao"].to_numpy(dtype="float64", na_value=np.nan), index=dados.index)
+        elif operador == "ano":
+            derivadas[nome] = pd.to_datetime(dados[colunas[0]]).dt.year
+        elif operador == "razao":
+            divisor = dados[colunas[1]].astype("float64")
+            derivadas[nome] = dados[colunas[0]].astype("float64") / divisor.where(divisor != 0)
+        else:
+            raise ValueError(f"Coluna derivada desconhecida: {operador}")
+    return derivadas
+
+
+def coluna_plano(dados, derivadas, nome):
+    return derivadas[nome] if nome in derivadas else dados[nome]
+
+
+# Referências que os filtros calculam sobre a tabela inteira: (estatistica, coluna, grupo), com a estatística
+# "media" ou um percentil entre 0 e 1
+def referencias_plano(plano):
+    referencias = []
+    for coluna, operador, argumento in plano.get("filtros", []):
+        if operador == "relativo_grupo":
+            _, estatistica, grupo = argumento
+            referencias.append((estatistica, coluna, grupo))
+    return referencias
+
+
+# Sketch KLL dos valores não nulos de cada grupo (o grupo None quando não há agrupamento)
+def sketches_referencia(valores, grupos, k=SKETCH_KLL_K):
+    from datasketches import kll_floats_sketch
+
+    validos = valores.notna().to_numpy()
+    valores = valores.to_numpy(dtype="float32")[validos]
+    grupos = np.full(len(valores), None, dtype=object) if grupos is None else grupos.astype(object).to_numpy()[validos]
+    sketches = {}
+    for nome in pd.unique(grupos):
+        sketch = kll_floats_sketch(k)
+        sketch.update(valores[pd.isna(grupos)] if pd.isna(nome) else valores[grupos == nome])
+        sketches[None if pd.isna(nome) else nome] = sketch
+    return sketches
+
+
+# Parciais das referências em uma parte da tabela (lote, shard ou a tabela inteira): para as médias, a soma e a
+# contagem por grupo (um único grupo para a média nacional); para os percentis, que não se combinam a partir de
+# resumos, os valores não nulos da coluna e o grupo de cada um. Com aproximado, os percentis usam um sketch KLL
+# por grupo, de tamanho fixo, em vez dos valores.
+def parciais_referencias(plano, dados, aproximado=False):
+    if not referencias_plano(plano):
+        return {}
+    derivadas = colunas_derivadas(plano, dados)
+    parciais = {}
+    for chave in referencias_plano(plano):
+        estatistica, coluna, grupo = chave
+        valores = coluna_plano(dados, derivadas, coluna).astype("float64")
+        if estatistica != "media" and aproximado:
+            parciais[chave] = sketches_referencia(valores, coluna_plano(dados, derivadas, grupo) if grupo is not None else None)
+        elif estatistica != "media":
+            parcial = pd.DataFrame({"valor": valores.to_numpy()})
+            if grupo is not None:
+                parcial["grupo"] = coluna_plano(dados, derivadas, grupo).astype(object).to_numpy()
+            parciais[chave] = parcial.dropna(subset=["valor"])
+        elif grupo is None:
+            parciais[chave] = pd.DataFrame({"soma": [valores.sum()], "contagem": [valores.count()]})
+        else:
+            parcial = valores.groupby(coluna_plano(dados, derivadas, grupo), observed=True, dropna=False).agg(["sum", "count"])
+            # Índice com valores simples, para combinar parciais com categorias diferentes
+            parcial.index = parcial.index.astype(object)
+            parciais[chave] = parcial.set_axis(["soma", "contagem"], axis=1)
+    return parciais
+
+
+# Combina as parciais das referências: as médias (soma / contagem) ou os percentis de cada grupo (com aproximado,
+# pela união dos sketches KLL das parciais)
+def combinar_referencias(plano, parciais, aproximado=False):
+    referencias = {}
+    for chave in referencias_plano(plano):
+        estatistica, _, grupo = chave
+        if estatistica != "media" and aproximado:
+            from datasketches import kll_floats_sketch
+
+            combinados = {}
+            for parcial in parciais:
+                for nome, sketch in parcial[chave].items():
+                    combinados.setdefault(nome, kll_floats_sketch(SKETCH_KLL_K)).merge(sketch)
+            percentis = {nome: sketch.get_quantile(float(estatistica)) for nome, sketch in combinados.items()}
+            if grupo is None:
+                referencias[chave] = percentis.get(None, np.nan)
+            else:
+                referencias[chave] = pd.Series(list(percentis.values()), index=pd.Index(list(percentis), dtype=object), dtype="float64")
+            continue
+        if estatistica != "media":
+            valores = pd.concat([parcial[chave] for parcial in parciais] or [pd.DataFrame(columns=["valor", "grupo"])])
+            if grupo is None:
+                referencias[chave] = valores["valor"].quantile(float(estatistica)) if len(valores) else np.nan
+            else:
+                referencias[chave] = valores.groupby("grupo", dropna=False)["valor"].quantile(float(estatistica))
+            continue
+        totais = pd.concat([parcial[chave] for parcial in parciais] or [pd.DataFrame(columns=["soma", "contagem"])])
+        totais = totais.groupby(level=0, dropna=False).sum()
+        medias = totais["soma"] / totais["contagem"].where(totais["contagem"] > 0)
+        referencias[chave] = (medias.iloc[0] if len(medias) else np.nan) if grupo is None else medias
+    return referencias
+
+
+# Valor de referência do grupo de cada linha (as categorias são procuradas uma vez, não cada linha)
+def valores_do_grupo(grupos, referencia):
+    if isinstance(grupos.dtype, pd.CategoricalDtype):
+        sem_grupo = referencia[referencia.index.isna()]
+        # O código -1 (linha sem grupo) seleciona a última posição, com a referência do grupo nulo
+        por_codigo = np.append(referencia.reindex(grupos.cat.categories).to_numpy(dtype="float64"),
+                               sem_grupo.iloc[0] if len(sem_grupo) else np.nan)
+        return pd.Series(por_codigo[grupos.cat.codes.to_numpy()], index=grupos.index)
+    return grupos.map(referencia).astype("float64")
+
+
+# Máscara das linhas que passam pelos filtros do plano, com as referências já calculadas
+def mascara_filtros(plano, dados, derivadas, referencias):
+    mascara = pd.Series(True, index=dados.index)
+    for coluna, operador, argumento in plano.get("filtros", []):
+        if operador == "em":
+            mascara &= coluna_plano(dados, derivadas, coluna).isin(argumento)
+        elif operador == "dentro_poligono":
+            # Caixa envolvente e células da grade antes do teste exato, só nas linhas que passaram pelos filtros anteriores
+            latitudes, longitudes = coluna_plano(dados, derivadas, 'latitude'), coluna_plano(dados, derivadas, 'longitude')
+            lat_min, lat_max, lon_min, lon_max = limites_poligono(argumento)
+            mascara &= latitudes.between(lat_min, lat_max) & longitudes.between(lon_min, lon_max)
+            if "celula_grade" in dados.columns:
+                celulas = dados["celula_grade"][mascara]
+            else:
+                celulas = celula_grade(latitudes[mascara], longitudes[mascara])
+            mascara[mascara] = celulas_no_poligono(celulas, argumento)
+            mascara[mascara] = pontos_dentro_poligono(latitudes[mascara], longitudes[mascara], argumento)
+        elif operador == "relativo_grupo":
+            direcao, estatistica, grupo = argumento
+            referencia = referencias[(estatistica, coluna, grupo)]
+            if grupo is not None:
+                referencia = valores_do_grupo(coluna_plano(dados, derivadas, grupo), referencia)
+            valores = coluna_plano(dados, derivadas, coluna)
+            if direcao == "acima":
+                mascara &= valores > referencia
+            elif direcao == "abaixo":
+                mascara &= valores < referencia
+            else:
+                raise ValueError(f"Direção desconhecida: {direcao}")
+        else:
+            raise ValueError(f"Filtro desconhecido: {operador}")
+    return mascara
+
+
+# Resultado parcial do plano em uma parte da tabela: as linhas filtradas (só as k maiores, com top_k, incluindo
+# os empates), ou as agregações parciais por grupo (somas e contagens, que se combinam somando)
+def parcial_plano(plano, dados, referencias, colunas_tabela):
+    derivadas = colunas_derivadas(plano, dados)
+    mascara = mascara_filtros(plano, dados, derivadas, referencias)
+
+    if not plano.get("agregacoes"):
+        linhas = dados.loc[mascara]
+        if plano.get("top_k"):
+            coluna, k, _ = plano["top_k"]
+            linhas = linhas.loc[coluna_plano(dados, derivadas, coluna)[mascara].astype("float64").nlargest(k, keep="all").index]
+        if derivadas:
+            linhas = linhas.assign(**{nome: valores[mascara] for nome, valores in derivadas.items()})
+        return linhas[list(plano.get("colunas", colunas_tabela))]
+
+    valores = {}
+    for nome, (funcao, coluna) in plano["agregacoes"].items():
+        if funcao == "contagem":
+            valores[nome] = np.ones(int(mascara.sum()), dtype="int64")
+        elif funcao in ("soma", "media"):
+            serie = coluna_plano(dados, derivadas, coluna)[mascara].astype("float64")
+            valores[nome] = serie.to_numpy()
+            if funcao == "media":
+                valores[f"{nome}__contagem"] = serie.notna().to_numpy(dtype="int64")
+        else:
+            raise ValueError(f"Agregação desconhecida: {funcao}")
+    parcial = pd.DataFrame(valores)
+
+    grupos = plano.get("agrupar", [])
+    if not grupos:
+        return parcial.sum(min_count=1).to_frame().T
+    chaves = [coluna_plano(dados, derivadas, grupo)[mascara].rename(grupo).reset_index(drop=True) for grupo in grupos]
+    parcial = parcial.groupby(chaves, observed=True, dropna=False).sum(min_count=1).reset_index()
+    for grupo in grupos:
+        if isinstance(parcial[grupo].dtype, pd.CategoricalDtype):
+            parcial[grupo] = parcial[grupo].astype(object)
+    return parcial
+
+
+# Combina as parciais do plano (de lotes, shards ou da tabela inteira) no resultado final
+def combinar_plano(plano, parciais, colunas_tabela):
+    if not plano.get("agregacoes"):
+        colunas = list(plano.get("colunas", colunas_tabela))
+        resultado = pd.concat(parciais, ignore_index=True) if parciais else pd.DataFrame(columns=colunas)
+        if plano.get("top_k"):
+            # As k maiores entre as maiores de cada parte, com o mesmo desempate e os nulos por último, como no SQL
+            coluna, k, desempate = plano["top_k"]
+            resultado = resultado.sort_values(by=[coluna, desempate], ascending=[False, True], na_position="last").head(k)
+    else:
+        grupos = plano.get("agrupar", [])
+        colunas_parciais = [
+            coluna for nome, (funcao, _) in plano["agregacoes"].items()
+            for coluna in ([nome, f"{nome}__contagem"] if funcao == "media" else [nome])
+        ]
+        totais = pd.concat(parciais, ignore_index=True) if parciais else pd.DataFrame(columns=grupos + colunas_parciais)
+        if grupos:
+            totais = totais.groupby(grupos, dropna=False, sort=False)[colunas_parciais].sum(min_count=1).reset_index()
+        else:
+            totais = totais[colunas_parciais].astype("float64").sum(min_count=1).to_frame().T
+
+        resultado = totais[grupos].copy()
+        for nome, (funcao, _) in plano["agregacoes"].items():
+            if funcao == "contagem":
+                resultado[nome] = totais[nome].fillna(0).astype("int64")
+            elif funcao == "soma":
+                resultado[nome] = totais[nome]
+            else:
+                contagem = totais[f"{nome}__contagem"]
+                resultado[nome] = totais[nome] / contagem.where(contagem > 0)
+
+    if plano.get("ordenar"):
+        colunas, crescentes = zip(*plano["ordenar"])
+        resultado = resultado.sort_values(by=list(colunas), ascending=list(crescentes))
+    return resultado.reset_index(drop=True)
+
+
+# Interpreta o plano sobre um DataFrame Pandas inteiro, com a mesma semântica do SQL compilado
+def executar_plano_pandas(plano, df_memoria, colunas_tabela):
+    referencias = combinar_referencias(plano, [parciais_referencias(plano, df_memoria)])
+    return combinar_plano(plano, [parcial_plano(plano, df_memoria, referencias, colunas_tabela)], colunas_tabela)
+
+
+# Motor Pandas: plano interpretado sobre o DataFrame compacto (carregado do snapshot se ainda não estiver na memória)
+def motor_pandas(plano):
+    df_memoria = globals().get("df_pd")
+    if df_memoria is None:
+        df_memoria = carregar_snapshot()
+    return executar_plano_pandas(plano, df_memoria, df_delta.columns)
+
+# COMMAND ----------
+
+# Bateria de testes: cada consulta do catálogo no Spark e no motor centralizado configurado.
+# Com o motor multiprocessado, os shards e o pool são preparados uma vez, fora das medições.
+if MOTOR_CENTRALIZADO == "processos":
+    preparar_processos()
+try:
+    for nome, plano in CATALOGO_CONSULTAS.items():
+        executar_benchmark(nome, consultas_spark[nome], lambda plano=plano: motor_centralizado(plano))
+finally:
+    encerrar_processos()
+
+# COMMAND ----------
+
+# Conferindo a poda de arquivos feita pela caixa envolvente: métricas do scan da Consulta 3 executada
+poda_consulta3 = relatorio_poda_scan(CATALOGO_CONSULTAS["Consulta 3"])
+print(f"Arquivos lidos: {poda_consulta3['arquivos_lidos']} de {poda_consulta3['arquivos_total']} ({poda_consulta3['arquivos_pulados']} pulados)")
+print(f"Row groups lidos: {poda_consulta3['row_groups_lidos']} de {poda_consulta3['row_groups_total']}")
+print(f"Bytes lidos: {poda_consulta3['bytes_lidos']} de {poda_consulta3['bytes_total']}")
 
 # COMMAND ----------
 
@@ -303,39 +2223,922 @@ print(f"Tempo de execução Consulta 8 (Pandas): {tempo_execucao_pandas_8} segun
 
 # COMMAND ----------
 
-# Dados das consultas e tempos de execução
+# Dados das consultas, tempos de execução (mediana das repetições) e métricas da execução instrumentada
 tempos = [
-    {"Consulta": "Consulta 1", "Tempo Spark (s)": tempo_execucao_spark_1, "Tempo Pandas (s)": tempo_execucao_pandas_1},
-    {"Consulta": "Consulta 2", "Tempo Spark (s)": tempo_execucao_spark_2, "Tempo Pandas (s)": tempo_execucao_pandas_2},
-    {"Consulta": "Consulta 3", "Tempo Spark (s)": tempo_execucao_spark_3, "Tempo Pandas (s)": tempo_execucao_pandas_3},
-    {"Consulta": "Consulta 4", "Tempo Spark (s)": tempo_execucao_spark_4, "Tempo Pandas (s)": tempo_execucao_pandas_4},
-    {"Consulta": "Consulta 5", "Tempo Spark (s)": tempo_execucao_spark_5, "Tempo Pandas (s)": tempo_execucao_pandas_5},
-    {"Consulta": "Consulta 6", "Tempo Spark (s)": tempo_execucao_spark_6, "Tempo Pandas (s)": tempo_execucao_pandas_6},
-    {"Consulta": "Consulta 8", "Tempo Spark (s)": tempo_execucao_spark_8, "Tempo Pandas (s)": tempo_execucao_pandas_8}
+    {
+        "Consulta": resultado["consulta"],
+        "Tempo Spark (s)": resultado["spark"]["mediana"],
+        "Tempo Pandas (s)": resultado["pandas"]["mediana"],
+        "Spark p95 (s)": resultado["spark"]["p95"],
+        "Pandas p95 (s)": resultado["pandas"]["p95"],
+        "Spark bytes lidos": resultado["metricas_spark"]["bytes_lidos"],
+        "Spark linhas lidas": resultado["metricas_spark"]["linhas_lidas"],
+        "Spark arquivos lidos": resultado["metricas_spark"]["arquivos_lidos"],
+        "Spark arquivos pulados": resultado["metricas_spark"]["arquivos_pulados"],
+        "Spark shuffle lido (bytes)": resultado["metricas_spark"]["shuffle_lido_bytes"],
+        "Spark shuffle escrito (bytes)": resultado["metricas_spark"]["shuffle_escrito_bytes"],
+        "Spark spill (bytes)": resultado["metricas_spark"]["spill_memoria_bytes"] + resultado["metricas_spark"]["spill_disco_bytes"],
+        "Spark assimetria de tarefas": resultado["metricas_spark"]["assimetria_tarefas"],
+        "Spark stages incompletos": ", ".join(resultado["metricas_spark"]["stages_incompletos"]) or None,
+        "Pandas CPU (s)": resultado["metricas_pandas"]["cpu_s"],
+        "Pandas pico RSS (MB)": resultado["metricas_pandas"]["rss_pico_mb"],
+    }
+    for resultado in resultados_benchmark.values()
 ]
 
 # Criando o DataFrame Pandas com os dados
 df_tempos = pd.DataFrame(tempos)
 
 # Arredondando os tempos para 4 casas decimais
-df_tempos["Tempo Spark (s)"] = round(df_tempos["Tempo Spark (s)"], 4)
-df_tempos["Tempo Pandas (s)"] = round(df_tempos["Tempo Pandas (s)"], 4)
+df_tempos = df_tempos.round(4)
 
 # Calculando a diferença entre os tempos
 df_tempos["Diferença"] = round(df_tempos["Tempo Spark (s)"] - df_tempos["Tempo Pandas (s)"], 4)
 
+# Gravando os resultados em JSON e CSV para comparação entre execuções
+caminho_json, caminho_csv = salvar_resultados_benchmark(resultados_benchmark)
+print(f"Resultados gravados em {caminho_json} e {caminho_csv}")
+
 # Exibindo a tabela
 df_tempos.display()
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC Os resultados indicam consistentemente que o ambiente Spark, por ser distribuído, tende a oferecer tempos de execução mais rápidos em comparação com o ambiente Pandas, especialmente em consultas que envolvem operações mais complexas ou grandes volumes de dados, como nas consultas 3 e 8 em que o tempo foi reduzido em aproximadamente 30 segundos. Consultas que exigem operações paralelizáveis parecem se beneficiar significativamente do ambiente distribuído, enquanto o ambiente centralizado do Pandas tende a enfrentar desafios de escalabilidade para determinados tipos de operações.
+# MAGIC ##### Benchmark de layouts
+# MAGIC
+# MAGIC Cada layout de `LAYOUTS` é gravado em um caminho próprio e as consultas da bateria rodam contra ele (a view `tabela_delta` é apontada para o layout da vez). Para cada consulta são registrados a latência (mediana das repetições), os bytes lidos e o número de arquivos lidos, extraídos das métricas dos nós de leitura do plano físico executado e das execuções auxiliares da montagem da consulta (as médias por UF da Consulta 8).
+# MAGIC
+# MAGIC O benchmark regrava a tabela inteira uma vez por layout, roda um `OPTIMIZE ZORDER` e repete a bateria em cada layout, então só roda com `LAYOUTS_EXECUTAR = True`.
+
+# COMMAND ----------
+
+# O benchmark de layouts só roda quando ativado explicitamente
+LAYOUTS_EXECUTAR = False
+
+# Caminho base para as cópias da tabela em cada layout
+caminho_layouts = "/FileStore/big-data_project/delta/layouts"
+
+# Roda as consultas Spark contra cada layout e retorna latência, bytes e arquivos lidos
+def benchmark_layouts(df_origem, layouts=tuple(LAYOUTS), consultas=consultas_spark,
+                      aquecimento=BENCHMARK_AQUECIMENTO, repeticoes=BENCHMARK_REPETICOES):
+    linhas = []
+    try:
+        for layout in layouts:
+            caminho_layout = f"{caminho_layouts}/{layout}"
+            gravar_layout(df_origem, caminho_layout, layout)
+            spark.read.format("delta").load(caminho_layout).createOrReplaceTempView("tabela_delta")
+
+            for nome, consulta in consultas.items():
+                tempos = medir_tempos(lambda: executar_com_metricas_leitura(consulta), aquecimento, repeticoes)
+                metricas = executar_com_metricas_leitura(consulta)
+                metricas.pop("plano_executado")
+                linhas.append({"layout": layout, "consulta": nome, **resumir_tempos(tempos), **metricas})
+                print(f"{layout} | {nome}: mediana {linhas[-1]['mediana']:.4f} s | {metricas['arquivos_lidos']} arquivos | {metricas['bytes_lidos']} bytes")
+    finally:
+        # A view volta a apontar para a tabela principal
+        df_delta.createOrReplaceTempView("tabela_delta")
+    return pd.DataFrame(linhas)
+
+# COMMAND ----------
+
+# Executando o benchmark de layouts a partir da tabela principal (só com LAYOUTS_EXECUTAR)
+if LAYOUTS_EXECUTAR:
+    df_layouts = benchmark_layouts(df_delta)
+
+    # Gravando os resultados junto com os do benchmark das consultas
+    os.makedirs(caminho_resultados, exist_ok=True)
+    df_layouts.to_csv(os.path.join(caminho_resultados, f"layouts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"), index=False)
+
+    # Exibindo a comparação: uma linha por consulta, uma coluna por layout
+    df_layouts.pivot(index="consulta", columns="layout", values=["mediana", "arquivos_lidos", "bytes_lidos"]).display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Manutenção do layout da tabela (compactação, Z-Ordering, estatísticas e VACUUM)
+# MAGIC
+# MAGIC Com a ingestão incremental, cada MERGE grava arquivos novos na tabela `temas_amb`. Com o tempo, acumulam-se arquivos pequenos e as estatísticas ficam desatualizadas. O job de manutenção abaixo tem quatro partes:
+# MAGIC
+# MAGIC * **Monitoramento:** mede o número de arquivos e a distribuição dos tamanhos, contando como pequenos os arquivos abaixo de `MANUTENCAO_ARQUIVO_PEQUENO_MB`.
+# MAGIC * **Compactação e clustering:** roda `OPTIMIZE` com tamanho alvo de `MANUTENCAO_TAMANHO_ALVO_MB`, só quando a fração de arquivos pequenos passa do limite. O mesmo `OPTIMIZE` aplica Z-Ordering nas colunas de `MANUTENCAO_ZORDER`. Em tabelas com liquid clustering, o `OPTIMIZE` usa as colunas de clustering da própria tabela.
+# MAGIC * **Estatísticas:** restringe as estatísticas de data skipping às colunas filtradas pelas consultas e as recalcula para os arquivos existentes. A propriedade da tabela só é alterada quando difere da lista pedida, e o `ANALYZE` só roda depois de uma compactação, quando as colunas mudaram ou quando pedido, porque cada um grava uma versão nova da tabela (e uma versão nova refaz o snapshot, os shards e os sketches e invalida o cache de resultados).
+# MAGIC * **VACUUM:** remove arquivos de versões mais antigas que `MANUTENCAO_RETENCAO_HORAS`. Antes disso, o rollup é atualizado, para que o Change Data Feed não precise das versões removidas.
+# MAGIC
+# MAGIC Cada execução registra os arquivos e a latência da bateria antes e depois, para mostrar o que a manutenção rendeu. A manutenção roda a bateria duas vezes e pode regravar a tabela, então só roda com `MANUTENCAO_EXECUTAR = True`.
+
+# COMMAND ----------
+
+# A manutenção só roda quando ativada explicitamente
+MANUTENCAO_EXECUTAR = False
+
+# Configuração da manutenção
+MANUTENCAO_TAMANHO_ALVO_MB = 128
+MANUTENCAO_ARQUIVO_PEQUENO_MB = 32
+MANUTENCAO_FRACAO_PEQUENOS = 0.2       # Fração mínima de arquivos pequenos para compactar
+MANUTENCAO_ZORDER = ["celula_grade", "data_inscricao"]
+MANUTENCAO_COLUNAS_ESTATISTICAS = ["uf", "celula_grade", "latitude", "longitude", "data_inscricao", "area_do_imovel"]
+MANUTENCAO_RETENCAO_HORAS = 168
+
+
+# Número de arquivos e distribuição de tamanhos (em MB) da versão atual da tabela
+def distribuicao_arquivos(caminho=caminho_delta, pequeno_mb=MANUTENCAO_ARQUIVO_PEQUENO_MB):
+    arquivos = spark.read.format("delta").load(caminho).inputFiles()
+    tamanhos = np.array([os.path.getsize(caminho_local_dbfs(arquivo)) for arquivo in arquivos]) / 2 ** 20
+    if not len(tamanhos):
+        return {"arquivos": 0, "tamanho_total_mb": 0.0, "arquivos_pequenos": 0, "fracao_pequenos": 0.0}
+    faixas = np.histogram(tamanhos, bins=[0, 8, 32, 128, 512, np.inf])[0]
+    return {
+        "arquivos": len(tamanhos),
+        "tamanho_total_mb": float(tamanhos.sum()),
+        "tamanho_min_mb": float(tamanhos.min()),
+        "tamanho_mediana_mb": float(np.median(tamanhos)),
+        "tamanho_max_mb": float(tamanhos.max()),
+        "arquivos_pequenos": int((tamanhos < pequeno_mb).sum()),
+        "fracao_pequenos": float((tamanhos < pequeno_mb).mean()),
+        **{f"arquivos_{faixa}": int(total) for faixa, total in zip(["ate_8mb", "8_32mb", "32_128mb", "128_512mb", "acima_512mb"], faixas)},
+    }
+
+
+# Latência de cada consulta da bateria (mediana das repetições) contra a versão atual da tabela
+def latencias_bateria(caminho=caminho_delta, consultas=consultas_spark):
+    spark.read.format("delta").load(caminho).createOrReplaceTempView("tabela_delta")
+    return {nome: resumir_tempos(medir_tempos(lambda: forcar_execucao_spark(consulta())))["mediana"]
+            for nome, consulta in consultas.items()}
+
+
+# Compacta os arquivos pequenos no tamanho alvo, aplicando Z-Ordering (ou o liquid clustering da tabela)
+def compactar_tabela(caminho=caminho_delta, zorder=MANUTENCAO_ZORDER, tamanho_alvo_mb=MANUTENCAO_TAMANHO_ALVO_MB):
+    detalhe = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first().asDict()
+    # Colunas de partição não podem entrar no Z-Ordering
+    zorder = [coluna for coluna in zorder if coluna not in (detalhe.get("partitionColumns") or [])]
+
+    configuracao = "spark.databricks.delta.optimize.maxFileSize"
+    anterior = spark.conf.get(configuracao, None)
+    spark.conf.set(configuracao, str(tamanho_alvo_mb * 2 ** 20))
+    try:
+        otimizacao = DeltaTable.forPath(spark, caminho).optimize()
+        if detalhe.get("clusteringColumns") or not zorder:
+            metricas = otimizacao.executeCompaction()
+        else:
+            metricas = otimizacao.executeZOrderBy(*zorder)
+    finally:
+        if anterior is None:
+            spark.conf.unset(configuracao)
+        else:
+            spark.conf.set(configuracao, anterior)
+
+    metricas = metricas.first()["metrics"]
+    return {"arquivos_removidos": metricas["numFilesRemoved"], "arquivos_adicionados": metricas["numFilesAdded"]}
+
+
+# Restringe as estatísticas de data skipping às colunas filtradas e as recalcula para os arquivos existentes.
+# ALTER e ANALYZE gravam versões novas da tabela, então só rodam quando as colunas mudaram ou com recalcular.
+def atualizar_estatisticas(caminho=caminho_delta, colunas=MANUTENCAO_COLUNAS_ESTATISTICAS, recalcular=False):
+    propriedades = spark.sql(f"DESCRIBE DETAIL delta.`{caminho}`").first()["properties"] or {}
+    alteradas = propriedades.get("delta.dataSkippingStatsColumns") != ",".join(colunas)
+    if alteradas:
+        spark.sql(f"ALTER TABLE delta.`{caminho}` SET TBLPROPERTIES ('delta.dataSkippingStatsColumns' = '{','.join(colunas)}')")
+    if alteradas or recalcular:
+        spark.sql(f"ANALYZE TABLE delta.`{caminho}` COMPUTE DELTA STATISTICS")
+    return {"estatisticas_alteradas": alteradas, "estatisticas_recalculadas": alteradas or recalcular}
+
+
+# Roda a manutenção completa e registra arquivos e latências antes e depois
+def executar_manutencao(caminho=caminho_delta, compactar=True, zorder=MANUTENCAO_ZORDER, estatisticas=True,
+                        recalcular_estatisticas=False, vacuum=True, retencao_horas=MANUTENCAO_RETENCAO_HORAS,
+                        fracao_pequenos=MANUTENCAO_FRACAO_PEQUENOS):
+    carimbo = datetime.now().strftime("%Y%m%d_%H%M%S")
+    antes = distribuicao_arquivos(caminho)
+    latencias_antes = latencias_bateria(caminho)
+    etapas = {"versao_antes": versao_delta(caminho)}
+
+    try:
+        compactada = compactar and antes["fracao_pequenos"] >= fracao_pequenos
+        if compactada:
+            etapas.update(compactar_tabela(caminho, zorder))
+        if estatisticas:
+            # O ANALYZE só é necessário depois de uma compactação ou quando pedido
+            etapas.update(atualizar_estatisticas(caminho, recalcular=compactada or recalcular_estatisticas))
+        if vacuum:
+            # O rollup lê o Change Data Feed desde a sua versão; atualizá-lo antes evita depender de versões removidas
+            if caminho == caminho_delta:
+                atualizar_rollup()
+            DeltaTable.forPath(spark, caminho).vacuum(retencao_horas)
+
+        depois = distribuicao_arquivos(caminho)
+        latencias_depois = latencias_bateria(caminho)
+        if caminho in datasets_delta:
+            atualizar_dataset_delta(caminho)
+    finally:
+        # A view volta a apontar para a tabela principal
+        spark.read.format("delta").load(caminho_delta).createOrReplaceTempView("tabela_delta")
+    etapas["versao_depois"] = versao_delta(caminho)
+
+    arquivos = pd.DataFrame([{"momento": "antes", **antes}, {"momento": "depois", **depois}])
+    latencias = pd.DataFrame({"antes_s": latencias_antes, "depois_s": latencias_depois}).rename_axis("consulta").reset_index()
+    latencias["ganho"] = latencias["antes_s"] / latencias["depois_s"]
+
+    os.makedirs(caminho_resultados, exist_ok=True)
+    arquivos.assign(execucao=carimbo, **etapas).to_csv(os.path.join(caminho_resultados, f"manutencao_arquivos_{carimbo}.csv"), index=False)
+    latencias.assign(execucao=carimbo).to_csv(os.path.join(caminho_resultados, f"manutencao_latencias_{carimbo}.csv"), index=False)
+
+    print(f"Arquivos: {antes['arquivos']} -> {depois['arquivos']} | pequenos: {antes['arquivos_pequenos']} -> {depois['arquivos_pequenos']}")
+    print(f"Bateria: {latencias['antes_s'].sum():.4f} s -> {latencias['depois_s'].sum():.4f} s")
+    return arquivos, latencias, etapas
+
+# COMMAND ----------
+
+# Executando a manutenção da tabela principal (só com MANUTENCAO_EXECUTAR)
+if MANUTENCAO_EXECUTAR:
+    arquivos_manutencao, latencias_manutencao, etapas_manutencao = executar_manutencao()
+
+    arquivos_manutencao.round(2).display()
+    latencias_manutencao.round(4).display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Consultas respondidas pelos rollups
+# MAGIC
+# MAGIC As Consultas 1, 4, 5, 6 e 8 são roteadas para a tabela de resumo. O resultado de cada uma é conferido com a consulta na tabela base antes da medição.
+
+# COMMAND ----------
+
+# Garantindo que o resumo reflete a versão atual da tabela base
+atualizar_rollup()
+
+linhas_rollup = []
+for nome in ["Consulta 1", "Consulta 4", "Consulta 5", "Consulta 6", "Consulta 8"]:
+    plano, consulta_base = CATALOGO_CONSULTAS[nome], consultas_spark[nome]
+    resultados_iguais, detalhe = comparar_resultados(consulta_base(), rotear_plano(plano))
+    if not resultados_iguais:
+        raise AssertionError(f"{nome}: resultado do resumo diverge da tabela base\n{detalhe}")
+
+    tempos_rollup = medir_tempos(lambda: rotear_plano(plano).collect())
+    tempos_base = medir_tempos(lambda: forcar_execucao_spark(consulta_base()))
+    linhas_rollup.append({
+        "Consulta": nome,
+        "Tempo tabela base (s)": resumir_tempos(tempos_base)["mediana"],
+        "Tempo rollup (s)": resumir_tempos(tempos_rollup)["mediana"],
+    })
+
+pd.DataFrame(linhas_rollup).round(4).display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Modo aproximado: velocidade e precisão
+# MAGIC
+# MAGIC Cada resposta aproximada é comparada com o valor exato calculado no Spark e no Pandas: a tabela mostra os tempos (mediana das repetições), o valor exato de cada ambiente, o erro relativo da resposta aproximada em relação a cada um e se cada valor exato ficou dentro do intervalo de erro informado. As colunas do Pandas só são preenchidas com `MOTOR_CENTRALIZADO = "memoria"`.
+
+# COMMAND ----------
+
+construir_aproximacoes()
+
+# Cada item: (nome, função aproximada, consulta exata no Spark, consulta exata no Pandas)
+comparacoes_aproximadas = [
+    (
+        "Municípios distintos",
+        municipios_distintos_aproximado,
+        lambda: spark.sql("SELECT COUNT(DISTINCT municipio) FROM tabela_delta").first()[0],
+        lambda: df_pd['municipio'].nunique(),
+    ),
+    (
+        "Mediana da área",
+        lambda: percentil_area_aproximado(0.5),
+        lambda: spark.sql("SELECT percentile(area_do_imovel, 0.5) FROM tabela_delta").first()[0],
+        lambda: df_pd['area_do_imovel'].median(),
+    ),
+    (
+        "Percentil 95 da área",
+        lambda: percentil_area_aproximado(0.95),
+        lambda: spark.sql("SELECT percentile(area_do_imovel, 0.95) FROM tabela_delta").first()[0],
+        lambda: df_pd['area_do_imovel'].quantile(0.95),
+    ),
+    (
+        "Consulta 5 (razão média de vegetação)",
+        razao_vegetacao_aproximada,
+        lambda: consultas_spark["Consulta 5"]().first()[0],
+        lambda: motor_pandas(CATALOGO_CONSULTAS["Consulta 5"]).iloc[0, 0],
+    ),
+    (
+        "Consulta 1 (área total em MT)",
+        lambda: area_por_uf_aproximada(['MT']).iloc[0].to_dict(),
+        lambda: spark.sql("SELECT SUM(area_do_imovel) FROM tabela_delta WHERE uf = 'MT'").first()[0],
+        lambda: df_pd.loc[df_pd['uf'] == 'MT', 'area_do_imovel'].sum(),
+    ),
+]
+
+
+# Erro relativo (%) da resposta aproximada em relação a um valor exato
+def erro_relativo_aproximado(resposta, valor_exato):
+    return 100 * abs(resposta["valor"] - valor_exato) / abs(valor_exato)
+
+
+linhas_aproximadas = []
+for nome, aproximada, exata_spark, exata_pandas in comparacoes_aproximadas:
+    resposta = aproximada()
+    valor_exato = exata_spark()
+    valor_pandas = exata_pandas() if MOTOR_CENTRALIZADO == "memoria" else None
+    linhas_aproximadas.append({
+        "Consulta": nome,
+        "Valor aproximado": resposta["valor"],
+        "Valor exato Spark": valor_exato,
+        "Erro relativo Spark (%)": erro_relativo_aproximado(resposta, valor_exato),
+        "Spark dentro do intervalo": resposta["limite_inferior"] <= valor_exato <= resposta["limite_superior"],
+        "Valor exato Pandas": valor_pandas,
+        "Erro relativo Pandas (%)": erro_relativo_aproximado(resposta, valor_pandas) if valor_pandas is not None else None,
+        "Pandas dentro do intervalo": (
+            resposta["limite_inferior"] <= valor_pandas <= resposta["limite_superior"] if valor_pandas is not None else None
+        ),
+        "Tempo Spark exato (s)": resumir_tempos(medir_tempos(exata_spark))["mediana"],
+        "Tempo Pandas exato (s)": resumir_tempos(medir_tempos(exata_pandas))["mediana"] if MOTOR_CENTRALIZADO == "memoria" else None,
+        "Tempo aproximado (s)": resumir_tempos(medir_tempos(aproximada))["mediana"],
+    })
+
+pd.DataFrame(linhas_aproximadas).round(4).display()
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC A Consulta 7 não foi testada em ambientes distribuídos e centralizados, uma vez que a natureza da consulta a torna desafiadora de ser comparada diretamente. No caso específico dessa consulta, ela envolve a determinação da maior propriedade e o cálculo da distância até Brasília, ambos baseados em cálculos geoespaciais específicos e envolvem operações que podem ser difíceis de paralelizar efetivamente em um ambiente distribuído sem perder a precisão ou eficiência.
+# MAGIC ##### Escalabilidade com dados sintéticos
+# MAGIC
+# MAGIC A conclusão de que o Spark escala melhor vinha de um único tamanho de dados em um único cluster. O gerador abaixo produz, de forma determinística (semente fixa), dados com o mesmo esquema do Cadastro Ambiental Rural em fatores de escala de 1x a 100x. As distribuições vêm de um perfil extraído da tabela real: o peso de cada município (e portanto a concentração por UF), a posição média e a dispersão das coordenadas em cada município, a distribuição log-normal da área, a razão de vegetação nativa, os anos de inscrição e as combinações de situação/condição do cadastro.
+# MAGIC
+# MAGIC A varredura roda a bateria de consultas em cada fator de escala: no Spark, em processos separados com `local[1]` até `local[N]`; no ambiente centralizado, com o Pandas no driver. Os números aleatórios de cada linha vêm de um hash do seu `id` com a semente (`xxhash64`), então os dados não dependem do número de partições nem do cluster. Antes de carregar cada fator no Pandas, a memória necessária é estimada pelo tamanho descomprimido dos arquivos Parquet; um fator que não cabe na memória disponível, ou que falha com `MemoryError`, é registrado como o ponto em que o Pandas deixa de escalar, e os fatores maiores não rodam no Pandas. Os gráficos mostram a latência por fator de escala e a vazão por nível de paralelismo.
+# MAGIC
+# MAGIC A varredura grava até 100 vezes a tabela e leva horas, então só roda com `VARREDURA_EXECUTAR = True`. O gerador, porém, é conferido em toda execução com uma amostra de `VARREDURA_LINHAS_TESTE` linhas (número de linhas e esquema da origem), para que um erro nele não fique escondido atrás da flag.
+
+# COMMAND ----------
+
+import subprocess
+import sys
+
+import matplotlib.pyplot as plt
+
+# A varredura só roda quando ativada explicitamente
+VARREDURA_EXECUTAR = False
+
+# Fatores de escala, níveis de paralelismo local e semente da varredura
+VARREDURA_FATORES = [1, 2, 5, 10, 20, 50, 100]
+VARREDURA_PARALELISMO = sorted({1, 2, 4, os.cpu_count()})
+VARREDURA_SEMENTE = 42
+
+# Linhas do fator 1x (por padrão, o tamanho da tabela real)
+VARREDURA_LINHAS_BASE = None
+
+# Linhas da amostra que confere o gerador em toda execução, mesmo com a varredura desativada
+VARREDURA_LINHAS_TESTE = 1000
+
+# Número de posições das tabelas de sorteio (resolução das probabilidades)
+SORTEIO_POSICOES = 100000
+
+# Partições da geração (não alteram os dados, só o paralelismo da gravação)
+VARREDURA_PARTICOES = 64
+
+# Memória do Pandas por byte Parquet descomprimido (buffers Arrow e DataFrame coexistem na conversão) e
+# fração da memória disponível do driver que o Pandas pode usar
+VARREDURA_FATOR_MEMORIA_PANDAS = 3
+VARREDURA_FRACAO_MEMORIA = 0.8
+
+# Destino dos dados sintéticos (Parquet, lido pelos processos locais via /dbfs)
+caminho_sinteticos = "/FileStore/big-data_project/sinteticos"
+
+
+# Extrai da tabela real o perfil usado pelo gerador (tabelas pequenas, agregadas no Spark)
+def perfil_sintetico(df_base):
+    log_area = F.log(F.when(F.col("area_do_imovel") > 0, F.col("area_do_imovel")))
+    razao = F.when(F.col("area_do_imovel") > 0, F.col("area_remanescente_vegetacao_nativa") / F.col("area_do_imovel"))
+    municipios = df_base.groupBy("uf", "municipio", "codigo_ibge").agg(
+        F.count(F.lit(1)).alias("peso"),
+        F.avg("latitude").alias("lat_media"), F.stddev("latitude").alias("lat_desvio"),
+        F.avg("longitude").alias("lon_media"), F.stddev("longitude").alias("lon_desvio"),
+        F.avg(log_area).alias("log_area_media"), F.stddev(log_area).alias("log_area_desvio"),
+        F.avg(razao).alias("razao_media"), F.stddev(razao).alias("razao_desvio"),
+    ).toPandas().fillna({"lat_desvio": 0, "lon_desvio": 0, "log_area_desvio": 0, "razao_desvio": 0, "razao_media": 0})
+    anos = df_base.groupBy(F.year("data_inscricao").alias("ano")).count().dropna().toPandas()
+    situacoes = df_base.groupBy("situacao_cadastro", "condicao_cadastro").count().toPandas()
+    return {
+        "municipios": municipios.dropna(subset=["lat_media", "lon_media", "log_area_media"]).reset_index(drop=True),
+        "anos": anos.rename(columns={"count": "peso"}),
+        "situacoes": situacoes.rename(columns={"count": "peso"}),
+    }
+
+
+# Tabela de sorteio: cada posição aponta para um item, na proporção do seu peso. A coluna de posição perde o
+# sufixo "_id" da coluna do item (municipio_id -> posicao_municipio), que é a chave usada nas junções do gerador.
+def tabela_sorteio(pesos, coluna, posicoes=SORTEIO_POSICOES):
+    limites = np.round(np.cumsum(pesos) / np.sum(pesos) * posicoes).astype("int64")
+    itens = np.searchsorted(limites, np.arange(posicoes), side="right")
+    posicao = f"posicao_{coluna.removesuffix('_id')}"
+    return F.broadcast(spark.createDataFrame(pd.DataFrame({posicao: np.arange(posicoes), coluna: itens})))
+
+
+# Número uniforme em (0, 1) derivado do hash do id da linha com a semente. Ao contrário de F.rand, que é
+# semeado por partição, não depende do particionamento nem da ordem de execução.
+def uniforme_linha(semente):
+    return (F.pmod(F.xxhash64(F.col("id"), F.lit(semente)), F.lit(2 ** 53)).cast("double") + 0.5) / float(2 ** 53)
+
+
+# Normal padrão pela transformação de Box-Muller sobre dois uniformes da linha
+def normal_linha(semente):
+    return F.sqrt(-2 * F.log(uniforme_linha(semente))) * F.cos(2 * np.pi * uniforme_linha(semente + 1000))
+
+
+# Gera um DataFrame sintético com o esquema de df_origem, de forma determinística para a mesma semente
+def gerar_car_sintetico(perfil, linhas, df_origem=df, semente=VARREDURA_SEMENTE, particoes=VARREDURA_PARTICOES):
+    # Todos os números aleatórios são gerados antes das junções, a partir do id de cada linha
+    sinteticos = spark.range(0, linhas, numPartitions=particoes).select(
+        "id",
+        F.floor(uniforme_linha(semente) * SORTEIO_POSICOES).alias("posicao_municipio"),
+        F.floor(uniforme_linha(semente + 1) * SORTEIO_POSICOES).alias("posicao_ano"),
+        F.floor(uniforme_linha(semente + 2) * SORTEIO_POSICOES).alias("posicao_situacao"),
+        normal_linha(semente + 3).alias("z_lat"),
+        normal_linha(semente + 4).alias("z_lon"),
+        normal_linha(semente + 5).alias("z_area"),
+        normal_linha(semente + 6).alias("z_razao"),
+        F.floor(uniforme_linha(semente + 7) * 365).cast("int").alias("dia_do_ano"),
+    )
+
+    # Os pesos já estão nas tabelas de sorteio; sem eles, as três tabelas não repetem nomes de colunas
+    municipios = F.broadcast(spark.createDataFrame(perfil["municipios"].drop(columns="peso").reset_index().rename(columns={"index": "municipio_id"})))
+    anos = F.broadcast(spark.createDataFrame(perfil["anos"].drop(columns="peso").reset_index().rename(columns={"index": "ano_id"})))
+    situacoes = F.broadcast(spark.createDataFrame(perfil["situacoes"].drop(columns="peso").reset_index().rename(columns={"index": "situacao_id"})))
+
+    sinteticos = (
+        sinteticos
+        .join(tabela_sorteio(perfil["municipios"]["peso"], "municipio_id"), "posicao_municipio")
+        .join(tabela_sorteio(perfil["anos"]["peso"], "ano_id"), "posicao_ano")
+        .join(tabela_sorteio(perfil["situacoes"]["peso"], "situacao_id"), "posicao_situacao")
+        .join(municipios, "municipio_id")
+        .join(anos, "ano_id")
+        .join(situacoes, "situacao_id")
+    )
+
+    area = F.exp(F.col("log_area_media") + F.col("log_area_desvio") * F.col("z_area"))
+    razao = F.least(F.greatest(F.col("razao_media") + F.col("razao_desvio") * F.col("z_razao"), F.lit(0.0)), F.lit(1.0))
+    colunas = {
+        "uf": F.col("uf"),
+        "municipio": F.col("municipio"),
+        "codigo_ibge": F.col("codigo_ibge"),
+        "area_do_imovel": area,
+        "area_remanescente_vegetacao_nativa": area * razao,
+        "latitude": F.col("lat_media") + F.col("lat_desvio") * F.col("z_lat"),
+        "longitude": F.col("lon_media") + F.col("lon_desvio") * F.col("z_lon"),
+        "data_inscricao": F.date_add(F.make_date(F.col("ano"), F.lit(1), F.lit(1)), F.col("dia_do_ano")),
+        "registro_car": F.concat_ws("-", F.col("uf"), F.col("codigo_ibge").cast("string"),
+                                    F.upper(F.substring(F.sha2(F.concat(F.col("id").cast("string"), F.lit(f"-{semente}")), 256), 1, 32))),
+        "situacao_cadastro": F.col("situacao_cadastro"),
+        "condicao_cadastro": F.col("condicao_cadastro"),
+    }
+
+    # Mesmo esquema da origem: colunas geradas com o tipo original e demais colunas nulas
+    return sinteticos.orderBy("id").select([
+        (colunas[campo.name] if campo.name in colunas else F.lit(None)).cast(campo.dataType).alias(campo.name)
+        for campo in df_origem.schema.fields
+    ])
+
+
+# Bateria da varredura compilada do catálogo para os processos Spark locais: as médias por grupo em janela e o
+# teste de contenção na função registrada pelo próprio processo. Retorna as consultas e os polígonos usados.
+def consultas_sql_varredura(catalogo=CATALOGO_CONSULTAS):
+    poligonos = {}
+
+    def funcao_poligono(poligono_wkt):
+        nome = nome_funcao_poligono(poligono_wkt)
+        poligonos[nome] = poligono_wkt
+        return nome
+
+    consultas = {nome: plano_para_sql(plano, "tabela_delta", df_delta.columns, funcao_poligono) for nome, plano in catalogo.items()}
+    return consultas, poligonos
+
+# Processo Spark local da varredura: roda as consultas com o paralelismo pedido e imprime os tempos em JSON
+CODIGO_PROCESSO_VARREDURA = '''
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import pandas_udf
+
+args = json.loads(sys.argv[1])
+spark = (SparkSession.builder.master(f"local[{args['paralelismo']}]")
+         .config("spark.sql.shuffle.partitions", 2 * args["paralelismo"]).getOrCreate())
+spark.read.parquet(args["caminho"]).createOrReplaceTempView("tabela_delta")
+
+def criar_udf_dentro_poligono(poligono_wkt):
+    poligono = shapely.from_wkt(poligono_wkt)
+    shapely.prepare(poligono)
+
+    @pandas_udf("boolean")
+    def dentro_poligono(latitude: pd.Series, longitude: pd.Series) -> pd.Series:
+        return pd.Series(shapely.contains_xy(poligono, longitude.to_numpy("float64"), latitude.to_numpy("float64")))
+
+    return dentro_poligono
+
+for nome, poligono_wkt in args["poligonos"].items():
+    spark.udf.register(nome, criar_udf_dentro_poligono(poligono_wkt))
+
+tempos = {}
+for nome, sql in args["consultas"].items():
+    medidas = []
+    for rodada in range(args["aquecimento"] + args["repeticoes"]):
+        inicio = time.perf_counter()
+        spark.sql(sql).write.format("noop").mode("overwrite").save()
+        if rodada >= args["aquecimento"]:
+            medidas.append(time.perf_counter() - inicio)
+    tempos[nome] = float(np.median(medidas))
+print(json.dumps(tempos))
+'''
+
+
+# Roda a bateria SQL em um processo Spark local com o paralelismo pedido
+def medir_spark_local(caminho_parquet, paralelismo, aquecimento=BENCHMARK_AQUECIMENTO, repeticoes=BENCHMARK_REPETICOES):
+    consultas, poligonos = consultas_sql_varredura()
+    argumentos = json.dumps({
+        "caminho": caminho_parquet, "paralelismo": paralelismo, "poligonos": poligonos,
+        "consultas": consultas, "aquecimento": aquecimento, "repeticoes": repeticoes,
+    })
+    processo = subprocess.run([sys.executable, "-c", CODIGO_PROCESSO_VARREDURA, argumentos],
+                              capture_output=True, text=True, check=True)
+    return json.loads(processo.stdout.strip().splitlines()[-1])
+
+
+# Memória estimada para carregar os dados no Pandas, pelo tamanho descomprimido dos row groups Parquet
+def estimar_memoria_pandas(caminho_parquet, fator=VARREDURA_FATOR_MEMORIA_PANDAS):
+    total = 0
+    for fragmento in ds.dataset(caminho_parquet, format="parquet").get_fragments():
+        metadados = fragmento.metadata
+        total += sum(metadados.row_group(i).total_byte_size for i in range(metadados.num_row_groups))
+    return total * fator
+
+
+# Roda os planos do catálogo com o Pandas sobre os dados sintéticos, no driver
+def medir_pandas_sintetico(caminho_parquet, catalogo=CATALOGO_CONSULTAS, aquecimento=BENCHMARK_AQUECIMENTO,
+                           repeticoes=BENCHMARK_REPETICOES):
+    try:
+        df_sintetico = compactar_pandas(pd.read_parquet(caminho_parquet))
+        return {
+            nome: resumir_tempos(medir_tempos(lambda: executar_plano_pandas(plano, df_sintetico, df_delta.columns),
+                                              aquecimento, repeticoes))["mediana"]
+            for nome, plano in catalogo.items()
+        }
+    except MemoryError:
+        return None
+
+
+# Gera os dados de cada fator de escala e mede a bateria no Spark (cada paralelismo) e no Pandas
+def varredura_escalabilidade(fatores=VARREDURA_FATORES, paralelismos=VARREDURA_PARALELISMO, linhas_base=VARREDURA_LINHAS_BASE):
+    perfil = perfil_sintetico(df)
+    linhas_base = linhas_base or df.count()
+    medicoes = []
+    pandas_escala = True
+    for fator in fatores:
+        linhas = linhas_base * fator
+        caminho = f"{caminho_sinteticos}/fator={fator}"
+        preparar_linhas(gerar_car_sintetico(perfil, linhas)).write.mode("overwrite").parquet(caminho)
+
+        for paralelismo in paralelismos:
+            tempos = medir_spark_local(caminho_local_dbfs(caminho), paralelismo)
+            medicoes.append({"fator": fator, "linhas": linhas, "motor": f"Spark local[{paralelismo}]",
+                             "paralelismo": paralelismo, "tempo_total_s": sum(tempos.values()), **tempos})
+
+        # Depois da primeira falha, os fatores maiores também não caberiam
+        tempos = None
+        if pandas_escala:
+            necessaria = estimar_memoria_pandas(caminho_local_dbfs(caminho))
+            disponivel = psutil.virtual_memory().available * VARREDURA_FRACAO_MEMORIA
+            if necessaria <= disponivel:
+                tempos = medir_pandas_sintetico(caminho_local_dbfs(caminho))
+            else:
+                print(f"Fator {fator}x: o Pandas precisaria de {necessaria / 2 ** 30:.1f} GB, há {disponivel / 2 ** 30:.1f} GB disponíveis")
+            pandas_escala = tempos is not None
+        medicoes.append({"fator": fator, "linhas": linhas, "motor": "Pandas", "paralelismo": 1,
+                         "tempo_total_s": sum(tempos.values()) if tempos else None, **(tempos or {})})
+        print(f"Fator {fator}x ({linhas} linhas) concluído")
+
+    df_varredura = pd.DataFrame(medicoes)
+    df_varredura["vazao_linhas_s"] = df_varredura["linhas"] * len(CATALOGO_CONSULTAS) / df_varredura["tempo_total_s"]
+    return df_varredura
+
+
+# Curvas de latência por fator de escala e de vazão por nível de paralelismo
+def graficos_varredura(df_varredura):
+    figura, (eixo_latencia, eixo_vazao) = plt.subplots(1, 2, figsize=(14, 5))
+    for motor, medicoes in df_varredura.dropna(subset=["tempo_total_s"]).groupby("motor"):
+        eixo_latencia.plot(medicoes["fator"], medicoes["tempo_total_s"], marker="o", label=motor)
+    eixo_latencia.set(xscale="log", yscale="log", xlabel="Fator de escala", ylabel="Tempo da bateria (s)",
+                      title="Latência por fator de escala")
+    eixo_latencia.legend()
+
+    spark_local = df_varredura[df_varredura["motor"] != "Pandas"]
+    for fator, medicoes in spark_local.groupby("fator"):
+        eixo_vazao.plot(medicoes["paralelismo"], medicoes["vazao_linhas_s"], marker="o", label=f"{fator}x")
+    eixo_vazao.set(xlabel="Paralelismo (local[N])", ylabel="Vazão (linhas/s)", title="Vazão do Spark por paralelismo")
+    eixo_vazao.legend(title="Fator")
+    return figura
+
+# COMMAND ----------
+
+# Conferindo o gerador com uma amostra pequena: o número de linhas e o esquema (nomes e tipos) da origem
+amostra_sintetica = gerar_car_sintetico(perfil_sintetico(df), VARREDURA_LINHAS_TESTE)
+if amostra_sintetica.count() != VARREDURA_LINHAS_TESTE:
+    raise AssertionError(f"Gerador sintético produziu {amostra_sintetica.count()} linhas, esperadas {VARREDURA_LINHAS_TESTE}")
+if [(campo.name, campo.dataType) for campo in amostra_sintetica.schema] != [(campo.name, campo.dataType) for campo in df.schema]:
+    raise AssertionError(f"Esquema do gerador sintético diverge da origem\n{amostra_sintetica.schema}\n{df.schema}")
+preparar_linhas(amostra_sintetica).limit(5).display()
+
+# Executando a varredura (só com VARREDURA_EXECUTAR) e gravando os resultados junto com os do benchmark
+if VARREDURA_EXECUTAR:
+    df_varredura = varredura_escalabilidade()
+    df_varredura.to_csv(os.path.join(caminho_resultados, f"varredura_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"), index=False)
+
+    df_varredura.round(4).display()
+    display(graficos_varredura(df_varredura))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Carga concorrente (vários analistas ao mesmo tempo)
+# MAGIC
+# MAGIC No uso real, vários analistas consultam a `tabela_delta` ao mesmo tempo. O gerador de carga abaixo simula N clientes concorrentes em um pool de threads. Cada cliente sorteia consultas da bateria segundo um mix configurável e dispara a próxima assim que a anterior termina. Cada consulta é enviada a um pool do escalonador FAIR do Spark: painéis leves em um pool, extrações pesadas em outro.
+# MAGIC
+# MAGIC O relatório mostra a vazão (consultas por segundo), a latência nos percentis 50, 95 e 99, e a justiça entre os pools. Para medir a justiça, compara-se com o peso configurado a fatia que cada pool recebeu do tempo de execução das tarefas nos executores. Essa fatia é o `executorRunTime` dos stages dos jobs da carga, lido da API REST e agrupado pelo pool do stage. Ela não é a soma das latências vistas pelos clientes, que depende mais do mix de consultas do que do escalonador. Mesmo assim, a fatia só tende ao peso enquanto os dois pools têm tarefas pendentes: um pool que pede menos do que a sua parte recebe menos. Também se calcula a lentidão de cada consulta em relação à sua latência isolada, medida na bateria. A lentidão média de cada pool entra no índice de Jain, que vale 1 quando todos os pools são igualmente penalizados.
+# MAGIC
+# MAGIC Os pesos dos pools só valem se o cluster tiver `spark.scheduler.mode FAIR` e `spark.scheduler.allocation.file` apontando para o arquivo gerado por `arquivo_pools_fair`. Sem o arquivo, os pools são criados sob demanda, todos com peso 1.
+# MAGIC
+# MAGIC A carga ocupa o cluster por três níveis de concorrência de `CARGA_DURACAO_S` segundos cada, então só roda com `CARGA_EXECUTAR = True`.
+
+# COMMAND ----------
+
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+# A carga só roda quando ativada explicitamente
+CARGA_EXECUTAR = False
+
+# Configuração da carga
+CARGA_CLIENTES = 8
+CARGA_DURACAO_S = 120
+CARGA_SEMENTE = 42
+
+# Mix de consultas: peso relativo de cada consulta no sorteio dos clientes
+CARGA_MIX = {
+    "Consulta 1": 4, "Consulta 2": 1, "Consulta 3": 1, "Consulta 4": 3,
+    "Consulta 5": 2, "Consulta 6": 4, "Consulta 7": 1, "Consulta 8": 2,
+}
+
+# Pool do escalonador FAIR de cada consulta e peso de cada pool
+CARGA_POOLS = {
+    "Consulta 1": "painel", "Consulta 4": "painel", "Consulta 5": "painel", "Consulta 6": "painel", "Consulta 8": "painel",
+    "Consulta 2": "extracao", "Consulta 3": "extracao", "Consulta 7": "extracao",
+}
+CARGA_PESOS_POOLS = {"painel": 2, "extracao": 1}
+
+# Arquivo de alocação dos pools (configurado no cluster em spark.scheduler.allocation.file)
+caminho_pools_fair = "/dbfs/FileStore/big-data_project/fairscheduler.xml"
+
+
+# Grava o arquivo de alocação do escalonador FAIR com os pesos dos pools
+def arquivo_pools_fair(pesos=CARGA_PESOS_POOLS, caminho=caminho_pools_fair):
+    pools = "\n".join(
+        f'  <pool name="{pool}">\n    <schedulingMode>FAIR</schedulingMode>\n    <weight>{peso}</weight>\n    <minShare>0</minShare>\n  </pool>'
+        for pool, peso in pesos.items()
+    )
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    with open(caminho, "w") as arquivo:
+        arquivo.write(f'<?xml version="1.0"?>\n<allocations>\n{pools}\n</allocations>\n')
+    return caminho
+
+
+# Cliente da carga: sorteia e executa consultas até o fim da janela, cada uma no seu pool
+def cliente_carga(cliente, consultas, mix, pools, fim, grupo, semente=CARGA_SEMENTE):
+    sorteio = random.Random(semente + cliente)
+    nomes, pesos = list(mix), list(mix.values())
+    execucoes = []
+    # Todos os jobs da carga ficam no mesmo job group, para o tempo das tarefas por pool
+    spark.sparkContext.setJobGroup(grupo, "Carga concorrente")
+    while time.perf_counter() < fim:
+        nome = sorteio.choices(nomes, pesos)[0]
+        # Propriedade local da thread: os jobs disparados por ela vão para o pool da consulta
+        spark.sparkContext.setLocalProperty("spark.scheduler.pool", pools[nome])
+        inicio = time.perf_counter()
+        forcar_execucao_spark(consultas[nome]())
+        execucoes.append({"cliente": cliente, "consulta": nome, "pool": pools[nome],
+                          "inicio_s": inicio, "latencia_s": time.perf_counter() - inicio})
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+    spark.sparkContext.setLocalProperty("spark.jobGroup.id", None)
+    return execucoes
+
+
+# Tempo de execução das tarefas nos executores (executorRunTime, em segundos) por pool, nos stages dos jobs do grupo
+def tempo_tarefas_por_pool(grupo):
+    esperar_jobs_grupo(grupo)
+    stages_grupo = {stage for job in api_spark("jobs") if job.get("jobGroup") == grupo for stage in job["stageIds"]}
+    tempos = {}
+    for stage in api_spark("stages"):
+        if stage["stageId"] in stages_grupo and stage["status"] == "COMPLETE":
+            pool = stage["schedulingPool"]
+            tempos[pool] = tempos.get(pool, 0) + stage["executorRunTime"] / 1000
+    return tempos
+
+
+# Latência isolada de cada consulta: a mediana da bateria, ou uma medição nova se a consulta não rodou
+def latencias_isoladas(consultas):
+    return {
+        nome: resultados_benchmark[nome]["spark"]["mediana"] if nome in resultados_benchmark
+        else resumir_tempos(medir_tempos(lambda: forcar_execucao_spark(consulta())))["mediana"]
+        for nome, consulta in consultas.items()
+    }
+
+
+# Roda a carga concorrente e retorna as execuções individuais e o relatório
+def executar_carga(clientes=CARGA_CLIENTES, duracao_s=CARGA_DURACAO_S, consultas=consultas_spark,
+                   mix=CARGA_MIX, pools=CARGA_POOLS, pesos_pools=CARGA_PESOS_POOLS):
+    modo = spark.sparkContext.getConf().get("spark.scheduler.mode", "FIFO")
+    if modo != "FAIR":
+        print(f"Aviso: spark.scheduler.mode é {modo}; os pools só são respeitados com FAIR")
+
+    isoladas = latencias_isoladas({nome: consultas[nome] for nome in mix})
+    grupo_jobs = f"carga_{uuid.uuid4().hex}"
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        futuros = [executor.submit(cliente_carga, cliente, consultas, mix, pools, inicio + duracao_s, grupo_jobs)
+                   for cliente in range(clientes)]
+        execucoes = pd.DataFrame([execucao for futuro in futuros for execucao in futuro.result()])
+    duracao_real = time.perf_counter() - inicio
+    tarefas_pool = tempo_tarefas_por_pool(grupo_jobs)
+    execucoes["lentidao"] = execucoes["latencia_s"] / execucoes["consulta"].map(isoladas)
+
+    percentis = lambda latencias: {f"p{q}_s": float(np.percentile(latencias, q)) for q in (50, 95, 99)}
+    resumo = {"clientes": clientes, "duracao_s": duracao_real, "consultas": len(execucoes),
+              "vazao_qps": len(execucoes) / duracao_real, **percentis(execucoes["latencia_s"])}
+
+    por_pool = []
+    tempo_total = sum(tarefas_pool.values())
+    peso_total = sum(pesos_pools.get(pool, 1) for pool in execucoes["pool"].unique())
+    for pool, grupo in execucoes.groupby("pool"):
+        por_pool.append({
+            "pool": pool, "consultas": len(grupo), "vazao_qps": len(grupo) / duracao_real,
+            **percentis(grupo["latencia_s"]),
+            "tempo_tarefas_s": tarefas_pool.get(pool, 0.0),
+            "fatia_tempo": tarefas_pool.get(pool, 0.0) / tempo_total if tempo_total else None,
+            "fatia_esperada": pesos_pools.get(pool, 1) / peso_total,
+            "lentidao_media": grupo["lentidao"].mean(),
+        })
+    por_pool = pd.DataFrame(por_pool)
+
+    # Índice de justiça de Jain sobre a lentidão média dos pools
+    lentidoes = por_pool["lentidao_media"].to_numpy()
+    resumo["justica_jain"] = float(lentidoes.sum() ** 2 / (len(lentidoes) * (lentidoes ** 2).sum()))
+
+    por_consulta = execucoes.groupby("consulta").agg(
+        execucoes=("latencia_s", "size"),
+        p50_s=("latencia_s", lambda latencias: np.percentile(latencias, 50)),
+        p95_s=("latencia_s", lambda latencias: np.percentile(latencias, 95)),
+        p99_s=("latencia_s", lambda latencias: np.percentile(latencias, 99)),
+        lentidao_media=("lentidao", "mean"),
+    ).reset_index()
+
+    print(f"{clientes} clientes: {resumo['vazao_qps']:.2f} consultas/s | p50 {resumo['p50_s']:.3f} s | p95 {resumo['p95_s']:.3f} s | p99 {resumo['p99_s']:.3f} s | Jain {resumo['justica_jain']:.3f}")
+    return execucoes, resumo, por_pool, por_consulta
+
+# COMMAND ----------
+
+# Gerando o arquivo de alocação dos pools (usado na configuração do cluster)
+arquivo_pools_fair()
+
+# Executando a carga com níveis crescentes de concorrência (só com CARGA_EXECUTAR)
+if CARGA_EXECUTAR:
+    resumos_carga, pools_carga = [], []
+    for clientes in sorted({1, CARGA_CLIENTES // 2, CARGA_CLIENTES}):
+        execucoes_carga, resumo_carga, por_pool_carga, por_consulta_carga = executar_carga(clientes=clientes)
+        resumos_carga.append(resumo_carga)
+        pools_carga.append(por_pool_carga.assign(clientes=clientes))
+
+    df_carga = pd.DataFrame(resumos_carga)
+    df_carga.to_csv(os.path.join(caminho_resultados, f"carga_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"), index=False)
+
+    df_carga.round(4).display()
+    pd.concat(pools_carga).round(4).display()
+    por_consulta_carga.round(4).display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##### Motores plugáveis do catálogo (validação cruzada com o DuckDB)
+# MAGIC
+# MAGIC Os planos do catálogo de consultas não dependem do motor. Aqui eles rodam em três motores: o Spark, o motor centralizado escolhido em `MOTOR_CENTRALIZADO` (Pandas em memória, em lotes ou em shards, o mesmo da bateria de testes) e o DuckDB, um motor colunar embutido que lê os mesmos arquivos Parquet da versão atual da tabela Delta. O DuckDB recebe o mesmo SQL compilado do Spark, com o teste de contenção registrado como função Arrow sobre o mesmo motor vetorizado (`pontos_dentro_poligono`) e as referências por grupo (médias ou percentis) calculadas em janela.
+# MAGIC
+# MAGIC Os resultados de cada motor são conferidos com os do Spark antes da medição. Para adicionar um motor, basta registrar em `MOTORES_CATALOGO` uma função que recebe o plano, sem reescrever as consultas.
+
+# COMMAND ----------
+
+# Conexão DuckDB sobre os arquivos Parquet da tabela Delta, refeita quando o dataset resolvido muda
+estado_duckdb = {}
+
+
+def conexao_duckdb(caminho=caminho_delta):
+    import duckdb
+
+    dataset = dataset_delta(caminho)
+    if estado_duckdb.get("dataset") is not dataset:
+        conexao = duckdb.connect()
+        conexao.register("tabela_delta", dataset)
+        estado_duckdb.update(dataset=dataset, conexao=conexao, funcoes=set())
+    return estado_duckdb["conexao"]
+
+
+# Motor DuckDB: o mesmo SQL compilado, com o teste de contenção registrado como função Arrow
+def motor_duckdb(plano):
+    import duckdb
+
+    conexao = conexao_duckdb()
+
+    def registrar_poligono(poligono_wkt):
+        nome = nome_funcao_poligono(poligono_wkt)
+        if nome not in estado_duckdb["funcoes"]:
+            conexao.create_function(
+                nome,
+                lambda latitude, longitude: pa.array(pontos_dentro_poligono(latitude, longitude, poligono_wkt)),
+                [duckdb.typing.DOUBLE, duckdb.typing.DOUBLE], duckdb.typing.BOOLEAN, type="arrow",
+            )
+            estado_duckdb["funcoes"].add(nome)
+        return nome
+
+    return conexao.execute(plano_para_sql(plano, "tabela_delta", df_delta.columns, registrar_poligono, dialeto="duckdb")).df()
+
+
+# Motores disponíveis: cada um recebe o plano e devolve um DataFrame Spark ou Pandas
+MOTORES_CATALOGO = {
+    "spark": motor_spark,
+    "pandas": motor_centralizado,
+    "duckdb": motor_duckdb,
+}
+
+
+# Executa o resultado por completo (DataFrames Spark são preguiçosos; os demais motores já materializam)
+def materializar_resultado(resultado):
+    if hasattr(resultado, "write"):
+        forcar_execucao_spark(resultado)
+    return resultado
+
+
+# Confere cada motor contra o motor de referência e mede os tempos de todas as consultas do catálogo
+def benchmark_catalogo(catalogo=CATALOGO_CONSULTAS, motores=MOTORES_CATALOGO, referencia="spark",
+                       aquecimento=BENCHMARK_AQUECIMENTO, repeticoes=BENCHMARK_REPETICOES):
+    # Arquivos da versão atual resolvidos uma vez, fora das medições (usados pelo DuckDB e pelo motor em lotes).
+    # Com o motor multiprocessado, os shards e o pool também são preparados antes das medições.
+    atualizar_dataset_delta()
+    if MOTOR_CENTRALIZADO == "processos":
+        preparar_processos()
+    linhas = []
+    try:
+        for nome, plano in catalogo.items():
+            resultado_referencia = motores[referencia](plano)
+            for motor, executar in motores.items():
+                if motor != referencia:
+                    resultados_iguais, detalhe = comparar_resultados(resultado_referencia, executar(plano))
+                    if not resultados_iguais:
+                        raise AssertionError(f"{nome}: resultado do motor {motor} diverge do motor {referencia}\n{detalhe}")
+
+                tempos = medir_tempos(lambda: materializar_resultado(executar(plano)), aquecimento, repeticoes)
+                linhas.append({"consulta": nome, "motor": motor, **resumir_tempos(tempos)})
+                print(f"{nome} ({motor}): mediana {linhas[-1]['mediana']:.4f} s")
+    finally:
+        encerrar_processos()
+    return pd.DataFrame(linhas)
+
+# COMMAND ----------
+
+# Executando o catálogo em todos os motores, com validação cruzada dos resultados
+df_catalogo = benchmark_catalogo()
+df_catalogo.to_csv(os.path.join(caminho_resultados, f"catalogo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"), index=False)
+
+# Uma linha por consulta, uma coluna por motor
+df_catalogo.pivot(index="consulta", columns="motor", values="mediana").round(4).display()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC A comparação entre os ambientes sai dos tempos medidos nesta execução (`df_tempos`, medianas da bateria), e não de números fixos no texto: a célula abaixo lista, para cada consulta, o ambiente mais rápido e a diferença. A expectativa é que o Spark, por ser distribuído, ganhe nas consultas com mais trabalho por linha ou com mais dados lidos, como a consulta por polígono (Consulta 3) e o filtro relativo à média da UF (Consulta 8). Nas consultas pequenas, o custo fixo de agendar os jobs pode favorecer o ambiente centralizado. A varredura de escalabilidade mostra a partir de que tamanho o Pandas deixa de escalar.
+
+# COMMAND ----------
+
+# Conclusão a partir dos tempos medidos: ambiente mais rápido e diferença em cada consulta
+for _, linha in df_tempos.sort_values("Diferença").iterrows():
+    ambiente = "Spark" if linha["Diferença"] < 0 else "Pandas"
+    print(f"{linha['Consulta']}: {ambiente} mais rápido por {abs(linha['Diferença']):.4f} s "
+          f"(Spark {linha['Tempo Spark (s)']:.4f} s | Pandas {linha['Tempo Pandas (s)']:.4f} s)")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC A Consulta 7 passou a fazer parte da bateria de testes na etapa que identifica a maior propriedade (top-k por área, em uma única leitura), que é a parte da consulta que percorre toda a tabela. O cálculo da distância até Brasília é feito sobre uma única linha e não entra na medição.
 
 # COMMAND ----------
 
@@ -344,22 +3147,163 @@ df_tempos.display()
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ##### Cache de resultados
+# MAGIC
+# MAGIC As consultas desta seção repetem as da bateria de testes e rodam de novo a cada atualização, mesmo quando a tabela não mudou. `consultar_plano_com_cache` guarda o resultado de cada plano do catálogo em um arquivo Arrow no disco local do driver. A chave é o plano normalizado mais a versão Delta da tabela, então um novo commit na tabela muda a chave e as entradas das versões anteriores são descartadas. A chave não usa o SQL compilado, porque compilar a Consulta 8 já coleta as médias por UF, uma leitura completa da tabela que um acerto deve evitar. Para SQL escrito à mão, `consultar_com_cache` usa o texto normalizado da consulta mais a versão de cada tabela que ela lê (`tabelas_delta_cache`). Passam pelo cache as consultas cujo resultado é pequeno o bastante para ser trazido inteiro para o driver: as agregações (1, 4, 5, 6 e 8) e a Consulta 7, que devolve uma linha. As Consultas 2 e 3 extraem milhões de linhas e continuam no Spark, exibidas com `.display()`. Um resultado maior que `CACHE_MAX_BYTES` não é guardado. O cache tem limite de tamanho com remoção LRU, sobrevive entre sessões e mantém contadores de acertos, falhas, bytes servidos e bytes lidos economizados.
+
+# COMMAND ----------
+
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+
+import pyarrow as pa
+
+# Tamanho máximo do cache em disco
+CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# Diretório do cache no disco local do driver
+caminho_cache = "/local_disk0/big-data_project/cache_consultas"
+
+# Views que podem aparecer nas consultas e a tabela Delta por trás de cada uma
+tabelas_delta_cache = {"tabela_delta": caminho_delta}
+
+# Entradas do cache em ordem de uso (a primeira é a menos recente) e contadores
+entradas_cache = OrderedDict()
+estatisticas_cache = {"acertos": 0, "falhas": 0, "remocoes": 0, "bytes_servidos": 0, "bytes_lidos_economizados": 0}
+
+
+# Normaliza o texto da consulta (espaços e ponto e vírgula final não mudam o resultado)
+def normalizar_sql(sql):
+    return " ".join(sql.strip().rstrip(";").split())
+
+
+# Versão Delta atual de cada tabela registrada que a consulta lê
+def versoes_entradas(sql):
+    return {
+        nome: versao_delta(caminho)
+        for nome, caminho in tabelas_delta_cache.items()
+        if re.search(rf"\b{re.escape(nome)}\b", sql, re.IGNORECASE)
+    }
+
+
+def chave_cache(texto, versoes):
+    return hashlib.sha256(json.dumps([texto, sorted(versoes.items())]).encode()).hexdigest()
+
+
+# Recupera as entradas gravadas em disco por sessões anteriores, da menos para a mais recente
+def carregar_indice_cache(caminho=caminho_cache):
+    os.makedirs(caminho, exist_ok=True)
+    entradas_cache.clear()
+    arquivos = [os.path.join(caminho, nome) for nome in os.listdir(caminho) if nome.endswith(".arrow")]
+    for arquivo in sorted(arquivos, key=os.path.getmtime):
+        metadados = pa.ipc.open_file(pa.memory_map(arquivo, "r")).schema.metadata
+        entradas_cache[metadados[b"chave"].decode()] = {
+            "arquivo": arquivo,
+            "bytes": os.path.getsize(arquivo),
+            "bytes_lidos": int(metadados[b"bytes_lidos"]),
+            "versoes": json.loads(metadados[b"versoes"]),
+        }
+
+
+def remover_entrada_cache(chave):
+    entrada = entradas_cache.pop(chave)
+    if os.path.exists(entrada["arquivo"]):
+        os.remove(entrada["arquivo"])
+    estatisticas_cache["remocoes"] += 1
+
+
+# Descarta as entradas calculadas sobre versões antigas das tabelas
+def invalidar_cache(versoes_atuais):
+    for chave, entrada in list(entradas_cache.items()):
+        if any(nome in versoes_atuais and versao != versoes_atuais[nome] for nome, versao in entrada["versoes"].items()):
+            remover_entrada_cache(chave)
+
+
+# Remove as entradas menos usadas até o cache caber no limite
+def ajustar_tamanho_cache(limite=CACHE_MAX_BYTES):
+    while entradas_cache and sum(entrada["bytes"] for entrada in entradas_cache.values()) > limite:
+        remover_entrada_cache(next(iter(entradas_cache)))
+
+
+# Texto normalizado de um plano do catálogo (as tuplas viram listas, as chaves ficam ordenadas)
+def normalizar_plano(plano):
+    return json.dumps(plano, sort_keys=True, default=str)
+
+
+# Executa a consulta SQL, ou devolve o resultado guardado se as tabelas não mudaram desde então
+def consultar_com_cache(sql, caminho=caminho_cache):
+    sql = normalizar_sql(sql)
+    return executar_com_cache(sql, versoes_entradas(sql), lambda: spark.sql(sql), caminho)
+
+
+# Executa um plano do catálogo no Spark, ou devolve o resultado guardado se a tabela não mudou desde então.
+# A chave vem do próprio plano, e não do SQL compilado: compilar um filtro relativo ao grupo já lê a tabela
+# inteira para as referências (Consulta 8), o que um acerto do cache deve evitar.
+def consultar_plano_com_cache(plano, caminho=caminho_cache):
+    versoes = {"tabela_delta": versao_delta(tabelas_delta_cache["tabela_delta"])}
+    return executar_com_cache(normalizar_plano(plano), versoes, lambda: motor_spark(plano), caminho)
+
+
+# Devolve o resultado guardado para a consulta (texto normalizado) nas versões informadas, ou monta a consulta
+# (função sem argumentos que devolve o DataFrame Spark), executa e guarda o resultado
+def executar_com_cache(texto, versoes, consulta, caminho=caminho_cache):
+    invalidar_cache(versoes)
+    chave = chave_cache(texto, versoes)
+
+    if chave in entradas_cache:
+        entrada = entradas_cache[chave]
+        entradas_cache.move_to_end(chave)
+        os.utime(entrada["arquivo"])
+        estatisticas_cache["acertos"] += 1
+        estatisticas_cache["bytes_servidos"] += entrada["bytes"]
+        estatisticas_cache["bytes_lidos_economizados"] += entrada["bytes_lidos"]
+        return pa.ipc.open_file(pa.memory_map(entrada["arquivo"], "r")).read_all().to_pandas()
+
+    estatisticas_cache["falhas"] += 1
+    df_spark, auxiliares = montar_consulta(consulta)
+    resultado = df_spark.toPandas()
+
+    # Bytes lidos pela execução e pelas execuções auxiliares da montagem, das métricas dos nós de leitura
+    bytes_lidos = metricas_leitura(auxiliares + [df_spark._jdf.queryExecution()])["bytes_lidos"]
+
+    tabela = pa.Table.from_pandas(resultado, preserve_index=False)
+    # Um resultado maior que o cache inteiro seria removido logo após a gravação
+    if tabela.nbytes > CACHE_MAX_BYTES:
+        return resultado
+    tabela = tabela.replace_schema_metadata({
+        **(tabela.schema.metadata or {}),
+        b"chave": chave.encode(), b"consulta": texto.encode(),
+        b"versoes": json.dumps(versoes).encode(), b"bytes_lidos": str(bytes_lidos).encode(),
+    })
+    os.makedirs(caminho, exist_ok=True)
+    arquivo = os.path.join(caminho, f"{chave}.arrow")
+    with pa.OSFile(arquivo + ".tmp", "wb") as saida, pa.ipc.new_file(saida, tabela.schema) as escritor:
+        escritor.write_table(tabela)
+    os.replace(arquivo + ".tmp", arquivo)
+
+    entradas_cache[chave] = {"arquivo": arquivo, "bytes": os.path.getsize(arquivo), "bytes_lidos": bytes_lidos, "versoes": versoes}
+    ajustar_tamanho_cache()
+    return resultado
+
+
+carregar_indice_cache()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ##### Consulta 1: Recupere a soma de área (em hectares) para todas as propriedades agrícolas que pertencem ao MS e MT. Ordene os resultados em ordem decrescente. Essa consulta visa identificar a extensão total das propriedades agrícolas nos estados de Mato Grosso (MT) e Mato Grosso do Sul (MS), apresentando os resultados de forma decrescente.
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta1 = spark.sql("""
-    SELECT uf, SUM(area_do_imovel) AS area_total_hectares
-    FROM tabela_delta
-    WHERE uf IN ('MS', 'MT') 
-    GROUP BY uf 
-    ORDER BY area_total_hectares DESC
-""")
+# Executando a consulta (ou recuperando o resultado do cache)
+consulta1 = consultar_plano_com_cache(CATALOGO_CONSULTAS["Consulta 1"])
 
 # Exibindo os resultados
-consulta1.display()
+display(consulta1)
 
 # COMMAND ----------
 
@@ -368,12 +3312,8 @@ consulta1.display()
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta2 = spark.sql("""
-    SELECT *
-    FROM tabela_delta
-    WHERE uf IN ('SP', 'RJ', 'MG', 'ES')
-""")
+# Executando a consulta (extração de linhas: fica no Spark, fora do cache)
+consulta2 = motor_spark(CATALOGO_CONSULTAS["Consulta 2"])
 
 # Exibindo os resultados
 consulta2.display()
@@ -385,40 +3325,202 @@ consulta2.display()
 
 # COMMAND ----------
 
-pip install shapely
+# Executando a consulta (o polígono das coordenadas acima está no plano do catálogo; as células da grade e a
+# caixa envolvente do polígono são adicionadas ao WHERE antes do teste exato)
+consulta3 = motor_spark(CATALOGO_CONSULTAS["Consulta 3"])
+
+# Exibindo os resultados
+consulta3.display()
 
 # COMMAND ----------
 
-from shapely.geometry import Point, Polygon
-from pyspark.sql import SparkSession
+# MAGIC %md
+# MAGIC ##### Junção espacial com camadas de polígonos
+# MAGIC
+# MAGIC A Consulta 3 testa um único polígono. Para atribuir cada propriedade a uma região de uma camada com milhares de polígonos (municípios, unidades de conservação, bacias), a junção abaixo recebe uma camada em WKT (CSV) ou GeoParquet. A camada é transmitida aos executores por broadcast, em WKB, uma única vez por conteúdo: o broadcast e a árvore ficam associados a um hash dos identificadores e do WKB da camada, então medir a mesma camada várias vezes reaproveita ambos. Em cada processo Python, os polígonos são preparados e indexados uma única vez em uma STR-tree (`shapely.STRtree`), no mesmo cache por processo (`cache_processo`) do motor de ponto-em-polígono, que guarda só as árvores das camadas mais recentes. `liberar_camada_spark` remove o broadcast dos executores quando a camada não é mais usada.
+# MAGIC
+# MAGIC As propriedades passam por `mapInPandas`, em lotes Arrow. Cada lote consulta a árvore de uma vez só, e a árvore devolve apenas os polígonos cuja caixa envolvente contém o ponto. Por isso o custo cresce com o número de propriedades (vezes o logaritmo do número de polígonos), e não com propriedades × polígonos. A caixa envolvente da camada inteira é aplicada antes, como filtro empurrado para a leitura. O resultado tem um par (`registro_car`, `region_id`) para cada polígono que contém a propriedade.
+# MAGIC
+# MAGIC `juncao_espacial_pandas` faz a mesma junção no ambiente centralizado (`MOTOR_CENTRALIZADO = "memoria"`), com o mesmo corte pela caixa envolvente da camada e a mesma árvore, e só busca o `registro_car` das linhas que caíram em algum polígono. Ela é conferida contra a versão Spark e medida com as mesmas camadas.
+
+# COMMAND ----------
 
-# Criando uma sessão Spark
-spark = SparkSession.builder.appName("ConsultaPoligono").getOrCreate()
+import hashlib
+
+import pyarrow.parquet as pq
+from pyspark.sql import types as T
+
+# Camada de regiões usada no exemplo (None usa uma grade regular sobre o Brasil)
+caminho_camada_regioes = None
+
+# Número de STR-trees de camadas mantidas no cache de cada processo Python
+CAMADAS_POR_PROCESSO = 2
+
+# Broadcasts das camadas em uso no driver, por chave da camada
+camadas_transmitidas = {}
+
+
+# Carrega uma camada de polígonos (GeoParquet ou CSV com WKT) como identificadores e geometrias em WKB
+def carregar_camada_poligonos(caminho, coluna_id="region_id", coluna_geometria="geometry"):
+    caminho_local = caminho_local_dbfs(caminho)
+    if caminho_local.endswith(".csv"):
+        tabela = pd.read_csv(caminho_local)
+        geometrias = shapely.from_wkt(tabela[coluna_geometria])
+    else:
+        arquivo = pq.read_table(caminho_local)
+        # No GeoParquet, a coluna de geometria principal vem dos metadados "geo" (WKB)
+        metadados_geo = (arquivo.schema.metadata or {}).get(b"geo")
+        if metadados_geo:
+            coluna_geometria = json.loads(metadados_geo)["primary_column"]
+        tabela = arquivo.to_pandas()
+        geometrias = shapely.from_wkb(tabela[coluna_geometria])
+    return pd.DataFrame({"region_id": tabela[coluna_id].to_numpy(), "geometria": shapely.to_wkb(geometrias)})
+
+
+# Camada de teste: grade regular de células quadradas sobre o território brasileiro
+def camada_grade_regular(passo_graus=1.0, lat_min=-34.0, lat_max=6.0, lon_min=-74.0, lon_max=-34.0):
+    lats = np.arange(lat_min, lat_max, passo_graus)
+    lons = np.arange(lon_min, lon_max, passo_graus)
+    lat, lon = [eixo.ravel() for eixo in np.meshgrid(lats, lons, indexing="ij")]
+    geometrias = shapely.box(lon, lat, lon + passo_graus, lat + passo_graus)
+    return pd.DataFrame({"region_id": np.arange(len(geometrias)), "geometria": shapely.to_wkb(geometrias)})
+
+
+# Chave da camada: hash dos identificadores e do WKB dos polígonos
+def chave_camada(camada):
+    resumo = hashlib.sha256()
+    resumo.update(pd.util.hash_pandas_object(camada["region_id"], index=False).to_numpy().tobytes())
+    for wkb in camada["geometria"]:
+        resumo.update(wkb)
+    return resumo.hexdigest()
+
+
+# Transmite a camada aos executores, reaproveitando o broadcast de uma camada com o mesmo conteúdo
+def transmitir_camada(camada):
+    chave = chave_camada(camada)
+    camada_broadcast = camadas_transmitidas.get(chave)
+    if camada_broadcast is None:
+        camada_broadcast = spark.sparkContext.broadcast((camada["region_id"].to_numpy(), camada["geometria"].to_numpy()))
+        camadas_transmitidas[chave] = camada_broadcast
+    return chave, camada_broadcast
+
+
+# Remove dos executores o broadcast da camada (as consultas que ainda o usarem o transmitem de novo)
+def liberar_camada_spark(camada):
+    camada_broadcast = camadas_transmitidas.pop(chave_camada(camada), None)
+    if camada_broadcast is not None:
+        camada_broadcast.unpersist()
+
+
+# Retorna a STR-tree dos polígonos da camada transmitida, construída uma única vez por processo (por chave da camada)
+def obter_indice_camada(camada_broadcast, chave, limite=CAMADAS_POR_PROCESSO):
+    import shapely
+
+    cache = cache_processo("indices_camadas")
+    indice = cache.get(chave)
+    if indice is None:
+        ids, wkbs = camada_broadcast.value
+        geometrias = shapely.from_wkb(wkbs)
+        shapely.prepare(geometrias)
+        indice = (ids, shapely.STRtree(geometrias))
+        # Descarta as árvores mais antigas (o dicionário preserva a ordem de inserção)
+        while len(cache) >= limite:
+            cache.pop(next(iter(cache)))
+        cache[chave] = indice
+    return indice
+
+
+# Pares (índice da propriedade no lote, índice do polígono) com a propriedade dentro do polígono
+def pares_dentro_camada(latitudes, longitudes, arvore):
+    import numpy as np
+    import shapely
+
+    latitudes = np.asarray(latitudes, dtype="float64")
+    longitudes = np.asarray(longitudes, dtype="float64")
+    validos = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+    pontos = shapely.points(longitudes[validos], latitudes[validos])
+    # "within" exclui a borda, como shapely.contains_xy na Consulta 3
+    indices_pontos, indices_poligonos = arvore.query(pontos, predicate="within")
+    return validos[indices_pontos], indices_poligonos
+
+
+# Junta as propriedades com a camada de polígonos, emitindo (registro_car, region_id)
+def juncao_espacial_spark(df_spark, camada):
+    ids = camada["region_id"].to_numpy()
+    tipo_id = T.LongType() if np.issubdtype(ids.dtype, np.integer) else T.StringType()
+    chave, camada_broadcast = transmitir_camada(camada)
+
+    lon_min, lat_min, lon_max, lat_max = shapely.total_bounds(shapely.from_wkb(camada["geometria"]))
+    candidatos = df_spark.select("registro_car", "latitude", "longitude").where(
+        F.col("latitude").between(lat_min, lat_max) & F.col("longitude").between(lon_min, lon_max)
+    )
 
-# Definindo as coordenadas do polígono
-coords = [(-53.5325072, -19.4632582), (-51.0495971, -19.1625841), (-51.3734501, -16.1924262), (-53.8181518, -16.4010783), (-53.5325072, -19.4632582)]
+    def atribuir_regioes(lotes):
+        ids_regioes, arvore = obter_indice_camada(camada_broadcast, chave)
+        for lote in lotes:
+            linhas, poligonos = pares_dentro_camada(lote["latitude"], lote["longitude"], arvore)
+            yield pd.DataFrame({
+                "registro_car": lote["registro_car"].to_numpy()[linhas],
+                "region_id": ids_regioes[poligonos],
+            })
 
-# Criando um objeto Polygon (polígono)
-polygon = Polygon(coords)
+    esquema = T.StructType([T.StructField("registro_car", T.StringType()), T.StructField("region_id", tipo_id)])
+    return candidatos.mapInPandas(atribuir_regioes, schema=esquema)
 
-# Função para verificar se as coordenadas estão dentro do polígono
-def check_inside_polygon(lat, lon):
-    point = Point(lon, lat)
-    return polygon.contains(point)
 
-# Registrando a função como uma UDF (User Defined Function)
-spark.udf.register("check_inside_polygon", check_inside_polygon)
+# Versão Pandas da junção, com a mesma caixa envolvente e a mesma árvore (para o ambiente centralizado)
+def juncao_espacial_pandas(df_memoria, camada):
+    geometrias = shapely.from_wkb(camada["geometria"])
+    shapely.prepare(geometrias)
 
-# Executando a consulta
-consulta3 = spark.sql("""
-    SELECT *
-    FROM tabela_delta
-    WHERE uf IN ('GO', 'MS', 'MT')
-    AND check_inside_polygon(latitude, longitude) = True
-""")
+    lon_min, lat_min, lon_max, lat_max = shapely.total_bounds(geometrias)
+    latitudes, longitudes = df_memoria["latitude"], df_memoria["longitude"]
+    candidatos = np.flatnonzero(
+        (latitudes.between(lat_min, lat_max) & longitudes.between(lon_min, lon_max)).to_numpy(dtype=bool, na_value=False)
+    )
+    linhas, poligonos = pares_dentro_camada(
+        latitudes.iloc[candidatos], longitudes.iloc[candidatos], shapely.STRtree(geometrias)
+    )
+    # Só os registros das linhas que caíram em algum polígono são buscados
+    return pd.DataFrame({
+        "registro_car": df_memoria["registro_car"].iloc[candidatos[linhas]].reset_index(drop=True),
+        "region_id": camada["region_id"].to_numpy()[poligonos],
+    })
 
-# Exibindo os resultados
-consulta3.display()
+# COMMAND ----------
+
+# Conferindo a junção contra a Consulta 3: uma camada só com o polígono da consulta
+camada_consulta3 = pd.DataFrame({"region_id": [3], "geometria": [shapely.to_wkb(polygon)]})
+juncao_consulta3 = juncao_espacial_spark(spark.table("tabela_delta"), camada_consulta3)
+resultados_iguais, detalhe = comparar_resultados(
+    motor_spark({"filtros": [("ponto", "dentro_poligono", polygon_wkt)]}).select("registro_car", F.lit(3).alias("region_id")),
+    juncao_consulta3,
+)
+# A versão Pandas tem de emitir os mesmos pares que a versão Spark
+if resultados_iguais and MOTOR_CENTRALIZADO == "memoria":
+    resultados_iguais, detalhe = comparar_resultados(juncao_consulta3, juncao_espacial_pandas(df_pd, camada_consulta3))
+liberar_camada_spark(camada_consulta3)
+if not resultados_iguais:
+    raise AssertionError(f"Junção espacial diverge da Consulta 3\n{detalhe}")
+
+# Tempo da junção com camadas cada vez maiores: deve crescer pouco com o número de polígonos
+linhas_juncao = []
+for passo in [4.0, 2.0, 1.0, 0.5, 0.25]:
+    camada = camada_grade_regular(passo)
+    tempos = medir_tempos(lambda: forcar_execucao_spark(juncao_espacial_spark(spark.table("tabela_delta"), camada)))
+    liberar_camada_spark(camada)
+    linha = {"poligonos": len(camada), **resumir_tempos(tempos)}
+    if MOTOR_CENTRALIZADO == "memoria":
+        tempos_pandas = medir_tempos(lambda: juncao_espacial_pandas(df_pd, camada))
+        linha.update({f"pandas_{nome}": valor for nome, valor in resumir_tempos(tempos_pandas).items()})
+    linhas_juncao.append(linha)
+pd.DataFrame(linhas_juncao).round(4).display()
+
+# Propriedades por região da camada configurada
+camada_regioes = carregar_camada_poligonos(caminho_camada_regioes) if caminho_camada_regioes else camada_grade_regular()
+regioes = juncao_espacial_spark(spark.table("tabela_delta"), camada_regioes)
+display(regioes.groupBy("region_id").agg(F.count(F.lit(1)).alias("total_propriedades")).orderBy(F.desc("total_propriedades")))
+liberar_camada_spark(camada_regioes)
 
 # COMMAND ----------
 
@@ -427,16 +3529,11 @@ consulta3.display()
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta4 = spark.sql("""
-    SELECT YEAR(data_inscricao) AS ano, COUNT(*) AS total_propriedades
-    FROM tabela_delta
-    GROUP BY YEAR(data_inscricao)
-    ORDER BY ano
-""")
+# Executando a consulta (ou recuperando o resultado do cache)
+consulta4 = consultar_plano_com_cache(CATALOGO_CONSULTAS["Consulta 4"])
 
 # Exibindo os resultados
-consulta4.display()
+display(consulta4)
 
 # COMMAND ----------
 
@@ -445,14 +3542,11 @@ consulta4.display()
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta5 = spark.sql("""
-    SELECT AVG(area_remanescente_vegetacao_nativa / area_do_imovel) AS percentual_medio
-    FROM tabela_delta
-""")
+# Executando a consulta (ou recuperando o resultado do cache)
+consulta5 = consultar_plano_com_cache(CATALOGO_CONSULTAS["Consulta 5"])
 
 # Exibindo os resultados
-consulta5.display()
+display(consulta5)
 
 # COMMAND ----------
 
@@ -461,15 +3555,11 @@ consulta5.display()
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta6 = spark.sql("""
-    SELECT uf, COUNT(*) AS total_propriedades
-    FROM tabela_delta
-    GROUP BY uf
-""")
+# Executando a consulta (ou recuperando o resultado do cache)
+consulta6 = consultar_plano_com_cache(CATALOGO_CONSULTAS["Consulta 6"])
 
 # Exibindo os resultados
-consulta6.display()
+display(consulta6)
 
 # COMMAND ----------
 
@@ -478,44 +3568,126 @@ consulta6.display()
 
 # COMMAND ----------
 
-import math
-from pyspark.sql.functions import lit, col
+# MAGIC %md
+# MAGIC ##### Subsistema de distâncias
+# MAGIC
+# MAGIC Duas peças reaproveitáveis para consultas de distância: a distância de Haversine vetorizada (NumPy no driver e expressão nativa de coluna no Spark) de cada propriedade até qualquer ponto de referência, como Brasília ou as capitais, e a busca das N propriedades mais próximas de um ponto, apoiada em uma árvore espacial (KD-tree sobre as coordenadas na esfera unitária) no driver e no índice em grade no Spark.
+
+# COMMAND ----------
+
+import numpy as np
+from pyspark.sql import functions as F
+from scipy.spatial import cKDTree
+
+# Coordenadas (latitude, longitude) de Brasília e das capitais, por UF
+BRASILIA = (-15.826691, -47.921822)
+CAPITAIS = {
+    'AC': (-9.9747, -67.8076), 'AL': (-9.6658, -35.7353), 'AM': (-3.1190, -60.0217), 'AP': (0.0349, -51.0694),
+    'BA': (-12.9714, -38.5014), 'CE': (-3.7319, -38.5267), 'DF': BRASILIA, 'ES': (-20.3155, -40.3128),
+    'GO': (-16.6869, -49.2648), 'MA': (-2.5307, -44.3068), 'MG': (-19.9167, -43.9345), 'MS': (-20.4697, -54.6201),
+    'MT': (-15.6014, -56.0979), 'PA': (-1.4558, -48.4902), 'PB': (-7.1195, -34.8450), 'PE': (-8.0476, -34.8770),
+    'PI': (-5.0920, -42.8038), 'PR': (-25.4284, -49.2733), 'RJ': (-22.9068, -43.1729), 'RN': (-5.7945, -35.2110),
+    'RO': (-8.7612, -63.9004), 'RR': (2.8235, -60.6758), 'RS': (-30.0346, -51.2177), 'SC': (-27.5954, -48.5480),
+    'SE': (-10.9472, -37.0731), 'SP': (-23.5505, -46.6333), 'TO': (-10.1840, -48.3336),
+}
+
+
+# Distância de Haversine (km) entre vetores de coordenadas e um ponto de referência, em NumPy
+def haversine_km(latitudes, longitudes, latitude_ref, longitude_ref):
+    lat1 = np.radians(np.asarray(latitudes, dtype="float64"))
+    lat2 = np.radians(latitude_ref)
+    dlat = lat2 - lat1
+    dlon = np.radians(longitude_ref - np.asarray(longitudes, dtype="float64"))
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * RAIO_TERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# Distância de Haversine (km) até um ponto de referência como expressão nativa do Spark (sem UDF)
+def coluna_haversine_km(latitude_ref, longitude_ref):
+    return F.expr(expressao_haversine_km(latitude_ref, longitude_ref))
+
+
+# Acrescenta uma coluna distancia_<nome>_km para cada ponto de referência
+def com_distancias_spark(df_spark, referencias):
+    for nome, (latitude_ref, longitude_ref) in referencias.items():
+        df_spark = df_spark.withColumn(f"distancia_{nome}_km", coluna_haversine_km(latitude_ref, longitude_ref))
+    return df_spark
+
+
+def com_distancias_pandas(df_memoria, referencias):
+    colunas = {
+        f"distancia_{nome}_km": haversine_km(df_memoria['latitude'], df_memoria['longitude'], latitude_ref, longitude_ref)
+        for nome, (latitude_ref, longitude_ref) in referencias.items()
+    }
+    return df_memoria.assign(**colunas)
+
+
+# Coordenadas cartesianas na esfera unitária: a distância euclidiana entre elas cresce com a distância na superfície
+def coordenadas_esfera(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype="float64"))
+    lon = np.radians(np.asarray(longitudes, dtype="float64"))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+# Constrói a KD-tree das propriedades com coordenadas válidas; retorna a árvore e as posições originais
+def construir_indice_proximidade(df_memoria):
+    validas = np.flatnonzero(np.isfinite(df_memoria['latitude'].to_numpy(dtype="float64"))
+                             & np.isfinite(df_memoria['longitude'].to_numpy(dtype="float64")))
+    pontos = coordenadas_esfera(df_memoria['latitude'].to_numpy()[validas], df_memoria['longitude'].to_numpy()[validas])
+    return cKDTree(pontos), validas
+
+
+# As k propriedades mais próximas de um ponto, usando a KD-tree
+def propriedades_mais_proximas(indice, df_memoria, latitude, longitude, k=10):
+    arvore, posicoes = indice
+    _, vizinhos = arvore.query(coordenadas_esfera([latitude], [longitude])[0], k=min(k, arvore.n))
+    proximas = df_memoria.iloc[posicoes[np.atleast_1d(vizinhos)]]
+    return proximas.assign(distancia_km=haversine_km(proximas['latitude'], proximas['longitude'], latitude, longitude))
+
+
+# As k propriedades mais próximas de um ponto no Spark: o raio de busca cresce até conter k propriedades,
+# e cada busca lê apenas as células da grade que cobrem o raio
+def propriedades_mais_proximas_spark(tabela, latitude, longitude, k=10, raio_inicial_km=10):
+    raio = raio_inicial_km
+    while True:
+        candidatas = spark.sql(montar_sql_raio(tabela, latitude, longitude, raio))
+        if raio >= np.pi * RAIO_TERRA_KM or candidatas.count() >= k:
+            return candidatas.orderBy("distancia_km").limit(k)
+        raio *= 4
 
-# Encontrar a maior área
-maior_area = df.agg({"area_do_imovel": "max"}).collect()[0][0]
+# COMMAND ----------
 
-# Filtrar para obter a propriedade com a maior área
-maior_propriedade = df.filter(col("area_do_imovel") == lit(maior_area)).first()
+# Maior propriedade da tabela Delta (plano do catálogo, ou o resultado do cache), com as distâncias até Brasília e as capitais
+consulta7 = com_distancias_pandas(consultar_plano_com_cache(CATALOGO_CONSULTAS["Consulta 7"]), {"brasilia": BRASILIA, **CAPITAIS})
 
-# Coordenadas de Brasília
-brasilia_coords = (-15.826691, -47.921822)  # Substitua pelas coordenadas reais de Brasília
+print("A maior propriedade entre todas é:")
+display(consulta7)
 
-# Coordenadas do centro da maior propriedade
-centro_maior_propriedade = (maior_propriedade['latitude'], maior_propriedade['longitude'])
+print("\nDistância até Brasília: %.2f km" % consulta7['distancia_brasilia_km'].iloc[0])
+capital_proxima = min(CAPITAIS, key=lambda uf: consulta7[f"distancia_{uf}_km"].iloc[0])
+print("Capital mais próxima: %s (%.2f km)" % (capital_proxima, consulta7[f"distancia_{capital_proxima}_km"].iloc[0]))
 
-# Função para calcular a distância entre dois pontos usando a fórmula de Haversine
-def haversine_distance(origin, destination):
-    lat1, lon1 = origin
-    lat2, lon2 = destination
-    radius = 6371  # Raio médio da Terra em km
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) * math.sin(dlon / 2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = radius * c
-    return distance
+# COMMAND ----------
 
-# Calculando a distância entre a propriedade e Brasília
-distancia_para_brasilia = haversine_distance(centro_maior_propriedade, brasilia_coords)
+# Distância de cada propriedade até a capital mais próxima, em expressões nativas do Spark, com a média por UF
+distancias_capitais = com_distancias_spark(spark.table("tabela_delta").select("uf", "latitude", "longitude"), CAPITAIS)
+distancias_capitais = distancias_capitais.withColumn(
+    "distancia_capital_km", F.least(*[F.col(f"distancia_{uf}_km") for uf in CAPITAIS])
+)
+display(
+    distancias_capitais.groupBy("uf")
+    .agg(F.avg("distancia_capital_km").alias("distancia_media_capital_km"), F.max("distancia_capital_km").alias("distancia_maxima_capital_km"))
+    .orderBy("uf")
+)
 
-print("A maior propriedade entre todas é:")
+# COMMAND ----------
 
-# Filtrar para obter a propriedade com a maior área
-consulta7 = df_delta.filter(col("area_do_imovel") == lit(maior_area)).select(
-    'uf', 'municipio', 'codigo_ibge', 'area_do_imovel', 'registro_car', 'situacao_cadastro', 'condicao_cadastro'
-).display()
+# As 10 propriedades mais próximas de Brasília, pelo índice em grade (Spark) e pela KD-tree (Pandas)
+propriedades_mais_proximas_spark("tabela_delta", *BRASILIA, k=10).display()
 
-print("\nDistância até Brasília: %.2f km" % distancia_para_brasilia)
+if MOTOR_CENTRALIZADO == "memoria":
+    indice_proximidade = construir_indice_proximidade(df_pd)
+    display(propriedades_mais_proximas(indice_proximidade, df_pd, *BRASILIA, k=10))
 
 # COMMAND ----------
 
@@ -524,19 +3696,18 @@ print("\nDistância até Brasília: %.2f km" % distancia_para_brasilia)
 
 # COMMAND ----------
 
-# Executando a consulta
-consulta8 = spark.sql("""
-    WITH media_por_estado AS (
-        SELECT uf, AVG(area_do_imovel) AS media_area
-        FROM tabela_delta
-        GROUP BY uf
-    )
-    SELECT t.uf, COUNT(*) AS propriedades_acima_media
-    FROM tabela_delta t
-    JOIN media_por_estado m ON t.uf = m.uf
-    WHERE t.area_do_imovel > m.media_area
-    GROUP BY t.uf
-""")
+# Executando a consulta (ou recuperando o resultado do cache): o plano da bateria com a média nacional como referência
+plano_consulta8 = CATALOGO_CONSULTAS["Consulta 8"]
+consulta8 = consultar_plano_com_cache({**plano_consulta8, "filtros": [("area_do_imovel", "relativo_grupo", ("acima", "media", None))]})
 
 # Exibindo os resultados
-consulta8.display()
+display(consulta8)
+
+# Para comparação, a contagem usando a média de área de cada UF (a versão da bateria)
+display(consultar_plano_com_cache(plano_consulta8))
+
+# COMMAND ----------
+
+# Contadores do cache de resultados desta sessão
+print(f"Acertos: {estatisticas_cache['acertos']} | falhas: {estatisticas_cache['falhas']} | remoções: {estatisticas_cache['remocoes']}")
+print(f"Bytes servidos do cache: {estatisticas_cache['bytes_servidos']} | bytes lidos economizados: {estatisticas_cache['bytes_lidos_economizados']}")